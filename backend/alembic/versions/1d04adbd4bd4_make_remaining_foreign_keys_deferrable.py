@@ -0,0 +1,38 @@
+"""Make remaining foreign keys deferrable
+
+Revision ID: 1d04adbd4bd4
+Revises: 8beb15063c1e
+Create Date: 2026-10-19 18:33:51.477310
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "1d04adbd4bd4"
+down_revision: Union[str, None] = "8beb15063c1e"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+DEFERRABLE_FOREIGN_KEYS = [
+    ("ladder_history", "ladder_history_ladder_id_fkey"),
+    ("character_mmr", "character_mmr_character_id_fkey"),
+    ("character_mmr_rollup", "character_mmr_rollup_character_id_fkey"),
+    ("team_mmr", "team_mmr_team_id_fkey"),
+    ("match", "match_profile_id_fkey"),
+    ("match", "match_game_id_fkey"),
+    ("match", "match_team_id_fkey"),
+]
+
+
+def upgrade() -> None:
+    # Every foreign key is deferrable like the model declares, not only the ones backfill writes
+    for table, constraint in DEFERRABLE_FOREIGN_KEYS:
+        op.execute(f'ALTER TABLE "{table}" ALTER CONSTRAINT {constraint} DEFERRABLE INITIALLY IMMEDIATE')
+
+
+def downgrade() -> None:
+    for table, constraint in DEFERRABLE_FOREIGN_KEYS:
+        op.execute(f'ALTER TABLE "{table}" ALTER CONSTRAINT {constraint} NOT DEFERRABLE')
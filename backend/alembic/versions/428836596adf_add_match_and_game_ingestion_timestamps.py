@@ -0,0 +1,32 @@
+"""Add match and game ingestion timestamps
+
+Revision ID: 428836596adf
+Revises: bb88cc4a4240
+Create Date: 2026-10-19 18:20:32.364768
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "428836596adf"
+down_revision: Union[str, None] = "bb88cc4a4240"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column("match", sa.Column("created_timestamp", sa.Integer(), nullable=True))
+    op.add_column("game", sa.Column("created_timestamp", sa.Integer(), nullable=True))
+    op.create_index("match_created_timestamp_index", "match", ["created_timestamp"])
+    op.create_index("game_created_timestamp_index", "game", ["created_timestamp"])
+
+
+def downgrade() -> None:
+    op.drop_index("game_created_timestamp_index", table_name="game")
+    op.drop_index("match_created_timestamp_index", table_name="match")
+    op.drop_column("game", "created_timestamp")
+    op.drop_column("match", "created_timestamp")
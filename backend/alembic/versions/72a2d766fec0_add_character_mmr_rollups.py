@@ -0,0 +1,49 @@
+"""Add character MMR rollups
+
+Revision ID: 72a2d766fec0
+Revises: a8f672877d6f
+Create Date: 2026-10-19 18:08:39.548441
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision: str = "72a2d766fec0"
+down_revision: Union[str, None] = "a8f672877d6f"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "character_mmr_rollup",
+        sa.Column("id", sa.Uuid(), nullable=False),
+        sa.Column("race", postgresql.ENUM(name="race", create_type=False), nullable=False),
+        sa.Column("resolution", sa.Integer(), nullable=False),
+        sa.Column("bucket", sa.Integer(), nullable=False),
+        sa.Column("open", sa.Integer(), nullable=False),
+        sa.Column("high", sa.Integer(), nullable=False),
+        sa.Column("low", sa.Integer(), nullable=False),
+        sa.Column("close", sa.Integer(), nullable=False),
+        sa.Column("open_date", sa.Integer(), nullable=False),
+        sa.Column("close_date", sa.Integer(), nullable=False),
+        sa.Column("wins", sa.Integer(), nullable=True),
+        sa.Column("losses", sa.Integer(), nullable=True),
+        sa.Column("character_id", sa.Uuid(), nullable=True),
+        sa.ForeignKeyConstraint(["character_id"], ["character.id"]),
+        sa.PrimaryKeyConstraint("id"),
+        sa.UniqueConstraint(
+            "character_id", "race", "resolution", "bucket", name="character_mmr_rollup_unique_constraint"
+        ),
+    )
+    op.create_index("character_mmr_date_index", "character_mmr", ["date"])
+
+
+def downgrade() -> None:
+    op.drop_index("character_mmr_date_index", table_name="character_mmr")
+    op.drop_table("character_mmr_rollup")
@@ -0,0 +1,28 @@
+"""Add character MMR ingestion timestamp
+
+Revision ID: 8beb15063c1e
+Revises: db3ab0a43a8a
+Create Date: 2026-10-19 18:33:27.325128
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "8beb15063c1e"
+down_revision: Union[str, None] = "db3ab0a43a8a"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column("character_mmr", sa.Column("created_timestamp", sa.Integer(), nullable=True))
+    op.create_index("character_mmr_created_timestamp_index", "character_mmr", ["created_timestamp"])
+
+
+def downgrade() -> None:
+    op.drop_index("character_mmr_created_timestamp_index", table_name="character_mmr")
+    op.drop_column("character_mmr", "created_timestamp")
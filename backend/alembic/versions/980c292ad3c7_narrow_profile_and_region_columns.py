@@ -0,0 +1,68 @@
+"""Narrow profile and region columns
+
+Revision ID: 980c292ad3c7
+Revises: c3a30913b39d
+Create Date: 2026-10-19 17:54:54.900014
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "980c292ad3c7"
+down_revision: Union[str, None] = "c3a30913b39d"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+SMALLINT_COLUMNS = {
+    "league": ["league_id", "region_id", "queue_id", "team_type"],
+    "ladder": ["region_id"],
+    "profile": ["realm_id", "region_id"],
+    "team": ["region_id", "queue_id", "team_type"],
+    "retry_request": ["region_id"],
+    "backfill_checkpoint": ["region_id"],
+    "change_event": ["region_id"],
+}
+
+
+def upgrade() -> None:
+    bind = op.get_bind()
+    non_numeric = bind.execute(sa.text("SELECT count(*) FROM profile WHERE profile_id !~ '^[0-9]+$'")).scalar()
+    if non_numeric:
+        raise RuntimeError(f"{non_numeric} profiles have a non numeric profile_id, fix them before migrating")
+
+    for table, columns in SMALLINT_COLUMNS.items():
+        for column in columns:
+            out_of_range = bind.execute(
+                sa.text(f'SELECT count(*) FROM "{table}" WHERE {column} NOT BETWEEN -32768 AND 32767')
+            ).scalar()
+            if out_of_range:
+                raise RuntimeError(f"{out_of_range} rows of {table}.{column} do not fit in a smallint")
+
+    # One ALTER per table so each table is rewritten once
+    op.execute(
+        "ALTER TABLE profile "
+        + "ALTER COLUMN profile_id TYPE bigint USING profile_id::bigint, "
+        + "ALTER COLUMN realm_id TYPE smallint, "
+        + "ALTER COLUMN region_id TYPE smallint"
+    )
+    for table, columns in SMALLINT_COLUMNS.items():
+        if table == "profile":
+            continue
+        op.execute(f'ALTER TABLE "{table}" ' + ", ".join(f"ALTER COLUMN {column} TYPE smallint" for column in columns))
+
+
+def downgrade() -> None:
+    for table, columns in SMALLINT_COLUMNS.items():
+        if table == "profile":
+            continue
+        op.execute(f'ALTER TABLE "{table}" ' + ", ".join(f"ALTER COLUMN {column} TYPE integer" for column in columns))
+    op.execute(
+        "ALTER TABLE profile "
+        + "ALTER COLUMN profile_id TYPE varchar USING profile_id::varchar, "
+        + "ALTER COLUMN realm_id TYPE integer, "
+        + "ALTER COLUMN region_id TYPE integer"
+    )
@@ -0,0 +1,33 @@
+"""Add oauth token
+
+Revision ID: a8f672877d6f
+Revises: 980c292ad3c7
+Create Date: 2026-10-19 18:02:40.287898
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "a8f672877d6f"
+down_revision: Union[str, None] = "980c292ad3c7"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "oauth_token",
+        sa.Column("client_id", sa.String(), nullable=False),
+        sa.Column("access_token", sa.String(), nullable=False),
+        sa.Column("expires_timestamp", sa.Integer(), nullable=False),
+        sa.Column("updated_timestamp", sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint("client_id"),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("oauth_token")
@@ -0,0 +1,37 @@
+"""Add ladder history
+
+Revision ID: bb88cc4a4240
+Revises: 72a2d766fec0
+Create Date: 2026-10-19 18:10:35.269768
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "bb88cc4a4240"
+down_revision: Union[str, None] = "72a2d766fec0"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "ladder_history",
+        sa.Column("id", sa.Uuid(), nullable=False),
+        sa.Column("timestamp", sa.Integer(), nullable=False),
+        sa.Column("keyframe", sa.Boolean(), nullable=False),
+        sa.Column("members", sa.JSON(), nullable=False),
+        sa.Column("ladder_id", sa.Uuid(), nullable=True),
+        sa.ForeignKeyConstraint(["ladder_id"], ["ladder.id"]),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index("ladder_history_ladder_id_timestamp_index", "ladder_history", ["ladder_id", "timestamp"])
+
+
+def downgrade() -> None:
+    op.drop_index("ladder_history_ladder_id_timestamp_index", table_name="ladder_history")
+    op.drop_table("ladder_history")
@@ -0,0 +1,49 @@
+"""Add change event outbox
+
+Revision ID: c3a30913b39d
+Revises: f81f731dd64a
+Create Date: 2026-10-19 17:51:48.139579
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "c3a30913b39d"
+down_revision: Union[str, None] = "f81f731dd64a"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "change_event",
+        sa.Column("id", sa.BigInteger(), sa.Identity(), nullable=False),
+        sa.Column("transaction_id", sa.BigInteger(), server_default=sa.text("txid_current()"), nullable=False),
+        sa.Column("batch_id", sa.Uuid(), nullable=False),
+        sa.Column("table_name", sa.String(), nullable=False),
+        sa.Column("rows", sa.Integer(), nullable=False),
+        sa.Column("region_id", sa.Integer(), nullable=True),
+        sa.Column("min_timestamp", sa.Integer(), nullable=True),
+        sa.Column("max_timestamp", sa.Integer(), nullable=True),
+        sa.Column("created_timestamp", sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index("change_event_transaction_id_id_index", "change_event", ["transaction_id", "id"])
+    op.create_table(
+        "change_feed_cursor",
+        sa.Column("consumer", sa.String(), nullable=False),
+        sa.Column("last_transaction_id", sa.BigInteger(), nullable=False),
+        sa.Column("last_event_id", sa.BigInteger(), nullable=False),
+        sa.Column("updated_timestamp", sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint("consumer"),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("change_feed_cursor")
+    op.drop_index("change_event_transaction_id_id_index", table_name="change_event")
+    op.drop_table("change_event")
@@ -0,0 +1,30 @@
+"""Add ladder counters to character mmr
+
+Revision ID: d1902639ed2c
+Revises: 5371375b3e9e
+Create Date: 2026-10-19 17:34:18.765151
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "d1902639ed2c"
+down_revision: Union[str, None] = "5371375b3e9e"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column("character_mmr", sa.Column("wins", sa.Integer(), nullable=True))
+    op.add_column("character_mmr", sa.Column("losses", sa.Integer(), nullable=True))
+    op.add_column("character_mmr", sa.Column("points", sa.Integer(), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column("character_mmr", "points")
+    op.drop_column("character_mmr", "losses")
+    op.drop_column("character_mmr", "wins")
@@ -0,0 +1,56 @@
+"""Add team and team mmr
+
+Revision ID: d914249245a5
+Revises: dc287d3a5bb1
+Create Date: 2026-10-19 17:38:06.138389
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "d914249245a5"
+down_revision: Union[str, None] = "dc287d3a5bb1"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "team",
+        sa.Column("id", sa.Uuid(), nullable=False),
+        sa.Column("region_id", sa.Integer(), nullable=False),
+        sa.Column("queue_id", sa.Integer(), nullable=False),
+        sa.Column("team_type", sa.Integer(), nullable=False),
+        sa.Column("team_key", sa.String(), nullable=False),
+        sa.PrimaryKeyConstraint("id"),
+        sa.UniqueConstraint("region_id", "queue_id", "team_type", "team_key", name="team_unique_constraint"),
+    )
+    op.create_table(
+        "team_mmr",
+        sa.Column("id", sa.Uuid(), nullable=False),
+        sa.Column("mmr", sa.Integer(), nullable=False),
+        sa.Column("date", sa.Integer(), nullable=False),
+        sa.Column("wins", sa.Integer(), nullable=True),
+        sa.Column("losses", sa.Integer(), nullable=True),
+        sa.Column("points", sa.Integer(), nullable=True),
+        sa.Column("team_id", sa.Uuid(), nullable=True),
+        sa.ForeignKeyConstraint(
+            ["team_id"],
+            ["team.id"],
+        ),
+        sa.PrimaryKeyConstraint("id"),
+        sa.UniqueConstraint("team_id", "mmr", "date", name="team_mmr_unique_constraint"),
+    )
+    op.add_column("match", sa.Column("team_id", sa.Uuid(), nullable=True))
+    op.create_foreign_key(None, "match", "team", ["team_id"], ["id"])
+
+
+def downgrade() -> None:
+    op.drop_constraint("match_team_id_fkey", "match", type_="foreignkey")
+    op.drop_column("match", "team_id")
+    op.drop_table("team_mmr")
+    op.drop_table("team")
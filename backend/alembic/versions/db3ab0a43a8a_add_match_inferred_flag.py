@@ -0,0 +1,28 @@
+"""Add match inferred flag
+
+Revision ID: db3ab0a43a8a
+Revises: 428836596adf
+Create Date: 2026-10-19 18:31:10.848466
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "db3ab0a43a8a"
+down_revision: Union[str, None] = "428836596adf"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column("match", sa.Column("inferred", sa.Boolean(), server_default=sa.false(), nullable=False))
+    # Inferred matches written before this revision are the only decided ones without a map
+    op.execute("UPDATE match SET inferred = true WHERE map IS NULL AND decision IS NOT NULL")
+
+
+def downgrade() -> None:
+    op.drop_column("match", "inferred")
@@ -0,0 +1,26 @@
+"""Add match history polled timestamp
+
+Revision ID: dc287d3a5bb1
+Revises: ed671699be7c
+Create Date: 2026-10-19 17:36:47.959619
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "dc287d3a5bb1"
+down_revision: Union[str, None] = "ed671699be7c"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column("profile", sa.Column("match_history_polled_timestamp", sa.Integer(), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column("profile", "match_history_polled_timestamp")
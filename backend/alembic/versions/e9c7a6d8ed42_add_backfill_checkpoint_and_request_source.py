@@ -0,0 +1,52 @@
+"""Add backfill checkpoint and request source
+
+Revision ID: e9c7a6d8ed42
+Revises: 01606cdc325f
+Create Date: 2026-10-19 17:48:32.246870
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "e9c7a6d8ed42"
+down_revision: Union[str, None] = "01606cdc325f"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+DEFERRABLE_FOREIGN_KEYS = [
+    ("ladder", "ladder_league_id_fkey"),
+    ("character", "character_profile_id_fkey"),
+    ("ladder_member", "ladder_member_profile_id_fkey"),
+    ("ladder_member", "ladder_member_ladder_id_fkey"),
+]
+
+
+def upgrade() -> None:
+    op.add_column("request", sa.Column("source", sa.String(), server_default="live", nullable=False))
+    op.create_table(
+        "backfill_checkpoint",
+        sa.Column("id", sa.Uuid(), nullable=False),
+        sa.Column("region_id", sa.Integer(), nullable=False),
+        sa.Column("season_id", sa.Integer(), nullable=False),
+        sa.Column("leagues_done", sa.Boolean(), nullable=False),
+        sa.Column("last_ladder_id", sa.Integer(), nullable=True),
+        sa.Column("ladders", sa.Integer(), nullable=False),
+        sa.Column("completed_timestamp", sa.Integer(), nullable=True),
+        sa.Column("updated_timestamp", sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint("id"),
+        sa.UniqueConstraint("region_id", "season_id", name="backfill_checkpoint_unique_constraint"),
+    )
+    # Backfill batches check foreign keys once at commit
+    for table, constraint in DEFERRABLE_FOREIGN_KEYS:
+        op.execute(f'ALTER TABLE "{table}" ALTER CONSTRAINT {constraint} DEFERRABLE INITIALLY IMMEDIATE')
+
+
+def downgrade() -> None:
+    for table, constraint in DEFERRABLE_FOREIGN_KEYS:
+        op.execute(f'ALTER TABLE "{table}" ALTER CONSTRAINT {constraint} NOT DEFERRABLE')
+    op.drop_table("backfill_checkpoint")
+    op.drop_column("request", "source")
@@ -0,0 +1,28 @@
+"""Add match history high water mark
+
+Revision ID: ed671699be7c
+Revises: d1902639ed2c
+Create Date: 2026-10-19 17:35:33.348839
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "ed671699be7c"
+down_revision: Union[str, None] = "d1902639ed2c"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column("profile", sa.Column("match_history_timestamp", sa.Integer(), nullable=True))
+    op.create_unique_constraint("match_unique_constraint", "match", ["profile_id", "map", "type", "start_timestamp"])
+
+
+def downgrade() -> None:
+    op.drop_constraint("match_unique_constraint", "match", type_="unique")
+    op.drop_column("profile", "match_history_timestamp")
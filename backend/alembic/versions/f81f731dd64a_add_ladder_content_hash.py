@@ -0,0 +1,26 @@
+"""Add ladder content hash
+
+Revision ID: f81f731dd64a
+Revises: e9c7a6d8ed42
+Create Date: 2026-10-19 17:50:50.624153
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "f81f731dd64a"
+down_revision: Union[str, None] = "e9c7a6d8ed42"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column("ladder", sa.Column("content_hash", sa.String(), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column("ladder", "content_hash")
@@ -0,0 +1,332 @@
+"""
+Vectorized MMR distribution and league cutoff analytics
+"""
+
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from threading import Lock
+
+import numpy as np
+from sqlalchemy import String, cast, func
+
+from backend.db.db import query, session_scope
+from backend.db.model import (
+    Character,
+    CharacterMMR,
+    Ladder,
+    LadderMember,
+    League,
+    Profile,
+)
+from backend.enums import LeagueId, QueueId, Race
+from backend.static import (
+    ANALYTICS_CACHE_SIZE,
+    ANALYTICS_DRIFT_BUCKET,
+    ANALYTICS_SNAPSHOT_INTERVAL,
+    LEAGUE_CUTOFF_PERCENTILE,
+    MMR_HISTOGRAM_BIN_WIDTH,
+    MMR_PERCENTILES,
+)
+from backend.utils.datetime import current_epoch_time
+from backend.utils.log import get_logger
+
+logger = get_logger(__name__)
+
+RACES = [race.value for race in Race]
+LEAGUES = [league.value for league in LeagueId]
+
+
+@dataclass
+class MMRSnapshot:
+    """Latest MMR per (character, race) as parallel columns"""
+
+    region_id: int
+    season_id: int
+    snapshot: int
+    mmr: np.ndarray = field(default_factory=lambda: np.empty(0, dtype=np.int32))
+    race: np.ndarray = field(default_factory=lambda: np.empty(0, dtype=np.int8))
+    league: np.ndarray = field(default_factory=lambda: np.empty(0, dtype=np.int8))
+    date: np.ndarray = field(default_factory=lambda: np.empty(0, dtype=np.int64))
+
+    def __len__(self):
+        return len(self.mmr)
+
+
+@dataclass
+class MMRDistribution:
+    region_id: int
+    season_id: int
+    snapshot: int
+    count: int
+    histogram: np.ndarray
+    bin_edges: np.ndarray
+    percentiles: dict
+    race_share_by_league: np.ndarray
+    league_cutoffs: np.ndarray
+    cutoff_drift: np.ndarray
+    cutoff_drift_buckets: np.ndarray
+
+    def as_dict(self):
+        return {
+            "region_id": self.region_id,
+            "season_id": self.season_id,
+            "snapshot": self.snapshot,
+            "count": self.count,
+            "histogram": self.histogram.tolist(),
+            "bin_edges": self.bin_edges.tolist(),
+            "percentiles": self.percentiles,
+            "race_share_by_league": {
+                LeagueId(league).name: dict(zip(RACES, shares.tolist()))
+                for league, shares in zip(LEAGUES, self.race_share_by_league)
+            },
+            "league_cutoffs": {
+                LeagueId(league).name: (None if np.isnan(cutoff) else int(cutoff))
+                for league, cutoff in zip(LEAGUES, self.league_cutoffs)
+            },
+            "cutoff_drift": {
+                int(bucket): [None if np.isnan(cutoff) else int(cutoff) for cutoff in cutoffs]
+                for bucket, cutoffs in zip(self.cutoff_drift_buckets, self.cutoff_drift)
+            },
+        }
+
+
+class DistributionCache:
+    """Bounded LRU keyed by (region_id, season_id, snapshot)"""
+
+    lock = Lock()
+    entries = OrderedDict()
+
+    @classmethod
+    def get(cls, key):
+        with cls.lock:
+            if key not in cls.entries:
+                return None
+
+            cls.entries.move_to_end(key)
+            return cls.entries[key]
+
+    @classmethod
+    def set(cls, key, value):
+        with cls.lock:
+            cls.entries[key] = value
+            cls.entries.move_to_end(key)
+            while len(cls.entries) > ANALYTICS_CACHE_SIZE:
+                cls.entries.popitem(last=False)
+
+
+def snapshot_epoch(timestamp=None):
+    """Round down to the snapshot interval so that nearby reads share a cache entry"""
+    if timestamp is None:
+        timestamp = current_epoch_time()
+
+    return timestamp - timestamp % ANALYTICS_SNAPSHOT_INTERVAL
+
+
+def current_season_id(session, region_id):
+    return session.query(func.max(League.season_id)).filter(League.region_id == region_id).scalar()
+
+
+def encode(values, vocabulary):
+    """Map a column of labels onto their index in vocabulary without a per-row loop"""
+    if not len(values):
+        return np.empty(0, dtype=np.int8)
+
+    labels, inverse = np.unique(np.asarray(values), return_inverse=True)
+    lookup = np.array([vocabulary.index(label) for label in labels.tolist()], dtype=np.int8)
+    return lookup[inverse]
+
+
+def league_by_profile_subquery(session, region_id, season_id):
+    """Highest 1v1 league reached by each profile in the season"""
+    return (
+        session.query(LadderMember.profile_id, func.max(League.league_id).label("league_id"))
+        .join(Ladder, Ladder.id == LadderMember.ladder_id)
+        .join(League, League.id == Ladder.league_id)
+        .filter(
+            (League.region_id == region_id),
+            (League.season_id == season_id),
+            (League.queue_id == QueueId.LotV_1v1.value),
+        )
+        .group_by(LadderMember.profile_id)
+        .subquery()
+    )
+
+
+def load_mmr_snapshot(session, region_id, season_id, snapshot):
+    latest = (
+        session.query(
+            CharacterMMR.character_id,
+            cast(CharacterMMR.race, String).label("race"),
+            CharacterMMR.mmr,
+            CharacterMMR.date,
+        )
+        .join(Character, Character.id == CharacterMMR.character_id)
+        .join(Profile, Profile.id == Character.profile_id)
+        .filter((Profile.region_id == region_id), (CharacterMMR.date <= snapshot))
+        .distinct(CharacterMMR.character_id, CharacterMMR.race)
+        .order_by(CharacterMMR.character_id, CharacterMMR.race, CharacterMMR.date.desc())
+        .subquery()
+    )
+    leagues = league_by_profile_subquery(session, region_id, season_id)
+    rows = query(
+        session,
+        params=[latest.c.mmr, latest.c.race, leagues.c.league_id, latest.c.date],
+        joins=[
+            (Character, Character.id == latest.c.character_id),
+            (leagues, leagues.c.profile_id == Character.profile_id),
+        ],
+    )
+
+    result = MMRSnapshot(region_id=region_id, season_id=season_id, snapshot=snapshot)
+    if not rows:
+        return result
+
+    mmr, race, league, date = zip(*rows)
+    result.mmr = np.asarray(mmr, dtype=np.int32)
+    result.race = encode(race, RACES)
+    result.league = np.asarray(league, dtype=np.int8)
+    result.date = np.asarray(date, dtype=np.int64)
+    return result
+
+
+def load_mmr_history(session, region_id, season_id, snapshot, lookback):
+    """Every MMR observation for the season's 1v1 players within lookback seconds of snapshot"""
+    leagues = league_by_profile_subquery(session, region_id, season_id)
+    rows = query(
+        session,
+        params=[CharacterMMR.mmr, leagues.c.league_id, CharacterMMR.date],
+        joins=[
+            (Character, Character.id == CharacterMMR.character_id),
+            (leagues, leagues.c.profile_id == Character.profile_id),
+        ],
+        filters=[(CharacterMMR.date <= snapshot), (CharacterMMR.date > snapshot - lookback)],
+    )
+    if not rows:
+        return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int8), np.empty(0, dtype=np.int64)
+
+    mmr, league, date = zip(*rows)
+    return np.asarray(mmr, dtype=np.int32), np.asarray(league, dtype=np.int8), np.asarray(date, dtype=np.int64)
+
+
+def mmr_histogram(mmr, bin_width=MMR_HISTOGRAM_BIN_WIDTH):
+    if not len(mmr):
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int32)
+
+    low = mmr.min() - mmr.min() % bin_width
+    high = mmr.max() - mmr.max() % bin_width + bin_width
+    return np.histogram(mmr, bins=np.arange(low, high + 1, bin_width))
+
+
+def mmr_percentiles(mmr, percentiles=MMR_PERCENTILES):
+    if not len(mmr):
+        return {percentile: None for percentile in percentiles}
+
+    return dict(zip(percentiles, np.percentile(mmr, percentiles).round().astype(int).tolist()))
+
+
+def race_share_by_league(race, league):
+    """Rows are leagues, columns are races. Each row sums to 1 (or 0 for an empty league)"""
+    counts = np.bincount(league.astype(np.int64) * len(RACES) + race, minlength=len(LEAGUES) * len(RACES)).reshape(
+        len(LEAGUES), len(RACES)
+    )
+    totals = counts.sum(axis=1, keepdims=True)
+    return np.divide(counts, totals, out=np.zeros(counts.shape), where=totals > 0)
+
+
+def grouped_percentile(values, groups, group_count, percentile):
+    """Percentile of values within each group id in [0, group_count). Empty groups are NaN"""
+    result = np.full(group_count, np.nan)
+    if not len(values):
+        return result
+
+    order = np.lexsort((values, groups))
+    values, groups = values[order], groups[order]
+    starts = np.searchsorted(groups, np.arange(group_count), side="left")
+    ends = np.searchsorted(groups, np.arange(group_count), side="right")
+    sizes = ends - starts
+    present = sizes > 0
+
+    # Linear interpolation between closest ranks, same as np.percentile's default
+    rank = (sizes[present] - 1) * percentile / 100
+    lower = np.floor(rank).astype(np.int64)
+    upper = np.ceil(rank).astype(np.int64)
+    lower_values = values[starts[present] + lower]
+    upper_values = values[starts[present] + upper]
+    result[present] = lower_values + (upper_values - lower_values) * (rank - lower)
+    return result
+
+
+def league_cutoffs(mmr, league, percentile=LEAGUE_CUTOFF_PERCENTILE):
+    return grouped_percentile(mmr, league.astype(np.int64), len(LEAGUES), percentile)
+
+
+def cutoff_drift(mmr, league, date, bucket=ANALYTICS_DRIFT_BUCKET, percentile=LEAGUE_CUTOFF_PERCENTILE):
+    """League cutoffs per time bucket. Returns (buckets, cutoffs[bucket, league])"""
+    if not len(mmr):
+        return np.empty(0, dtype=np.int64), np.empty((0, len(LEAGUES)))
+
+    buckets, bucket_index = np.unique(date - date % bucket, return_inverse=True)
+    groups = bucket_index.astype(np.int64) * len(LEAGUES) + league
+    cutoffs = grouped_percentile(mmr, groups, len(buckets) * len(LEAGUES), percentile)
+    return buckets, cutoffs.reshape(len(buckets), len(LEAGUES))
+
+
+def get_mmr_distribution(region_id, season_id=None, snapshot=None, lookback=ANALYTICS_DRIFT_BUCKET * 30):
+    snapshot = snapshot_epoch(snapshot)
+    with session_scope() as session:
+        if season_id is None:
+            season_id = current_season_id(session, region_id)
+
+        key = (region_id, season_id, snapshot)
+        cached = DistributionCache.get(key)
+        if cached:
+            return cached
+
+        latest = load_mmr_snapshot(session, region_id=region_id, season_id=season_id, snapshot=snapshot)
+        history_mmr, history_league, history_date = load_mmr_history(
+            session, region_id=region_id, season_id=season_id, snapshot=snapshot, lookback=lookback
+        )
+
+    histogram, bin_edges = mmr_histogram(latest.mmr)
+    buckets, drift = cutoff_drift(history_mmr, history_league, history_date)
+    distribution = MMRDistribution(
+        region_id=region_id,
+        season_id=season_id,
+        snapshot=snapshot,
+        count=len(latest),
+        histogram=histogram,
+        bin_edges=bin_edges,
+        percentiles=mmr_percentiles(latest.mmr),
+        race_share_by_league=race_share_by_league(latest.race, latest.league),
+        league_cutoffs=league_cutoffs(latest.mmr, latest.league),
+        cutoff_drift=drift,
+        cutoff_drift_buckets=buckets,
+    )
+    DistributionCache.set(key, distribution)
+    return distribution
+
+
+def log_mmr_distribution(**kwargs):
+    region_id = kwargs.get("region_id")
+    if not region_id:
+        logger.warning("Missing required param region_id")
+        return
+
+    distribution = get_mmr_distribution(region_id=region_id)
+    shares_logging = "Race share by league:\n"
+    for league, shares in zip(LeagueId, distribution.race_share_by_league):
+        shares_logging += f"\t{league.name}: " + ", ".join(f"{race}={share:.1%}" for race, share in zip(RACES, shares))
+        shares_logging += "\n"
+
+    cutoffs = ", ".join(
+        f"{league.name}={'-' if np.isnan(cutoff) else int(cutoff)}"
+        for league, cutoff in zip(LeagueId, distribution.league_cutoffs)
+    )
+    logger.info(
+        "\n"
+        f"MMR distribution for region_id={region_id}, season_id={distribution.season_id}: \n"
+        f"Characters: {distribution.count} \n"
+        f"Percentiles: {distribution.percentiles} \n"
+        f"League cutoffs: {cutoffs} \n"
+        f"{shares_logging}"
+    )
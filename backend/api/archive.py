@@ -0,0 +1,204 @@
+"""
+Append-only archive of raw API responses, so data can be reprocessed after a fix without
+spending quota again. Responses are JSON lines {"url", "fetched", "body"} in zstd
+compressed segments written by a single thread off the request path:
+
+    ARCHIVE_PATH/<first fetch ms>-<pid>.jsonl.zst.partial   open segment
+    ARCHIVE_PATH/<first fetch ms>-<pid>.jsonl.zst           closed segment, never written again
+
+ReplaySource reads segments back and serves their responses to BlizzardApi.get in replay
+mode.
+"""
+
+import atexit
+import io
+import json
+import os
+import queue
+import time
+from collections import defaultdict, deque
+from threading import Lock, Thread
+
+from backend.static import (
+    ARCHIVE_FLUSH_RECORDS,
+    ARCHIVE_PATH,
+    ARCHIVE_QUEUE_SIZE,
+    ARCHIVE_SEGMENT_BYTES,
+    ARCHIVE_SEGMENT_SECONDS,
+    ARCHIVE_ZSTD_LEVEL,
+)
+from backend.utils.log import get_logger
+from backend.utils.metrics import Metrics
+
+logger = get_logger(__name__)
+
+SEGMENT_SUFFIX = ".jsonl.zst"
+PARTIAL_SUFFIX = ".partial"
+
+
+class Segment:
+    def __init__(self, path, started):
+        import zstandard
+
+        self.path = path
+        self.started = started
+        self.bytes = 0
+        self.records = 0
+        self.file = open(f"{path}{PARTIAL_SUFFIX}", "wb")
+        self.writer = zstandard.ZstdCompressor(level=ARCHIVE_ZSTD_LEVEL).stream_writer(self.file)
+
+    def write(self, line):
+        self.writer.write(line)
+        self.bytes += len(line)
+        self.records += 1
+        if self.records % ARCHIVE_FLUSH_RECORDS == 0:
+            import zstandard
+
+            self.writer.flush(zstandard.FLUSH_FRAME)
+
+    def full(self):
+        return self.bytes >= ARCHIVE_SEGMENT_BYTES or time.time() - self.started >= ARCHIVE_SEGMENT_SECONDS
+
+    def close(self):
+        self.writer.close()
+        os.replace(f"{self.path}{PARTIAL_SUFFIX}", self.path)
+
+
+class ResponseArchive:
+    """Process wide archive writer, started on the first response"""
+
+    lock = Lock()
+    records = None
+    thread = None
+
+    @classmethod
+    def append(cls, url, body, fetched=None):
+        if cls.thread is None:
+            cls.start()
+
+        try:
+            cls.records.put_nowait((url, fetched or time.time(), body))
+        except queue.Full:
+            Metrics.increment("archive.dropped")
+
+    @classmethod
+    def start(cls):
+        with cls.lock:
+            if cls.thread is None:
+                cls.records = queue.Queue(maxsize=ARCHIVE_QUEUE_SIZE)
+                cls.thread = Thread(target=cls.write, name="archive", daemon=True)
+                cls.thread.start()
+                atexit.register(cls.stop)
+
+    @classmethod
+    def stop(cls):
+        """Write queued responses and close the open segment"""
+        with cls.lock:
+            if cls.thread is not None:
+                cls.records.put(None)
+                cls.thread.join()
+                cls.thread = None
+
+    @classmethod
+    def write(cls):
+        ARCHIVE_PATH.mkdir(parents=True, exist_ok=True)
+        segment = None
+        while True:
+            record = cls.records.get()
+            if record is None:
+                break
+
+            url, fetched, body = record
+            if segment is None or segment.full():
+                if segment is not None:
+                    segment.close()
+                segment = Segment(ARCHIVE_PATH / f"{int(fetched * 1000)}-{os.getpid()}{SEGMENT_SUFFIX}", time.time())
+
+            line = json.dumps({"url": url, "fetched": round(fetched, 3), "body": body}, separators=(",", ":"))
+            try:
+                segment.write(f"{line}\n".encode())
+            except Exception:
+                logger.exception(f"Failed to archive response of {url=}...")
+                continue
+            Metrics.increment("archive.responses")
+
+        if segment is not None:
+            segment.close()
+
+
+def segment_paths(start=None, end=None):
+    """Segments, closed or open, that may hold responses fetched in [start, end], oldest first"""
+    by_process = defaultdict(list)
+    for path in ARCHIVE_PATH.glob(f"*{SEGMENT_SUFFIX}*"):
+        first_fetch, pid = path.name.split(SEGMENT_SUFFIX)[0].split("-")
+        first_fetch = int(first_fetch) / 1000
+        if end is not None and first_fetch > end:
+            continue
+        by_process[pid].append((first_fetch, path))
+
+    # Processes write segments concurrently, but a process's segment ends before its next one
+    # starts, so only each process's last segment before start is needed
+    paths = []
+    for process_paths in by_process.values():
+        process_paths.sort()
+        if start is not None:
+            first = max((i for i, (first_fetch, _) in enumerate(process_paths) if first_fetch <= start), default=0)
+            process_paths = process_paths[first:]
+        paths.extend(process_paths)
+    return [path for _, path in sorted(paths)]
+
+
+def read_segment(path):
+    """Records of a segment. An open or truncated segment yields what could be read."""
+    import zstandard
+
+    with open(path, "rb") as f:
+        reader = zstandard.ZstdDecompressor().stream_reader(f, read_across_frames=True)
+        try:
+            for line in io.TextIOWrapper(reader, encoding="utf-8"):
+                if line.endswith("\n"):
+                    yield json.loads(line)
+        except zstandard.ZstdError as e:
+            logger.warning(f"Stopped reading truncated segment {path}: {e!r}")
+
+
+def read_archive(start=None, end=None):
+    """Records fetched in [start, end], in fetch order within a process"""
+    for path in segment_paths(start=start, end=end):
+        for record in read_segment(path):
+            if (start is None or record["fetched"] >= start) and (end is None or record["fetched"] <= end):
+                yield record
+
+
+class ReplaySource:
+    """
+    Archived responses fetched in [start, end] by URL. Each get of a URL serves its next
+    response in fetch order, so every pass of a job over the same URLs replays the next
+    snapshot.
+    """
+
+    def __init__(self, start=None, end=None):
+        self.responses = defaultdict(deque)
+        self.lock = Lock()
+        self.served = 0
+        # Segments of concurrent processes overlap, order each url's responses by fetch time
+        records = defaultdict(list)
+        for record in read_archive(start=start, end=end):
+            records[record["url"]].append((record["fetched"], record["body"]))
+        for url, url_records in records.items():
+            url_records.sort(key=lambda record: record[0])
+            self.responses[url] = deque(body for _, body in url_records)
+        logger.info(f"Loaded {self.remaining} archived responses of {len(self.responses)} urls for replay.")
+
+    @property
+    def remaining(self):
+        return sum(len(bodies) for bodies in self.responses.values())
+
+    def get(self, url):
+        """Raw body of the next response for url, or None when there is none left"""
+        with self.lock:
+            bodies = self.responses.get(url)
+            if not bodies:
+                return None
+            self.served += 1
+            return bodies.popleft()
@@ -3,29 +3,120 @@ https://develop.battle.net/documentation/starcraft-2/game-data-apis
 https://develop.battle.net/documentation/starcraft-2/community-apis
 """
 
+import json
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+from contextvars import copy_context
 from datetime import datetime, timedelta
-from functools import wraps
 from threading import Lock
 
 import requests
-from tenacity import RetryError, retry, stop_after_attempt, wait_fixed
+from tenacity import (
+    retry,
+    retry_if_exception_type,
+    stop_after_attempt,
+    wait_random_exponential,
+)
 
-from backend.db.db import ENGINE, create, query, session_scope
+from backend.api.archive import ResponseArchive
+from backend.api.circuit import CircuitBreaker, CircuitState
+from backend.api.latency import LatencyState
+from backend.api.oauth import TokenManager
+from backend.api.singleflight import SingleFlight
+from backend.db.db import create, query, session_scope
 from backend.db.model import Request
-from backend.enums import RegionId
+from backend.enums import RegionId, RequestSource
 from backend.static import (
+    ARCHIVE_ENABLED,
+    BACKFILL_REQUEST_SHARE,
     BLIZZARD_API_BASE,
-    BLIZZARD_CLIENT_ID,
-    BLIZZARD_CLIENT_SECRET,
-    BLIZZARD_OATH_BASE,
+    REQUEST_BACKOFF_MAX,
+    REQUEST_BACKOFF_MULTIPLIER,
+    REQUEST_HEDGE_ENDPOINTS,
     REQUEST_MAX_PER_DAY,
     REQUEST_MAX_PER_SECOND,
+    REQUEST_RETRY_ATTEMPTS,
+    REQUEST_TIMEOUT,
+    REQUEST_TIMEOUTS,
 )
+from backend.utils.concurrency import thread_pool_max_workers
 from backend.utils.datetime import current_epoch_time, datetime_to_epoch
+from backend.utils.deadline import expired, remaining
 from backend.utils.log import get_logger
+from backend.utils.metrics import Metrics
 
 logger = get_logger(__name__)
+request_logger = get_logger(f"{__name__}.requests")  # Per request messages, sampled
+
+
+class ApiError(Exception):
+    def __init__(self, message, url=None, status_code=None):
+        super().__init__(message)
+        self.url = url
+        self.status_code = status_code
+
+
+class ApiNotFoundError(ApiError):
+    pass
+
+
+class ApiUnavailableError(ApiError):
+    """The API could not be reached. The request may succeed later and should be deferred."""
+
+
+class CircuitOpenError(ApiUnavailableError):
+    """The region's circuit is open, the request was not sent"""
+
+
+class TransientApiError(ApiError):
+    """A single attempt failed in a way worth retrying"""
+
+
+class DeadlineExceededError(ApiUnavailableError):
+    """The job's deadline passed. The next run of the job picks the work up again."""
+
+
+def stop_when_retry_budget_exhausted(retry_state):
+    url = retry_state.kwargs.get("url")
+    if expired():
+        return True
+
+    if CircuitState.breaker(url).retry_budget.withdraw():
+        return False
+
+    logger.warning(f"Retry budget exhausted, not retrying {url=}")
+    return True
+
+
+_backoff = wait_random_exponential(multiplier=REQUEST_BACKOFF_MULTIPLIER, max=REQUEST_BACKOFF_MAX)
+
+
+def wait_within_deadline(retry_state):
+    """Full jitter backoff, never sleeping past the deadline"""
+    seconds = _backoff(retry_state)
+    left = remaining()
+    return seconds if left is None else max(0, min(seconds, left))
+
+
+def request_timeout(endpoint):
+    """(connect, read) timeout of endpoint, shortened to the time left before the deadline"""
+    connect, read = REQUEST_TIMEOUTS.get(endpoint, REQUEST_TIMEOUT)
+    left = remaining()
+    if left is None:
+        return connect, read
+    return min(connect, left), min(read, left)
+
+
+_hedge_executor = None
+_hedge_executor_lock = Lock()
+
+
+def hedge_executor():
+    global _hedge_executor
+    with _hedge_executor_lock:
+        if _hedge_executor is None:
+            _hedge_executor = ThreadPoolExecutor(max_workers=thread_pool_max_workers() * 2, thread_name_prefix="hedge")
+        return _hedge_executor
 
 
 class APIState:
@@ -33,114 +124,255 @@ class APIState:
     lock = Lock()
 
     @classmethod
-    def get_request_count(cls, timestamp):
-        with session_scope(engine=ENGINE) as session:
-            count = query(session, params={Request}, filters=[(Request.timestamp >= timestamp)], count=True)
+    def get_request_count(cls, timestamp, source=None):
+        filters = [(Request.timestamp >= timestamp)]
+        if source is not None:
+            filters.append(Request.source == source)
+
+        with session_scope() as session:
+            count = query(session, params={Request}, filters=filters, count=True)
             return count
 
     @classmethod
-    def get_second_request_count(cls):
+    def get_second_request_count(cls, source=None):
         lookback = datetime_to_epoch(datetime.now() - timedelta(0, 1))
-        return APIState.get_request_count(lookback)
+        return APIState.get_request_count(lookback, source=source)
 
     @classmethod
-    def get_day_request_count(cls):
+    def get_day_request_count(cls, source=None):
         lookback = datetime_to_epoch(datetime.now() - timedelta(0, 86400))
-        return APIState.get_request_count(lookback)
+        return APIState.get_request_count(lookback, source=source)
 
     @classmethod
-    def exceeded_max_requests(cls):
+    def exceeded_max_requests(cls, source=RequestSource.LIVE.value):
+        """
+        Live requests may use the whole rate limit. Backfill requests are further capped at
+        BACKFILL_REQUEST_SHARE of it so a long backfill never starves live ETL.
+        """
         second_request_count = APIState.get_second_request_count()
         day_request_count = APIState.get_day_request_count()
         exceeded = second_request_count >= REQUEST_MAX_PER_SECOND or day_request_count >= REQUEST_MAX_PER_DAY
         if exceeded:
-            logger.info(f"Exceeded max API requests. {second_request_count=}, {day_request_count=}")
+            request_logger.info(f"Exceeded max API requests. {second_request_count=}, {day_request_count=}")
+            return exceeded
+
+        if source == RequestSource.BACKFILL.value:
+            second_request_count = APIState.get_second_request_count(source=source)
+            day_request_count = APIState.get_day_request_count(source=source)
+            exceeded = (
+                second_request_count >= REQUEST_MAX_PER_SECOND * BACKFILL_REQUEST_SHARE
+                or day_request_count >= REQUEST_MAX_PER_DAY * BACKFILL_REQUEST_SHARE
+            )
+
         return exceeded
 
 
 class BlizzardApi:
-    oauth_token = None
-    oauth_token_expiration = None
-
-    def _refesh_battlenet_oauth_token(func):
-        @wraps(func)
-        def _wrapper(*args, **kwargs):
-            try:
-                if not BlizzardApi.oauth_token or BlizzardApi.token_expired():
-                    endpoint = BLIZZARD_OATH_BASE + "/token"
-                    params = {"grant_type": "client_credentials"}
-                    res = requests.post(
-                        url=endpoint, params=params, auth=(BLIZZARD_CLIENT_ID, BLIZZARD_CLIENT_SECRET)
-                    ).json()
-                    BlizzardApi.oauth_token = res["access_token"]
-                    BlizzardApi.oauth_token_expiration = datetime.now() + timedelta(0, int(res["expires_in"]))
-            except Exception:
-                logger.exception("Exception thrown while POSTing for oauth token...")
-
-            return func(*args, **kwargs)
-
-        return _wrapper
-
-    def token_expired():
-        if not BlizzardApi.oauth_token_expiration:
-            return True
-
-        return datetime.now() > BlizzardApi.oauth_token_expiration
+    replay = None  # ReplaySource serving archived responses instead of the API
+
+    def __init__(self, source=RequestSource.LIVE.value):
+        self.source = source
 
     def headers():
-        if not BlizzardApi.oauth_token:
+        token = TokenManager.token()
+        if not token:
             return {}
 
-        return {"Authorization": f"Bearer {BlizzardApi.oauth_token}"}
+        return {"Authorization": f"Bearer {token}"}
+
+    def record_request(self, url):
+        with session_scope() as session:
+            create(session=session, instance=Request(url=url, timestamp=current_epoch_time(), source=self.source))
 
     def block_request(self, url, interval=0.25):
         blocked = True
         while blocked:
+            if expired():
+                raise DeadlineExceededError("Deadline passed waiting for the rate limit", url=url)
+
             with APIState.lock:
-                blocked = APIState.exceeded_max_requests()
+                blocked = APIState.exceeded_max_requests(source=self.source)
 
             if blocked:
                 time.sleep(interval)
 
-        with session_scope(engine=ENGINE) as session:
-            create(session=session, instance=Request(url=url, timestamp=current_epoch_time()))
+        self.record_request(url)
 
-    @_refesh_battlenet_oauth_token
-    @retry(
-        stop=stop_after_attempt(2),
-        wait=wait_fixed(0.25),
-    )
-    def _get(self, url):
-        logger.info(f"Sending GET request to {url=}")
-        res = requests.get(url, headers=BlizzardApi.headers())
+    def try_request(self, url):
+        """Count a request against the rate limit if it allows one now, without waiting"""
+        with APIState.lock:
+            if APIState.exceeded_max_requests(source=self.source):
+                return False
+
+        self.record_request(url)
+        return True
+
+    def request(self, url, endpoint):
+        """A single GET, with nothing recorded about it. Returns (response or exception, seconds taken)."""
+        Metrics.increment("api.attempts")
+        request_logger.info(f"Sending GET request to {url=}")
+        start = time.perf_counter()
+        try:
+            res = requests.get(url, headers=BlizzardApi.headers(), timeout=request_timeout(endpoint))
+        except requests.RequestException as e:
+            return e, time.perf_counter() - start
+        return res, time.perf_counter() - start
+
+    def settle(self, url, endpoint, breaker, outcome, elapsed):
+        """Record the outcome of a GET on the breaker, latencies and archive, then return its JSON body or raise"""
+        if isinstance(outcome, requests.RequestException):
+            breaker.record_failure()
+            raise TransientApiError(f"{outcome!r}", url=url) from outcome
+
+        res = outcome
         if res.ok:
+            breaker.record_success()
+            LatencyState.record(endpoint, elapsed)
+            if ARCHIVE_ENABLED:
+                ResponseArchive.append(url, res.text)
             return res.json()
 
-        if res.status_code == 503:
-            logger.error(f"Service Unavailable. {res.status_code=}, {url=}. Will retry...")
-            raise Exception
+        if res.status_code == 404:
+            breaker.record_success()
+            raise ApiNotFoundError("Not found", url=url, status_code=res.status_code)
 
         if res.status_code == 429:
             logger.warning(f"Too May Requests. {res.status_code=}. Will retry...")
-            raise Exception
+            raise TransientApiError("Too Many Requests", url=url, status_code=res.status_code)
 
-        if res.status_code == 404:
-            logger.error(f"Not found. {res.status_code=}, {url=}")
-            return {}
+        if res.status_code >= 500:
+            breaker.record_failure()
+            logger.error(f"Service Unavailable. {res.status_code=}, {url=}. Will retry...")
+            raise TransientApiError(res.reason, url=url, status_code=res.status_code)
 
-        if res.status_code >= 400:
-            logger.error(f"Failed GET. {res.status_code=}, {res.reason=}, {url=}. Will retry...")
-            raise Exception
+        raise ApiError(res.reason, url=url, status_code=res.status_code)
 
-        return {}
+    def send(self, url, endpoint, breaker):
+        """A single GET attempt"""
+        return self.settle(url, endpoint, breaker, *self.request(url, endpoint))
 
-    def get(self, url):
+    def send_hedged(self, url, endpoint, breaker):
+        """
+        Send the request and, if it is still outstanding after the endpoint's recent p95
+        latency, a duplicate. The first success wins. Only the response returned, or the
+        first failure when both fail, is recorded on the breaker and archived, the other
+        one is ignored. A hedge needs the host's hedge budget and room in the rate limit,
+        it never waits.
+        """
+        delay = LatencyState.hedge_delay(endpoint)
+        if delay is None:
+            return self.send(url, endpoint, breaker)
+
+        executor = hedge_executor()
+        primary = executor.submit(copy_context().run, self.request, url, endpoint)
+        done, _ = wait([primary], timeout=delay)
+        if done or not breaker.hedge_budget.withdraw():
+            return self.settle(url, endpoint, breaker, *primary.result())
+
+        if not self.try_request(url):
+            breaker.hedge_budget.refund()
+            return self.settle(url, endpoint, breaker, *primary.result())
+
+        Metrics.increment("api.hedged")
+        hedge = executor.submit(copy_context().run, self.request, url, endpoint)
+        failed = None
+        for future in as_completed([primary, hedge]):
+            outcome, elapsed = future.result()
+            if isinstance(outcome, requests.RequestException) or not outcome.ok:
+                failed = failed or (outcome, elapsed)
+                continue
+
+            loser = primary if future is hedge else hedge
+            loser.cancel()
+            if future is hedge:
+                Metrics.increment("api.hedge_wins")
+            return self.settle(url, endpoint, breaker, outcome, elapsed)
+
+        return self.settle(url, endpoint, breaker, *failed)
+
+    @retry(
+        retry=retry_if_exception_type(TransientApiError),
+        stop=stop_after_attempt(REQUEST_RETRY_ATTEMPTS) | stop_when_retry_budget_exhausted,
+        wait=wait_within_deadline,
+        reraise=True,
+    )
+    def _get(self, url, endpoint=None):
+        # Stop retrying as soon as another request has tripped the circuit
+        breaker = CircuitState.breaker(url)
+        if breaker.is_open:
+            raise ApiUnavailableError(f"Circuit open for {breaker.host}", url=url)
+
+        if expired():
+            raise DeadlineExceededError("Deadline passed", url=url)
+
+        # Every attempt, retries included, is counted against the rate limit
+        self.block_request(url=url)
+        if endpoint in REQUEST_HEDGE_ENDPOINTS:
+            return self.send_hedged(url, endpoint, breaker)
+        return self.send(url, endpoint, breaker)
+
+    def get(self, url, endpoint=None):
+        """
+        JSON body of a GET. Raises ApiUnavailableError when the region's circuit is open,
+        retries are exhausted or the job's deadline has passed so callers can defer the
+        work, ApiNotFoundError for 404s and ApiError for other client errors.
+
+        Concurrent GETs of the same url share one request and its result.
+        """
+        if BlizzardApi.replay is not None:
+            return self.get_replayed(url)
+
+        return SingleFlight.do(
+            url, lambda: self.fetch(url, endpoint), timeout=remaining(), retry_on=(DeadlineExceededError,)
+        )
+
+    def fetch(self, url, endpoint=None):
+        Metrics.increment("api.requests")
+        breaker = CircuitState.breaker(url)
+        permit = breaker.allow()
+        if not permit:
+            Metrics.increment("api.unavailable")
+            raise CircuitOpenError(f"Circuit open for {breaker.host}", url=url)
+
+        try:
+            return self.fetch_allowed(url, endpoint, breaker)
+        except Exception as e:
+            # 429s, deadlines and client errors record nothing on the breaker themselves
+            if permit == CircuitBreaker.PROBE:
+                breaker.end_probe(failed=isinstance(e, ApiUnavailableError))
+            raise
+
+    def fetch_allowed(self, url, endpoint, breaker):
+        breaker.retry_budget.deposit()
+        breaker.hedge_budget.deposit()
         try:
-            self.block_request(url=url)
-            return self._get(url=url)
-        except RetryError:
+            return self._get(url=url, endpoint=endpoint)
+        except TransientApiError as e:
+            if expired():
+                Metrics.increment("api.deadline")
+                raise DeadlineExceededError(str(e), url=url, status_code=e.status_code) from e
             logger.error(f"Exceeded retries fetching {url=}")
-            return {}
+            Metrics.increment("api.unavailable")
+            raise ApiUnavailableError(str(e), url=url, status_code=e.status_code) from e
+        except DeadlineExceededError:
+            Metrics.increment("api.deadline")
+            raise
+        except ApiUnavailableError:
+            Metrics.increment("api.unavailable")
+            raise
+        except ApiError:
+            Metrics.increment("api.failed")
+            raise
+
+    def get_replayed(self, url):
+        """The next archived response of url, without touching the API or the rate limit"""
+        body = BlizzardApi.replay.get(url)
+        if body is None:
+            Metrics.increment("api.not_archived")
+            raise ApiNotFoundError("Not archived", url=url)
+
+        Metrics.increment("api.replayed")
+        return json.loads(body)
 
     # Game Data API
 
@@ -150,7 +382,8 @@ class BlizzardApi:
         """
         return self.get(
             url=BLIZZARD_API_BASE.format(region=RegionId(region_id).name.lower())
-            + f"/data/sc2/league/{season_id}/{queue_id}/{team_type}/{league_id}"
+            + f"/data/sc2/league/{season_id}/{queue_id}/{team_type}/{league_id}",
+            endpoint="league",
         )
 
     # Profile API
@@ -161,7 +394,8 @@ class BlizzardApi:
         """
         return self.get(
             url=BLIZZARD_API_BASE.format(region=RegionId(region_id).name.lower())
-            + f"/sc2/profile/{region_id}/{realm_id}/{profile_id}/ladder/{ladder_id}"
+            + f"/sc2/profile/{region_id}/{realm_id}/{profile_id}/ladder/{ladder_id}",
+            endpoint="profile_ladder",
         )
 
     # Ladder API
@@ -171,7 +405,8 @@ class BlizzardApi:
         /sc2/ladder/season/:regionId
         """
         return self.get(
-            url=BLIZZARD_API_BASE.format(region=RegionId(region_id).name.lower()) + f"/sc2/ladder/season/{region_id}"
+            url=BLIZZARD_API_BASE.format(region=RegionId(region_id).name.lower()) + f"/sc2/ladder/season/{region_id}",
+            endpoint="ladder_season",
         )
 
     # Legacy API
@@ -182,7 +417,8 @@ class BlizzardApi:
         """
         return self.get(
             url=BLIZZARD_API_BASE.format(region=RegionId(region_id).name.lower())
-            + f"/sc2/legacy/ladder/{region_id}/{ladder_id}"
+            + f"/sc2/legacy/ladder/{region_id}/{ladder_id}",
+            endpoint="legacy_ladder",
         )
 
     def get_legacy_match_history(self, region_id, realm_id, profile_id):
@@ -191,5 +427,6 @@ class BlizzardApi:
         """
         return self.get(
             url=BLIZZARD_API_BASE.format(region=RegionId(region_id).name.lower())
-            + f"/sc2/legacy/profile/{region_id}/{realm_id}/{profile_id}/matches"
+            + f"/sc2/legacy/profile/{region_id}/{realm_id}/{profile_id}/matches",
+            endpoint="legacy_match_history",
         )
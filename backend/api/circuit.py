@@ -0,0 +1,156 @@
+"""
+Per region host circuit breakers and retry budgets for the Blizzard API
+"""
+
+import time
+from threading import Lock
+from urllib.parse import urlparse
+
+from backend.static import (
+    CIRCUIT_FAILURE_THRESHOLD,
+    CIRCUIT_RESET_TIMEOUT,
+    REQUEST_HEDGE_BUDGET_INITIAL,
+    REQUEST_HEDGE_BUDGET_MAX,
+    REQUEST_HEDGE_BUDGET_RATIO,
+    REQUEST_RETRY_BUDGET_INITIAL,
+    REQUEST_RETRY_BUDGET_MAX,
+    REQUEST_RETRY_BUDGET_RATIO,
+)
+from backend.utils.log import get_logger
+
+logger = get_logger(__name__)
+
+
+class RetryBudget:
+    """
+    Retries are capped at a share of the requests made, so a failing host cannot multiply
+    traffic by the retry count. Every request deposits ratio of a retry and every retry
+    withdraws one. Hedged requests are budgeted the same way.
+    """
+
+    def __init__(
+        self, ratio=REQUEST_RETRY_BUDGET_RATIO, initial=REQUEST_RETRY_BUDGET_INITIAL, maximum=REQUEST_RETRY_BUDGET_MAX
+    ):
+        self.ratio = ratio
+        self.maximum = maximum
+        self.tokens = float(initial)
+        self.lock = Lock()
+
+    def deposit(self):
+        with self.lock:
+            self.tokens = min(self.maximum, self.tokens + self.ratio)
+
+    def withdraw(self):
+        with self.lock:
+            if self.tokens < 1:
+                return False
+
+            self.tokens -= 1
+            return True
+
+    def refund(self):
+        """Return a withdrawal that was not spent"""
+        with self.lock:
+            self.tokens = min(self.maximum, self.tokens + 1)
+
+
+class CircuitBreaker:
+    """
+    Closed: requests flow and consecutive failures are counted. Open: requests fail fast
+    until reset_timeout has passed. Half open: a single probe request is let through, its
+    result closes or re-opens the circuit. The probe's caller must settle it with end_probe
+    however it ends, or no other request is let through.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+    PROBE = "probe"  # Returned by allow to the caller holding the half open probe
+
+    def __init__(self, host, failure_threshold=CIRCUIT_FAILURE_THRESHOLD, reset_timeout=CIRCUIT_RESET_TIMEOUT):
+        self.host = host
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CircuitBreaker.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.retry_budget = RetryBudget()
+        self.hedge_budget = RetryBudget(
+            ratio=REQUEST_HEDGE_BUDGET_RATIO, initial=REQUEST_HEDGE_BUDGET_INITIAL, maximum=REQUEST_HEDGE_BUDGET_MAX
+        )
+        self.lock = Lock()
+
+    @property
+    def is_open(self):
+        return self.state == CircuitBreaker.OPEN
+
+    def allow(self):
+        with self.lock:
+            if self.state == CircuitBreaker.CLOSED:
+                return True
+
+            if self.state == CircuitBreaker.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                logger.info(f"Circuit for {self.host} is half open. Sending probe request...")
+                self.state = CircuitBreaker.HALF_OPEN
+                self.probing = False
+
+            if self.state == CircuitBreaker.HALF_OPEN and not self.probing:
+                self.probing = True
+                return CircuitBreaker.PROBE
+
+            return False
+
+    def record_success(self):
+        with self.lock:
+            if self.state != CircuitBreaker.CLOSED:
+                logger.info(f"Circuit for {self.host} closed.")
+            self.state = CircuitBreaker.CLOSED
+            self.failures = 0
+            self.probing = False
+
+    def end_probe(self, failed):
+        """
+        Release the probe if it ended without a success or failure being recorded. A failed
+        probe re-opens the circuit, otherwise the next request becomes the probe.
+        """
+        with self.lock:
+            if self.state != CircuitBreaker.HALF_OPEN or not self.probing:
+                return
+
+            self.probing = False
+            if failed:
+                logger.warning(f"Circuit for {self.host} re-opened, probe request failed.")
+                self.state = CircuitBreaker.OPEN
+                self.opened_at = time.monotonic()
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == CircuitBreaker.HALF_OPEN or (
+                self.state == CircuitBreaker.CLOSED and self.failures >= self.failure_threshold
+            ):
+                logger.warning(f"Circuit for {self.host} opened after {self.failures} consecutive failures.")
+                self.state = CircuitBreaker.OPEN
+                self.opened_at = time.monotonic()
+                self.probing = False
+
+
+class CircuitState:
+    """One breaker per API host, i.e. per region"""
+
+    lock = Lock()
+    breakers = {}
+
+    @classmethod
+    def breaker(cls, url):
+        host = urlparse(url).netloc
+        with cls.lock:
+            if host not in cls.breakers:
+                cls.breakers[host] = CircuitBreaker(host)
+            return cls.breakers[host]
+
+    @classmethod
+    def get(cls):
+        with cls.lock:
+            return dict(cls.breakers)
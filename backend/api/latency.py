@@ -0,0 +1,53 @@
+"""
+Recent latencies per API endpoint, used to decide when a slow request is hedged
+"""
+
+from collections import deque
+from threading import Lock
+
+from backend.static import (
+    REQUEST_HEDGE_MIN_DELAY,
+    REQUEST_HEDGE_MIN_SAMPLES,
+    REQUEST_HEDGE_QUANTILE,
+    REQUEST_LATENCY_WINDOW,
+)
+
+
+class LatencyState:
+
+    lock = Lock()
+    latencies = {}
+
+    @classmethod
+    def record(cls, endpoint, seconds):
+        with cls.lock:
+            if endpoint not in cls.latencies:
+                cls.latencies[endpoint] = deque(maxlen=REQUEST_LATENCY_WINDOW)
+            cls.latencies[endpoint].append(seconds)
+
+    @classmethod
+    def quantile(cls, endpoint, q):
+        with cls.lock:
+            latencies = sorted(cls.latencies.get(endpoint, ()))
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+    @classmethod
+    def hedge_delay(cls, endpoint):
+        """Seconds to wait before hedging a request, None until enough latencies are known"""
+        with cls.lock:
+            samples = len(cls.latencies.get(endpoint, ()))
+        if samples < REQUEST_HEDGE_MIN_SAMPLES:
+            return None
+        return max(REQUEST_HEDGE_MIN_DELAY, cls.quantile(endpoint, REQUEST_HEDGE_QUANTILE))
+
+    @classmethod
+    def get(cls):
+        """p50 and p95 seconds per endpoint"""
+        with cls.lock:
+            endpoints = list(cls.latencies)
+        return {
+            endpoint: {"p50": cls.quantile(endpoint, 0.5), "p95": cls.quantile(endpoint, 0.95)}
+            for endpoint in endpoints
+        }
@@ -14,7 +14,7 @@ from backend.enums import Race
 class LadderCharacter(BaseModel):
     model_config = ConfigDict(strict=True)
 
-    profile_id: str = Field(validation_alias=AliasChoices("id"))
+    profile_id: int = Field(validation_alias=AliasChoices("id"))
     realm_id: int = Field(validation_alias=AliasChoices("realm"))
     region_id: int = Field(validation_alias=AliasChoices("region"))
     display_name: str = Field(validation_alias=AliasChoices("displayName"))
@@ -22,6 +22,11 @@ class LadderCharacter(BaseModel):
     clan_tag: str = Field(validation_alias=AliasChoices("clanTag"))
     profile_path: str = Field(validation_alias=AliasChoices("profilePath"))
 
+    @field_validator("profile_id", mode="before")
+    @classmethod
+    def convert_profile_id(cls, value: str) -> int:
+        return int(value)
+
 
 class LadderMember(BaseModel):
     model_config = ConfigDict(strict=True, use_enum_values=True)
@@ -45,6 +50,7 @@ class LegacyLadderResponse(BaseModel):
     model_config = ConfigDict(strict=True, arbitrary_types_allowed=True)
 
     ladder_id: Optional[uuid.UUID] = None
+    content_hash: Optional[str] = None
     ladder_members: Optional[List[LadderMember]] = Field(default=[], validation_alias=AliasChoices("ladderMembers"))
 
 
@@ -57,6 +63,11 @@ class Match(BaseModel):
     speed: str
     start_timestamp: int = Field(validation_alias=AliasChoices("date"))
 
+    @field_validator("decision", mode="before")
+    @classmethod
+    def convert(cls, value: str) -> str:
+        return value.strip().upper()
+
 
 class LegacyMatchHistoryResponse(BaseModel):
     model_config = ConfigDict(strict=True, arbitrary_types_allowed=True)
@@ -13,12 +13,17 @@ from backend.enums import Race
 class TeamMember(BaseModel):
     model_config = ConfigDict(strict=True)
 
-    profile_id: str = Field(validation_alias=AliasChoices("id"))
+    profile_id: int = Field(validation_alias=AliasChoices("id"))
     realm_id: int = Field(validation_alias=AliasChoices("realm"))
     region_id: int = Field(validation_alias=AliasChoices("region"))
     display_name: str = Field(validation_alias=AliasChoices("displayName"))
     race: Race = Field(default=None, validation_alias=AliasChoices("favoriteRace"))
 
+    @field_validator("profile_id", mode="before")
+    @classmethod
+    def convert_profile_id(cls, value: str) -> int:
+        return int(value)
+
     @field_validator("race", mode="before")
     @classmethod
     def convert(cls, value: str) -> Race:
@@ -0,0 +1,88 @@
+"""
+Blizzard API token shared by every thread and ETL process. A token is refreshed once,
+OAUTH_REFRESH_MARGIN ahead of its expiry: threads wait on a lock, and processes take a
+Postgres advisory lock and reuse a token another process stored meanwhile.
+"""
+
+from threading import Lock
+
+import requests
+from sqlalchemy import func, select
+
+from backend.db.db import session_scope
+from backend.db.model import OAuthToken
+from backend.static import (
+    BLIZZARD_CLIENT_ID,
+    BLIZZARD_CLIENT_SECRET,
+    BLIZZARD_OATH_BASE,
+    OAUTH_ADVISORY_LOCK,
+    OAUTH_REFRESH_MARGIN,
+    REQUEST_TIMEOUTS,
+)
+from backend.utils.datetime import current_epoch_time
+from backend.utils.log import get_logger
+from backend.utils.metrics import Metrics
+
+logger = get_logger(__name__)
+
+
+def fresh(expires_timestamp):
+    return expires_timestamp is not None and expires_timestamp - OAUTH_REFRESH_MARGIN > current_epoch_time()
+
+
+def request_token():
+    res = requests.post(
+        url=BLIZZARD_OATH_BASE + "/token",
+        params={"grant_type": "client_credentials"},
+        auth=(BLIZZARD_CLIENT_ID, BLIZZARD_CLIENT_SECRET),
+        timeout=REQUEST_TIMEOUTS["oauth"],
+    )
+    res.raise_for_status()
+    body = res.json()
+    Metrics.increment("oauth.requests")
+    return body["access_token"], current_epoch_time() + int(body["expires_in"])
+
+
+class TokenManager:
+
+    lock = Lock()
+    access_token = None
+    expires_timestamp = None
+
+    @classmethod
+    def token(cls):
+        """A valid token, or the last one known if it could not be refreshed"""
+        if fresh(cls.expires_timestamp):
+            return cls.access_token
+
+        with cls.lock:
+            if not fresh(cls.expires_timestamp):
+                try:
+                    cls.access_token, cls.expires_timestamp = cls.refresh()
+                except Exception:
+                    logger.exception("Exception thrown while refreshing oauth token...")
+
+            return cls.access_token
+
+    @classmethod
+    def refresh(cls):
+        client_id = BLIZZARD_CLIENT_ID or ""
+        with session_scope() as session:
+            # Held until commit, so other processes wait here and then find the new token
+            session.execute(select(func.pg_advisory_xact_lock(OAUTH_ADVISORY_LOCK)))
+            stored = session.get(OAuthToken, client_id)
+            if stored and fresh(stored.expires_timestamp):
+                Metrics.increment("oauth.shared")
+                return stored.access_token, stored.expires_timestamp
+
+            logger.info("Refreshing oauth token...")
+            access_token, expires_timestamp = request_token()
+            session.merge(
+                OAuthToken(
+                    client_id=client_id,
+                    access_token=access_token,
+                    expires_timestamp=expires_timestamp,
+                    updated_timestamp=current_epoch_time(),
+                )
+            )
+            return access_token, expires_timestamp
@@ -0,0 +1,61 @@
+"""
+Coalescing of identical concurrent calls: while a call for a key is in flight, other
+callers of the same key wait for it and share its result or exception.
+"""
+
+from threading import Event, Lock
+from time import monotonic
+
+from backend.utils.metrics import Metrics
+
+
+class _Call:
+    def __init__(self):
+        self.done = Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+
+    lock = Lock()
+    calls = {}
+
+    @classmethod
+    def do(cls, key, func, timeout=None, retry_on=()):
+        """
+        func() once per key at a time. A caller that gives up waiting after timeout runs
+        func itself, which is how a deadline that passed is reported to it. Errors of the
+        retry_on types are the leader's own, like its deadline, so waiting callers call
+        again rather than share them, one of them as the new leader.
+        """
+        expires = None if timeout is None else monotonic() + timeout
+        while True:
+            with cls.lock:
+                call = cls.calls.get(key)
+                leader = call is None
+                if leader:
+                    call = cls.calls[key] = _Call()
+
+            if leader:
+                break
+
+            Metrics.increment("api.coalesced")
+            if not call.done.wait(timeout=None if expires is None else max(0, expires - monotonic())):
+                return func()
+            if isinstance(call.error, retry_on):
+                continue
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with cls.lock:
+                del cls.calls[key]
+            call.done.set()
@@ -0,0 +1,125 @@
+"""
+Upsert throughput and index size of the row layouts before and after time-ordered keys,
+run as python -m backend.benchmarks.keys against the database in PG_URI
+
+Each layout is loaded into a temporary table shaped like character_mmr, in batches with
+ON CONFLICT DO NOTHING as the ETL does, and reported as JSON.
+"""
+
+import argparse
+import json
+import random
+import time
+import uuid
+
+from psycopg2.extras import execute_values
+
+from backend.db.db import create_db_engine
+from backend.static import BACKFILL_BATCH_SIZE
+from backend.utils.ids import uuid7
+
+LAYOUTS = {
+    "uuid4_varchar": {
+        "key": uuid.uuid4,
+        "profile_id": str,
+        "ddl": """
+            CREATE TEMPORARY TABLE {table} (
+                id uuid PRIMARY KEY,
+                profile_id varchar NOT NULL,
+                realm_id integer NOT NULL,
+                region_id integer NOT NULL,
+                mmr integer NOT NULL,
+                date integer NOT NULL,
+                UNIQUE (profile_id, realm_id, region_id, date)
+            )
+        """,
+    },
+    "uuid7_bigint": {
+        "key": uuid7,
+        "profile_id": int,
+        "ddl": """
+            CREATE TEMPORARY TABLE {table} (
+                id uuid PRIMARY KEY,
+                profile_id bigint NOT NULL,
+                realm_id smallint NOT NULL,
+                region_id smallint NOT NULL,
+                mmr integer NOT NULL,
+                date integer NOT NULL,
+                UNIQUE (profile_id, realm_id, region_id, date)
+            )
+        """,
+    },
+}
+
+SIZES = """
+SELECT pg_relation_size('{table}'), pg_relation_size('{table}_pkey'), pg_indexes_size('{table}')
+"""
+
+
+def generate_rows(layout, rows, seed):
+    rng = random.Random(seed)
+    date = int(time.time())
+    for _ in range(rows):
+        date += rng.randint(0, 2)
+        yield (
+            str(layout["key"]()),
+            layout["profile_id"](rng.randint(1, 20_000_000)),
+            rng.randint(1, 2),
+            rng.randint(1, 3),
+            rng.randint(1000, 7000),
+            date,
+        )
+
+
+def benchmark(cursor, name, rows, batch_size, seed):
+    layout = LAYOUTS[name]
+    table = f"benchmark_{name}"
+    cursor.execute(layout["ddl"].format(table=table))
+
+    batch = []
+    elapsed = 0.0
+    stmt = f"INSERT INTO {table} VALUES %s ON CONFLICT DO NOTHING"
+    for row in generate_rows(layout, rows, seed):
+        batch.append(row)
+        if len(batch) >= batch_size:
+            start = time.perf_counter()
+            execute_values(cursor, stmt, batch, page_size=batch_size)
+            elapsed += time.perf_counter() - start
+            batch = []
+    if batch:
+        start = time.perf_counter()
+        execute_values(cursor, stmt, batch, page_size=batch_size)
+        elapsed += time.perf_counter() - start
+
+    cursor.execute(SIZES.format(table=table))
+    table_bytes, pkey_bytes, index_bytes = cursor.fetchone()
+    return {
+        "layout": name,
+        "rows": rows,
+        "batch_size": batch_size,
+        "seconds": round(elapsed, 3),
+        "rows_per_second": round(rows / elapsed) if elapsed else None,
+        "table_bytes": table_bytes,
+        "pkey_bytes": pkey_bytes,
+        "index_bytes": index_bytes,
+    }
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-l", "--layout", action="append", choices=sorted(LAYOUTS))
+    parser.add_argument("-n", "--rows", type=int, default=1_000_000)
+    parser.add_argument("-b", "--batch-size", type=int, default=BACKFILL_BATCH_SIZE)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    engine = create_db_engine()
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        for name in args.layout or LAYOUTS:
+            print(json.dumps(benchmark(cursor, name, args.rows, args.batch_size, args.seed)))
+    finally:
+        connection.rollback()
+        connection.close()
@@ -0,0 +1,144 @@
+"""
+Write throughput of the sync and async persistence paths, run as
+python -m backend.benchmarks.persistence against the database in PG_URI
+
+Both paths load the same seeded batches of character_mmr shaped rows into a scratch table
+with ON CONFLICT DO NOTHING, as the ETL does. Each batch first waits --fetch-latency
+seconds to stand in for the API request that produced it, so the report shows how well
+each path overlaps fetching with writing. The sync path runs batches on a thread pool of
+--concurrency sessions, the async path runs --concurrency coroutines sharing
+--connections asyncpg connections. Results are printed as JSON.
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import Column, Integer, MetaData, String, Table, UniqueConstraint, Uuid
+
+from backend.db.aio import (
+    async_bulk_insert,
+    async_session_scope,
+    create_async_db_engine,
+)
+from backend.db.db import bulk_insert, create_db_engine, insert_stmt, session_scope
+from backend.static import PROFILE_BATCH_SIZE
+from backend.utils.ids import uuid7
+
+UNIQUE_CONSTRAINT = "benchmark_character_mmr_unique_constraint"
+
+metadata = MetaData()
+table = Table(
+    "benchmark_character_mmr",
+    metadata,
+    Column("id", Uuid, primary_key=True),
+    Column("character_id", Uuid, nullable=False),
+    Column("race", String, nullable=False),
+    Column("mmr", Integer, nullable=False),
+    Column("date", Integer, nullable=False),
+    Column("wins", Integer),
+    Column("losses", Integer),
+    Column("points", Integer),
+    UniqueConstraint("character_id", "race", "mmr", "date", name=UNIQUE_CONSTRAINT),
+)
+
+
+def generate_batches(rows, batch_size, seed):
+    rng = random.Random(seed)
+    characters = [uuid7() for _ in range(max(rows // 10, 1))]
+    date = int(time.time())
+    batches = []
+    for offset in range(0, rows, batch_size):
+        batch = []
+        for _ in range(min(batch_size, rows - offset)):
+            date += rng.randint(0, 2)
+            batch.append(
+                {
+                    "id": uuid7(),
+                    "character_id": rng.choice(characters),
+                    "race": rng.choice(("PROTOSS", "TERRAN", "ZERG", "RANDOM")),
+                    "mmr": rng.randint(1000, 7000),
+                    "date": date,
+                    "wins": rng.randint(0, 500),
+                    "losses": rng.randint(0, 500),
+                    "points": None,
+                }
+            )
+        batches.append(batch)
+    return batches
+
+
+def report(path, batches, elapsed, **kwargs):
+    rows = sum(len(batch) for batch in batches)
+    return {
+        "path": path,
+        "rows": rows,
+        "batches": len(batches),
+        **kwargs,
+        "seconds": round(elapsed, 3),
+        "rows_per_second": round(rows / elapsed) if elapsed else None,
+    }
+
+
+def benchmark_sync(engine, batches, concurrency, fetch_latency):
+    def write(batch):
+        time.sleep(fetch_latency)
+        with session_scope(engine=engine) as session:
+            bulk_insert(session, stmt=insert_stmt(model=table, values=batch), constraint=UNIQUE_CONSTRAINT)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for _ in executor.map(write, batches):
+            pass
+    return report("sync", batches, time.perf_counter() - start, concurrency=concurrency)
+
+
+async def benchmark_async(batches, concurrency, connections, fetch_latency):
+    engine = create_async_db_engine(pool_size=connections, max_overflow=0)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def write(batch):
+        async with semaphore:
+            await asyncio.sleep(fetch_latency)
+            async with async_session_scope(engine=engine) as session:
+                await async_bulk_insert(
+                    session, stmt=insert_stmt(model=table, values=batch), constraint=UNIQUE_CONSTRAINT
+                )
+
+    try:
+        start = time.perf_counter()
+        await asyncio.gather(*(write(batch) for batch in batches))
+        elapsed = time.perf_counter() - start
+    finally:
+        await engine.dispose()
+    return report("async", batches, elapsed, concurrency=concurrency, connections=connections)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-p", "--path", action="append", choices=["sync", "async"])
+    parser.add_argument("-n", "--rows", type=int, default=200_000)
+    parser.add_argument("-b", "--batch-size", type=int, default=PROFILE_BATCH_SIZE)
+    parser.add_argument("-c", "--concurrency", type=int, default=32)
+    parser.add_argument("--connections", type=int, default=4)
+    parser.add_argument("--fetch-latency", type=float, default=0.2)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    batches = generate_batches(args.rows, args.batch_size, args.seed)
+    engine = create_db_engine()
+    for path in args.path or ["sync", "async"]:
+        metadata.drop_all(engine)
+        metadata.create_all(engine)
+        try:
+            if path == "sync":
+                result = benchmark_sync(engine, batches, args.concurrency, args.fetch_latency)
+            else:
+                result = asyncio.run(benchmark_async(batches, args.concurrency, args.connections, args.fetch_latency))
+        finally:
+            metadata.drop_all(engine)
+        print(json.dumps(result))
@@ -0,0 +1,64 @@
+"""
+Startup time of the ETL entry point, run as python -m backend.benchmarks.startup
+
+Each run imports the target module in a fresh interpreter and reports wall time and the
+heavy dependencies that were loaded, as JSON so CI can track it between commits.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+HEAVY_MODULES = ("sqlalchemy", "pydantic", "requests", "tenacity", "schedule", "numpy", "pyarrow")
+
+PROBE = """
+import json, sys
+import {module}
+print(json.dumps(sorted(name for name in {heavy!r} if name in sys.modules)))
+"""
+
+
+def run_once(module):
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-c", PROBE.format(module=module, heavy=HEAVY_MODULES)],
+        capture_output=True,
+        text=True,
+        check=True,
+        env={**os.environ, "PYTHONDONTWRITEBYTECODE": "1"},
+    )
+    elapsed = time.perf_counter() - start
+    return elapsed, json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def benchmark(module, runs):
+    timings = []
+    loaded = []
+    for _ in range(runs):
+        elapsed, loaded = run_once(module)
+        timings.append(elapsed)
+
+    timings.sort()
+    return {
+        "module": module,
+        "runs": runs,
+        "min_seconds": round(timings[0], 4),
+        "median_seconds": round(statistics.median(timings), 4),
+        "max_seconds": round(timings[-1], 4),
+        "heavy_modules_loaded": loaded,
+    }
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-m", "--module", action="append")
+    parser.add_argument("-n", "--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    for module in args.module or ["backend.etl.main"]:
+        print(json.dumps(benchmark(module, args.runs)))
@@ -0,0 +1,97 @@
+"""
+Async equivalents of session_scope, bulk_insert and bulk_upsert on SQLAlchemy asyncio and
+asyncpg. Statements are built with the same insert_stmt as the sync path, only executing
+them is awaited, so a coroutine can write one batch while others wait on the network.
+
+asyncpg connections belong to the event loop that opened them: use the engine from a
+single loop, and dispose of it with dispose_async_engine before that loop closes.
+"""
+
+import os
+from contextlib import asynccontextmanager
+from threading import Lock
+
+from dotenv import load_dotenv
+
+from backend.static import ASYNC_DB_MAX_OVERFLOW, ASYNC_DB_POOL_SIZE
+from backend.utils.metrics import Metrics
+
+load_dotenv()
+
+
+_async_engine = None
+_async_engine_lock = Lock()
+
+
+def async_pg_uri(uri=None):
+    """PG_URI with the asyncpg driver, i.e. postgresql+asyncpg://..."""
+    uri = uri or os.environ.get("PG_URI")
+    scheme, _, rest = uri.partition("://")
+    return f"{scheme.split('+')[0]}+asyncpg://{rest}"
+
+
+def create_async_db_engine(pool_size=ASYNC_DB_POOL_SIZE, max_overflow=ASYNC_DB_MAX_OVERFLOW):
+    from sqlalchemy.ext.asyncio import create_async_engine
+
+    return create_async_engine(
+        async_pg_uri(),
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        pool_timeout=30,
+    )
+
+
+def get_async_engine():
+    global _async_engine
+    if _async_engine is None:
+        with _async_engine_lock:
+            if _async_engine is None:
+                _async_engine = create_async_db_engine()
+    return _async_engine
+
+
+async def dispose_async_engine():
+    global _async_engine
+    with _async_engine_lock:
+        engine, _async_engine = _async_engine, None
+    if engine is not None:
+        await engine.dispose()
+
+
+@asynccontextmanager
+async def async_session_scope(engine=None):
+    from sqlalchemy.ext.asyncio import AsyncSession
+
+    if not engine:
+        engine = get_async_engine()
+
+    session = AsyncSession(bind=engine)
+    try:
+        yield session
+        await session.commit()
+    except Exception:
+        await session.rollback()
+        raise
+    finally:
+        await session.close()
+
+
+async def async_bulk_insert(session, stmt, constraint):
+    result = await session.execute(
+        stmt.on_conflict_do_nothing(
+            constraint=constraint,
+        )
+    )
+    Metrics.increment(f"rows.{stmt.table.name}", max(result.rowcount, 0))
+    return result.rowcount
+
+
+async def async_bulk_upsert(session, stmt, constraint, set_):
+    result = await session.execute(
+        stmt.on_conflict_do_update(
+            constraint=constraint,
+            set_=set_,
+        )
+    )
+    Metrics.increment(f"rows.{stmt.table.name}", max(result.rowcount, 0))
+    return result.rowcount
@@ -1,17 +1,28 @@
+import csv
+import io
 import os
 from contextlib import contextmanager
+from enum import Enum
+from threading import Lock
 
 from dotenv import load_dotenv
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, text
 from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.orm import Session
 
 from backend.utils.concurrency import thread_pool_max_workers
+from backend.utils.metrics import Metrics
 
 load_dotenv()
 
 
-def get_engine():
+COPY_NULL = "\\N"
+
+_engine = None
+_engine_lock = Lock()
+
+
+def create_db_engine():
     workers = thread_pool_max_workers()
     return create_engine(
         os.environ.get("PG_URI"),
@@ -21,13 +32,27 @@ def get_engine():
     )
 
 
-ENGINE = get_engine()
+def get_engine():
+    """The process wide engine, created on first use so importing this module stays cheap"""
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = create_db_engine()
+    return _engine
+
+
+def __getattr__(name):
+    # ENGINE used to be created at import time, keep it importable
+    if name == "ENGINE":
+        return get_engine()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 @contextmanager
 def session_scope(engine=None):
     if not engine:
-        engine = ENGINE
+        engine = get_engine()
 
     session = Session(bind=engine)
     try:
@@ -51,7 +76,14 @@ def query(
     order_by=None,
     limit=None,
     count=None,
+    yield_per=None,
 ):
+    """
+    Build and execute a query. With yield_per set, rows are streamed from a server-side
+    cursor in chunks of yield_per instead of being materialized up front; the returned
+    iterable is only valid while session is open. Pass columns rather than entities in
+    params to stream lightweight row tuples.
+    """
     stmt = session.query(*params)
 
     if joins:
@@ -72,7 +104,7 @@ def query(
         stmt.group_by(*group_by)
 
     if order_by is not None:
-        stmt = stmt.order_by(order_by)
+        stmt = stmt.order_by(*order_by) if isinstance(order_by, (list, tuple)) else stmt.order_by(order_by)
 
     if limit is not None:
         stmt = stmt.limit(limit)
@@ -80,6 +112,9 @@ def query(
     if count is not None:
         return stmt.count()
 
+    if yield_per is not None:
+        return stmt.yield_per(yield_per)
+
     return stmt.all()
 
 
@@ -93,20 +128,82 @@ def insert_stmt(model, values, returning=None):
 
 
 def bulk_insert(session, stmt, constraint):
-    session.execute(
+    result = session.execute(
         stmt.on_conflict_do_nothing(
             constraint=constraint,
         )
     )
+    Metrics.increment(f"rows.{stmt.table.name}", max(result.rowcount, 0))
+    return result.rowcount
 
 
 def bulk_upsert(session, stmt, constraint, set_):
-    session.execute(
+    result = session.execute(
         stmt.on_conflict_do_update(
             constraint=constraint,
             set_=set_,
         )
     )
+    Metrics.increment(f"rows.{stmt.table.name}", max(result.rowcount, 0))
+
+
+def copy_value(value):
+    if value is None:
+        return COPY_NULL
+    if isinstance(value, Enum):
+        return value.name
+    return value
+
+
+def copy_upsert(session, model, rows, constraint, update_columns=None):
+    """
+    Bulk load rows (dicts keyed by column name) with COPY into a temporary staging table,
+    then merge them into model's table with one INSERT .. SELECT .. ON CONFLICT. Much
+    faster than multi-row INSERT for large batches. Rows sharing a constraint key are
+    merged once. Without update_columns conflicting rows are left untouched.
+    """
+    if not rows:
+        return 0
+
+    table = model.__table__
+    columns = [column.name for column in table.columns]
+    unique = next(table_constraint for table_constraint in table.constraints if table_constraint.name == constraint)
+    keys = ", ".join(f'"{column.name}"' for column in unique.columns)
+    column_list = ", ".join(f'"{column}"' for column in columns)
+    staging = f"staging_{table.name}"
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow([copy_value(row.get(column)) for column in columns])
+    buffer.seek(0)
+
+    connection = session.connection()
+    connection.exec_driver_sql(f'CREATE TEMP TABLE {staging} (LIKE "{table.name}" INCLUDING DEFAULTS) ON COMMIT DROP')
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert(f"COPY {staging} ({column_list}) FROM STDIN WITH (FORMAT csv, NULL '{COPY_NULL}')", buffer)
+    finally:
+        cursor.close()
+
+    if update_columns:
+        conflict = "DO UPDATE SET " + ", ".join(f'"{column}" = EXCLUDED."{column}"' for column in update_columns)
+    else:
+        conflict = "DO NOTHING"
+    result = connection.exec_driver_sql(
+        f'INSERT INTO "{table.name}" ({column_list}) '
+        + f"SELECT DISTINCT ON ({keys}) {column_list} FROM {staging} "
+        + f"ON CONFLICT ON CONSTRAINT {constraint} {conflict}"
+    )
+    connection.exec_driver_sql(f"DROP TABLE {staging}")
+
+    Metrics.increment(f"rows.{table.name}", max(result.rowcount, 0))
+    return result.rowcount
+
+
+def defer_constraints(session):
+    """Check deferrable (foreign key) constraints once at commit instead of per row"""
+    session.execute(text("SET CONSTRAINTS ALL DEFERRED"))
 
 
 def create(session, instance):
@@ -1,18 +1,41 @@
 import uuid
 from typing import List, Optional
 
-from sqlalchemy import ForeignKey, UniqueConstraint
+from sqlalchemy import (
+    JSON,
+    BigInteger,
+    ForeignKey,
+    Identity,
+    Index,
+    SmallInteger,
+    UniqueConstraint,
+    false,
+    func,
+)
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 
-from backend.enums import Race
+from backend.enums import Race, RequestSource
 from backend.static import (
+    BACKFILL_CHECKPOINT_UNIQUE_CONSTRAINT,
+    CHANGE_EVENT_ORDER_INDEX,
+    CHARACTER_MMR_CREATED_INDEX,
+    CHARACTER_MMR_DATE_INDEX,
+    CHARACTER_MMR_ROLLUP_UNIQUE_CONSTRAINT,
     CHARACTER_MMR_UNIQUE_CONSTRAINT,
     CHARACTER_UNIQUE_CONSTRAINT,
+    GAME_CREATED_INDEX,
+    LADDER_HISTORY_ORDER_INDEX,
     LADDER_MEMBER_UNIQUE_CONSTRAINT,
     LADDER_UNIQUE_CONSTRAINT,
     LEAGUE_UNIQUE_CONSTRAINT,
+    MATCH_CREATED_INDEX,
+    MATCH_UNIQUE_CONSTRAINT,
     PROFILE_UNIQUE_CONSTRAINT,
+    RETRY_REQUEST_UNIQUE_CONSTRAINT,
+    TEAM_MMR_UNIQUE_CONSTRAINT,
+    TEAM_UNIQUE_CONSTRAINT,
 )
+from backend.utils.ids import uuid7
 
 
 class Base(DeclarativeBase):
@@ -24,13 +47,13 @@ class Base(DeclarativeBase):
 
 class League(Base):
     __tablename__ = "league"
-    id: Mapped[uuid.UUID] = mapped_column(primary_key=True, default=uuid.uuid4)
+    id: Mapped[uuid.UUID] = mapped_column(primary_key=True, default=uuid7)
 
-    league_id: Mapped[int] = mapped_column()
-    region_id: Mapped[int] = mapped_column()
+    league_id: Mapped[int] = mapped_column(SmallInteger)
+    region_id: Mapped[int] = mapped_column(SmallInteger)
     season_id: Mapped[int] = mapped_column()
-    queue_id: Mapped[int] = mapped_column()
-    team_type: Mapped[int] = mapped_column()
+    queue_id: Mapped[int] = mapped_column(SmallInteger)
+    team_type: Mapped[int] = mapped_column(SmallInteger)
 
     ladders: Mapped[List["Ladder"]] = relationship(back_populates="league")
 
@@ -50,15 +73,16 @@ class League(Base):
 
 class Ladder(Base):
     __tablename__ = "ladder"
-    id: Mapped[uuid.UUID] = mapped_column(primary_key=True, default=uuid.uuid4)
+    id: Mapped[uuid.UUID] = mapped_column(primary_key=True, default=uuid7)
 
     ladder_id: Mapped[int] = mapped_column()
-    region_id: Mapped[int] = mapped_column()
+    region_id: Mapped[int] = mapped_column(SmallInteger)
     min_rating: Mapped[Optional[int]] = mapped_column()
     max_rating: Mapped[Optional[int]] = mapped_column()
     member_count: Mapped[Optional[int]] = mapped_column()
+    content_hash: Mapped[Optional[str]] = mapped_column()  # Of the last legacy ladder payload written
 
-    league_id = mapped_column(ForeignKey("league.id"))
+    league_id = mapped_column(ForeignKey("league.id", deferrable=True, initially="IMMEDIATE"))
     league: Mapped[League] = relationship(back_populates="ladders")
     ladder_members: Mapped[List["LadderMember"]] = relationship(back_populates="ladder")
 
@@ -78,7 +102,7 @@ class Ladder(Base):
 
 class LadderMember(Base):
     __tablename__ = "ladder_member"
-    id: Mapped[uuid.UUID] = mapped_column(primary_key=True, default=uuid.uuid4)
+    id: Mapped[uuid.UUID] = mapped_column(primary_key=True, default=uuid7)
 
     join_timestamp: Mapped[int] = mapped_column()
     points: Mapped[Optional[int]] = mapped_column()
@@ -88,9 +112,9 @@ class LadderMember(Base):
     previous_rank: Mapped[Optional[int]] = mapped_column()
     race: Mapped[Optional[Race]] = mapped_column()
 
-    profile_id = mapped_column(ForeignKey("profile.id"))
+    profile_id = mapped_column(ForeignKey("profile.id", deferrable=True, initially="IMMEDIATE"))
     profile: Mapped["Profile"] = relationship(back_populates="ladder_members")
-    ladder_id = mapped_column(ForeignKey("ladder.id"))
+    ladder_id = mapped_column(ForeignKey("ladder.id", deferrable=True, initially="IMMEDIATE"))
     ladder: Mapped["Ladder"] = relationship(back_populates="ladder_members")
 
     UniqueConstraint(profile_id, ladder_id, join_timestamp, name=LADDER_MEMBER_UNIQUE_CONSTRAINT)
@@ -111,40 +135,114 @@ class LadderMember(Base):
         )
 
 
+class LadderHistory(Base):
+    """
+    Standings of a ladder's members at a sweep. A keyframe holds every member's fields, other
+    rows only the fields that changed since the previous sweep, keyed by member.
+    """
+
+    __tablename__ = "ladder_history"
+    id: Mapped[uuid.UUID] = mapped_column(primary_key=True, default=uuid7)
+
+    timestamp: Mapped[int] = mapped_column()
+    keyframe: Mapped[bool] = mapped_column()
+    members: Mapped[dict] = mapped_column(JSON)
+
+    ladder_id = mapped_column(ForeignKey("ladder.id", deferrable=True, initially="IMMEDIATE"))
+
+    Index(LADDER_HISTORY_ORDER_INDEX, ladder_id, timestamp)
+
+    def __repr__(self) -> str:
+        return (
+            f"LadderHistory(id={self.id!r}, "
+            + f"ladder_id={self.ladder_id!r}, "
+            + f"timestamp={self.timestamp!r}, "
+            + f"keyframe={self.keyframe!r}, "
+            + f"members={len(self.members)!r}"
+            + ")"
+        )
+
+
 class CharacterMMR(Base):
     __tablename__ = "character_mmr"
-    id: Mapped[uuid.UUID] = mapped_column(primary_key=True, default=uuid.uuid4)
+    id: Mapped[uuid.UUID] = mapped_column(primary_key=True, default=uuid7)
 
     race: Mapped[Race] = mapped_column()
     mmr: Mapped[int] = mapped_column()
     date: Mapped[int] = mapped_column()
+    wins: Mapped[Optional[int]] = mapped_column()
+    losses: Mapped[Optional[int]] = mapped_column()
+    points: Mapped[Optional[int]] = mapped_column()
+    created_timestamp: Mapped[Optional[int]] = mapped_column()  # Ingestion time, unset on older rows
 
-    character_id = mapped_column(ForeignKey("character.id"))
+    character_id = mapped_column(ForeignKey("character.id", deferrable=True, initially="IMMEDIATE"))
     character: Mapped["Character"] = relationship(back_populates="character_mmrs")
 
     UniqueConstraint(character_id, race, mmr, date, name=CHARACTER_MMR_UNIQUE_CONSTRAINT)
+    Index(CHARACTER_MMR_DATE_INDEX, date)
+    Index(CHARACTER_MMR_CREATED_INDEX, created_timestamp)
 
     def __repr__(self) -> str:
         return (
             f"CharacterMMR(id={self.id!r}, "
             + f"character_id={self.character_id!r}, "
             + f"race={self.race!r}, "
-            + f"mmr={self.mmr!r}"
-            + f"date={self.date!r}"
+            + f"mmr={self.mmr!r}, "
+            + f"date={self.date!r}, "
+            + f"wins={self.wins!r}, "
+            + f"losses={self.losses!r}, "
+            + f"points={self.points!r}"
+            + ")"
+        )
+
+
+class CharacterMMRRollup(Base):
+    """Open, high, low and close MMR of a character's race over a bucket of resolution seconds"""
+
+    __tablename__ = "character_mmr_rollup"
+    id: Mapped[uuid.UUID] = mapped_column(primary_key=True, default=uuid7)
+
+    race: Mapped[Race] = mapped_column()
+    resolution: Mapped[int] = mapped_column()
+    bucket: Mapped[int] = mapped_column()  # Start timestamp
+    open: Mapped[int] = mapped_column()
+    high: Mapped[int] = mapped_column()
+    low: Mapped[int] = mapped_column()
+    close: Mapped[int] = mapped_column()
+    open_date: Mapped[int] = mapped_column()
+    close_date: Mapped[int] = mapped_column()
+    wins: Mapped[Optional[int]] = mapped_column()
+    losses: Mapped[Optional[int]] = mapped_column()
+
+    character_id = mapped_column(ForeignKey("character.id", deferrable=True, initially="IMMEDIATE"))
+
+    UniqueConstraint(character_id, race, resolution, bucket, name=CHARACTER_MMR_ROLLUP_UNIQUE_CONSTRAINT)
+
+    def __repr__(self) -> str:
+        return (
+            f"CharacterMMRRollup(id={self.id!r}, "
+            + f"character_id={self.character_id!r}, "
+            + f"race={self.race!r}, "
+            + f"resolution={self.resolution!r}, "
+            + f"bucket={self.bucket!r}, "
+            + f"open={self.open!r}, "
+            + f"high={self.high!r}, "
+            + f"low={self.low!r}, "
+            + f"close={self.close!r}"
             + ")"
         )
 
 
 class Character(Base):
     __tablename__ = "character"
-    id: Mapped[uuid.UUID] = mapped_column(primary_key=True, default=uuid.uuid4)
+    id: Mapped[uuid.UUID] = mapped_column(primary_key=True, default=uuid7)
 
     display_name: Mapped[str] = mapped_column()
     clan_name: Mapped[Optional[str]] = mapped_column()
     clan_tag: Mapped[Optional[str]] = mapped_column()
     profile_path: Mapped[str] = mapped_column()
 
-    profile_id = mapped_column(ForeignKey("profile.id"))
+    profile_id = mapped_column(ForeignKey("profile.id", deferrable=True, initially="IMMEDIATE"))
     profile: Mapped["Profile"] = relationship(back_populates="characters")
     character_mmrs: Mapped[List["CharacterMMR"]] = relationship(back_populates="character")
 
@@ -164,11 +262,13 @@ class Character(Base):
 
 class Profile(Base):
     __tablename__ = "profile"
-    id: Mapped[uuid.UUID] = mapped_column(primary_key=True, default=uuid.uuid4)
+    id: Mapped[uuid.UUID] = mapped_column(primary_key=True, default=uuid7)
 
-    profile_id: Mapped[str] = mapped_column()
-    realm_id: Mapped[int] = mapped_column()
-    region_id: Mapped[int] = mapped_column()
+    profile_id: Mapped[int] = mapped_column(BigInteger)
+    realm_id: Mapped[int] = mapped_column(SmallInteger)
+    region_id: Mapped[int] = mapped_column(SmallInteger)
+    match_history_timestamp: Mapped[Optional[int]] = mapped_column()
+    match_history_polled_timestamp: Mapped[Optional[int]] = mapped_column()
 
     matches: Mapped[List["Match"]] = relationship(back_populates="profile")
     characters: Mapped[List["Character"]] = relationship(back_populates="profile")
@@ -181,24 +281,82 @@ class Profile(Base):
             f"Profile(id={self.id!r}, "
             + f"profile_id={self.profile_id!r}, "
             + f"realm_id={self.realm_id!r}, "
-            + f"region_id={self.region_id!r}"
+            + f"region_id={self.region_id!r}, "
+            + f"match_history_timestamp={self.match_history_timestamp!r}, "
+            + f"match_history_polled_timestamp={self.match_history_polled_timestamp!r}"
+            + ")"
+        )
+
+
+class Team(Base):
+    __tablename__ = "team"
+    id: Mapped[uuid.UUID] = mapped_column(primary_key=True, default=uuid7)
+
+    region_id: Mapped[int] = mapped_column(SmallInteger)
+    queue_id: Mapped[int] = mapped_column(SmallInteger)
+    team_type: Mapped[int] = mapped_column(SmallInteger)
+    team_key: Mapped[str] = mapped_column()
+
+    team_mmrs: Mapped[List["TeamMMR"]] = relationship(back_populates="team")
+    matches: Mapped[List["Match"]] = relationship(back_populates="team")
+
+    UniqueConstraint(region_id, queue_id, team_type, team_key, name=TEAM_UNIQUE_CONSTRAINT)
+
+    def __repr__(self) -> str:
+        return (
+            f"Team(id={self.id!r}, "
+            + f"region_id={self.region_id!r}, "
+            + f"queue_id={self.queue_id!r}, "
+            + f"team_type={self.team_type!r}, "
+            + f"team_key={self.team_key!r}"
+            + ")"
+        )
+
+
+class TeamMMR(Base):
+    __tablename__ = "team_mmr"
+    id: Mapped[uuid.UUID] = mapped_column(primary_key=True, default=uuid7)
+
+    mmr: Mapped[int] = mapped_column()
+    date: Mapped[int] = mapped_column()
+    wins: Mapped[Optional[int]] = mapped_column()
+    losses: Mapped[Optional[int]] = mapped_column()
+    points: Mapped[Optional[int]] = mapped_column()
+
+    team_id = mapped_column(ForeignKey("team.id", deferrable=True, initially="IMMEDIATE"))
+    team: Mapped["Team"] = relationship(back_populates="team_mmrs")
+
+    UniqueConstraint(team_id, mmr, date, name=TEAM_MMR_UNIQUE_CONSTRAINT)
+
+    def __repr__(self) -> str:
+        return (
+            f"TeamMMR(id={self.id!r}, "
+            + f"team_id={self.team_id!r}, "
+            + f"mmr={self.mmr!r}, "
+            + f"date={self.date!r}, "
+            + f"wins={self.wins!r}, "
+            + f"losses={self.losses!r}, "
+            + f"points={self.points!r}"
             + ")"
         )
 
 
 class Game(Base):
     __tablename__ = "game"
-    id: Mapped[uuid.UUID] = mapped_column(primary_key=True, default=uuid.uuid4)
+    id: Mapped[uuid.UUID] = mapped_column(primary_key=True, default=uuid7)
 
     start_timestamp: Mapped[int] = mapped_column()
     end_timestamp: Mapped[int] = mapped_column()
+    created_timestamp: Mapped[Optional[int]] = mapped_column()  # Ingestion time, unset on older rows
 
     matches: Mapped[List["Match"]] = relationship(back_populates="game")
 
+    Index(GAME_CREATED_INDEX, created_timestamp)
+
 
 class Match(Base):
     __tablename__ = "match"
-    id: Mapped[uuid.UUID] = mapped_column(primary_key=True, default=uuid.uuid4)
+    id: Mapped[uuid.UUID] = mapped_column(primary_key=True, default=uuid7)
 
     map: Mapped[Optional[str]] = mapped_column()
     type: Mapped[Optional[str]] = mapped_column()
@@ -206,13 +364,22 @@ class Match(Base):
     end_timestamp: Mapped[Optional[int]] = mapped_column()
     decision: Mapped[Optional[str]] = mapped_column()
     speed: Mapped[Optional[str]] = mapped_column()
+    created_timestamp: Mapped[Optional[int]] = mapped_column()  # Ingestion time, unset on older rows
+    # Inferred from ladder results, played in the poll interval (start_timestamp, end_timestamp]
+    inferred: Mapped[bool] = mapped_column(default=False, server_default=false())
 
-    profile_id = mapped_column(ForeignKey("profile.id"))
+    profile_id = mapped_column(ForeignKey("profile.id", deferrable=True, initially="IMMEDIATE"))
     profile: Mapped[Profile] = relationship(back_populates="matches")
 
-    game_id: Mapped[Optional[uuid.UUID]] = mapped_column(ForeignKey("game.id"))
+    game_id: Mapped[Optional[uuid.UUID]] = mapped_column(ForeignKey("game.id", deferrable=True, initially="IMMEDIATE"))
     game: Mapped[Game] = relationship(back_populates="matches")
 
+    team_id: Mapped[Optional[uuid.UUID]] = mapped_column(ForeignKey("team.id", deferrable=True, initially="IMMEDIATE"))
+    team: Mapped[Team] = relationship(back_populates="matches")
+
+    UniqueConstraint(profile_id, map, type, start_timestamp, name=MATCH_UNIQUE_CONSTRAINT)
+    Index(MATCH_CREATED_INDEX, created_timestamp)
+
     def __repr__(self) -> str:
         return (
             f"Match(id={self.id!r}, "
@@ -222,14 +389,127 @@ class Match(Base):
             + f"end_timestamp={self.end_timestamp!r}, "
             + f"decision={self.decision!r}, "
             + f"speed={self.speed!r}, "
-            + f"profile_id={self.profile_id!r}"
+            + f"inferred={self.inferred!r}, "
+            + f"profile_id={self.profile_id!r}, "
+            + f"team_id={self.team_id!r}"
             + ")"
         )
 
 
 class Request(Base):
     __tablename__ = "request"
-    id: Mapped[uuid.UUID] = mapped_column(primary_key=True, default=uuid.uuid4)
+    id: Mapped[uuid.UUID] = mapped_column(primary_key=True, default=uuid7)
 
     url: Mapped[str] = mapped_column()
     timestamp: Mapped[int] = mapped_column()
+    source: Mapped[str] = mapped_column(default=RequestSource.LIVE.value, server_default=RequestSource.LIVE.value)
+
+
+class OAuthToken(Base):
+    """The current API token, shared by every ETL process"""
+
+    __tablename__ = "oauth_token"
+    client_id: Mapped[str] = mapped_column(primary_key=True)
+
+    access_token: Mapped[str] = mapped_column()
+    expires_timestamp: Mapped[int] = mapped_column()
+    updated_timestamp: Mapped[int] = mapped_column()
+
+
+class RetryRequest(Base):
+    __tablename__ = "retry_request"
+    id: Mapped[uuid.UUID] = mapped_column(primary_key=True, default=uuid7)
+
+    kind: Mapped[str] = mapped_column()
+    region_id: Mapped[int] = mapped_column(SmallInteger)
+    url: Mapped[str] = mapped_column()
+    payload: Mapped[dict] = mapped_column(JSON)
+    priority: Mapped[int] = mapped_column()
+    attempts: Mapped[int] = mapped_column()
+    next_attempt_timestamp: Mapped[int] = mapped_column()
+    created_timestamp: Mapped[int] = mapped_column()
+    last_status: Mapped[Optional[int]] = mapped_column()
+    last_error: Mapped[Optional[str]] = mapped_column()
+    dead_timestamp: Mapped[Optional[int]] = mapped_column()
+
+    UniqueConstraint(kind, url, name=RETRY_REQUEST_UNIQUE_CONSTRAINT)
+
+    def __repr__(self) -> str:
+        return (
+            f"RetryRequest(id={self.id!r}, "
+            + f"kind={self.kind!r}, "
+            + f"url={self.url!r}, "
+            + f"attempts={self.attempts!r}, "
+            + f"last_status={self.last_status!r}, "
+            + f"dead_timestamp={self.dead_timestamp!r}"
+            + ")"
+        )
+
+
+class BackfillCheckpoint(Base):
+    __tablename__ = "backfill_checkpoint"
+    id: Mapped[uuid.UUID] = mapped_column(primary_key=True, default=uuid7)
+
+    region_id: Mapped[int] = mapped_column(SmallInteger)
+    season_id: Mapped[int] = mapped_column()
+    leagues_done: Mapped[bool] = mapped_column(default=False)
+    last_ladder_id: Mapped[Optional[int]] = mapped_column()
+    ladders: Mapped[int] = mapped_column(default=0)
+    completed_timestamp: Mapped[Optional[int]] = mapped_column()
+    updated_timestamp: Mapped[int] = mapped_column()
+
+    UniqueConstraint(region_id, season_id, name=BACKFILL_CHECKPOINT_UNIQUE_CONSTRAINT)
+
+    def __repr__(self) -> str:
+        return (
+            f"BackfillCheckpoint(id={self.id!r}, "
+            + f"region_id={self.region_id!r}, "
+            + f"season_id={self.season_id!r}, "
+            + f"leagues_done={self.leagues_done!r}, "
+            + f"last_ladder_id={self.last_ladder_id!r}, "
+            + f"ladders={self.ladders!r}, "
+            + f"completed_timestamp={self.completed_timestamp!r}"
+            + ")"
+        )
+
+
+class ChangeEvent(Base):
+    """
+    Outbox of writes for downstream consumers. Ordered by (transaction_id, id) since ids
+    are assigned before commit and may become visible out of order.
+    """
+
+    __tablename__ = "change_event"
+    id: Mapped[int] = mapped_column(BigInteger, Identity(), primary_key=True)
+
+    transaction_id: Mapped[int] = mapped_column(BigInteger, server_default=func.txid_current())
+    batch_id: Mapped[uuid.UUID] = mapped_column()
+    table_name: Mapped[str] = mapped_column()
+    rows: Mapped[int] = mapped_column()
+    region_id: Mapped[Optional[int]] = mapped_column(SmallInteger)
+    min_timestamp: Mapped[Optional[int]] = mapped_column()
+    max_timestamp: Mapped[Optional[int]] = mapped_column()
+    created_timestamp: Mapped[int] = mapped_column()
+
+    Index(CHANGE_EVENT_ORDER_INDEX, transaction_id, id)
+
+    def __repr__(self) -> str:
+        return (
+            f"ChangeEvent(id={self.id!r}, "
+            + f"batch_id={self.batch_id!r}, "
+            + f"table_name={self.table_name!r}, "
+            + f"rows={self.rows!r}, "
+            + f"region_id={self.region_id!r}, "
+            + f"min_timestamp={self.min_timestamp!r}, "
+            + f"max_timestamp={self.max_timestamp!r}"
+            + ")"
+        )
+
+
+class ChangeFeedCursor(Base):
+    __tablename__ = "change_feed_cursor"
+    consumer: Mapped[str] = mapped_column(primary_key=True)
+
+    last_transaction_id: Mapped[int] = mapped_column(BigInteger)
+    last_event_id: Mapped[int] = mapped_column(BigInteger)
+    updated_timestamp: Mapped[int] = mapped_column()
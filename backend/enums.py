@@ -2,7 +2,6 @@ from enum import Enum
 
 
 # TODO Enable support for CN region. Think this would require hitting a separate API.
-# TODO Enable support for US/EU. Getting 503 for most requests
 class RegionId(Enum):
     US = 1
     EU = 2
@@ -20,7 +19,6 @@ class RealmId(Enum):
     # China = 1
 
 
-# TODO Enable support for other queues
 class QueueId(Enum):
     # WoL_1v1 = 1
     # WoL_2v2 = 2
@@ -31,16 +29,53 @@ class QueueId(Enum):
     # HotS_3v3 = 103
     # HotS_4v4 = 104
     LotV_1v1 = 201
-    # LotV_2v2 = 202
-    # LotV_3v3 = 203
-    # LotV_4v4 = 204
-    # LotV_Archon = 206
+    LotV_2v2 = 202
+    LotV_3v3 = 203
+    LotV_4v4 = 204
+    LotV_Archon = 206
+
+    @property
+    def team_size(self):
+        """Players per side of a game"""
+        return {
+            QueueId.LotV_1v1: 1,
+            QueueId.LotV_2v2: 2,
+            QueueId.LotV_3v3: 3,
+            QueueId.LotV_4v4: 4,
+            QueueId.LotV_Archon: 2,
+        }[self]
+
+    @property
+    def match_type(self):
+        """Match type as reported by the legacy match history API"""
+        return {
+            QueueId.LotV_1v1: "1v1",
+            QueueId.LotV_2v2: "2v2",
+            QueueId.LotV_3v3: "3v3",
+            QueueId.LotV_4v4: "4v4",
+            QueueId.LotV_Archon: "archon",
+        }[self]
+
+    @property
+    def team_types(self):
+        """Solo queues have no random teams"""
+        if self == QueueId.LotV_1v1:
+            return [TeamType.ARRANGED]
+
+        return list(TeamType)
+
+    @classmethod
+    def from_match_type(cls, match_type):
+        for queue in cls:
+            if queue.match_type == match_type:
+                return queue
+
+        return None
 
 
-# TODO Enable support for random team types
 class TeamType(Enum):
     ARRANGED = 0
-    # RANDOM = 1
+    RANDOM = 1
 
 
 class LeagueId(Enum):
@@ -58,3 +93,21 @@ class Race(Enum):
     TERRAN = "TERRAN"
     PROTOSS = "PROTOSS"
     RANDOM = "RANDOM"
+
+
+class Decision(Enum):
+    WIN = "WIN"
+    LOSS = "LOSS"
+    TIE = "TIE"
+
+
+class RequestSource(Enum):
+    LIVE = "live"
+    BACKFILL = "backfill"
+
+
+class RetryKind(Enum):
+    LEAGUE = "league"
+    LEGACY_LADDER = "legacy_ladder"
+    PROFILE_LADDER = "profile_ladder"
+    MATCH_HISTORY = "match_history"
@@ -0,0 +1,329 @@
+"""
+Backfill of leagues, ladders and ladder members (Profile/Character) for past seasons
+"""
+
+from datetime import datetime
+
+from sqlalchemy import tuple_, update
+
+from backend.api.blizzard import ApiUnavailableError, BlizzardApi
+from backend.api.models.game_data import LeagueResponse
+from backend.api.models.ladder import SeasonResponse
+from backend.api.models.legacy import LegacyLadderResponse
+from backend.db.db import (
+    copy_upsert,
+    defer_constraints,
+    get_or_create,
+    query,
+    session_scope,
+)
+from backend.db.model import (
+    BackfillCheckpoint,
+    Character,
+    Ladder,
+    LadderMember,
+    League,
+    Profile,
+)
+from backend.enums import LeagueId, QueueId, RequestSource
+from backend.etl.identity import ProfileIdentities
+from backend.etl.ladder import LeagueFuture, upsert_league
+from backend.etl.ladder_member import LadderFuture
+from backend.static import (
+    BACKFILL_BATCH_SIZE,
+    CHARACTER_UNIQUE_CONSTRAINT,
+    LADDER_MEMBER_UNIQUE_CONSTRAINT,
+    PROFILE_UNIQUE_CONSTRAINT,
+)
+from backend.utils.concurrency import Stage, pipeline, thread_pool_max_workers
+from backend.utils.datetime import current_epoch_time
+from backend.utils.ids import uuid7
+from backend.utils.log import get_logger
+from backend.utils.tracing import span
+
+logger = get_logger(__name__)
+
+
+def backfill_api():
+    """Requests made for backfill count against their own slice of the rate limit"""
+    return BlizzardApi(source=RequestSource.BACKFILL.value)
+
+
+def get_backfill_league_wrapper(league_future):
+    return backfill_api().get_league(
+        region_id=league_future.region_id,
+        season_id=league_future.season_id,
+        queue_id=league_future.queue_id,
+        team_type=league_future.team_type,
+        league_id=league_future.league_id,
+    )
+
+
+def get_backfill_ladder_wrapper(ladder_future):
+    return backfill_api().get_legacy_ladder(region_id=ladder_future.region_id, ladder_id=ladder_future.ladder_id)
+
+
+def get_checkpoint(region_id, season_id):
+    with session_scope() as session:
+        checkpoint = get_or_create(
+            session,
+            model=BackfillCheckpoint,
+            filter={"region_id": region_id, "season_id": season_id},
+            values={
+                "region_id": region_id,
+                "season_id": season_id,
+                "leagues_done": False,
+                "ladders": 0,
+                "updated_timestamp": current_epoch_time(),
+            },
+        )
+        return checkpoint.leagues_done, checkpoint.last_ladder_id, checkpoint.completed_timestamp
+
+
+def update_checkpoint(session, region_id, season_id, **values):
+    session.execute(
+        update(BackfillCheckpoint)
+        .where((BackfillCheckpoint.region_id == region_id), (BackfillCheckpoint.season_id == season_id))
+        .values(updated_timestamp=current_epoch_time(), **values)
+    )
+
+
+def backfill_leagues(region_id, season_id):
+    """Fetch every league of the season. Returns False if any league could not be fetched."""
+    leagues = [
+        LeagueFuture(
+            region_id=region_id,
+            season_id=season_id,
+            queue_id=queue.value,
+            team_type=team.value,
+            league_id=league.value,
+        )
+        for queue in QueueId
+        for team in queue.team_types
+        for league in LeagueId
+    ]
+
+    complete = True
+    stages = [
+        Stage(get_backfill_league_wrapper, workers=thread_pool_max_workers(), name="fetch"),
+        Stage(LeagueResponse.model_validate, name="validate"),
+    ]
+    for item in pipeline(leagues, stages=stages):
+        if not item.ok:
+            logger.error(f"Failed to {item.stage} league {item.arg}: {item.error!r}")
+            complete = complete and not isinstance(item.error, ApiUnavailableError)
+            continue
+
+        item.value.region_id = item.arg.region_id
+        upsert_league(item.value)
+
+    return complete
+
+
+def copy_ladder_members(region_id, season_id, batch):
+    """
+    Write a batch of ladder responses through COPY with foreign keys checked at commit, and
+    advance the season's checkpoint in the same transaction.
+    """
+    profiles = {}
+    for _, response in batch:
+        for ladder_member in response.ladder_members:
+            character = ladder_member.character
+            profiles.setdefault(
+                (character.region_id, character.realm_id, character.profile_id),
+                {
+                    "id": uuid7(),
+                    "profile_id": character.profile_id,
+                    "realm_id": character.realm_id,
+                    "region_id": character.region_id,
+                },
+            )
+
+    with span("write"), session_scope() as session:
+        defer_constraints(session)
+        copy_upsert(session, model=Profile, rows=list(profiles.values()), constraint=PROFILE_UNIQUE_CONSTRAINT)
+        profile_ids = {
+            (region, realm, profile_id): id
+            for id, region, realm, profile_id in query(
+                session,
+                params=[Profile.id, Profile.region_id, Profile.realm_id, Profile.profile_id],
+                filters=[(tuple_(Profile.region_id, Profile.realm_id, Profile.profile_id).in_(list(profiles)))],
+            )
+        }
+
+        characters = []
+        ladder_members = []
+        for ladder_future, response in batch:
+            for ladder_member in response.ladder_members:
+                character = ladder_member.character
+                profile_id = profile_ids[(character.region_id, character.realm_id, character.profile_id)]
+                characters.append(
+                    {
+                        "id": uuid7(),
+                        "display_name": character.display_name,
+                        "clan_name": character.clan_name,
+                        "clan_tag": character.clan_tag,
+                        "profile_path": character.profile_path,
+                        "profile_id": profile_id,
+                    }
+                )
+                ladder_members.append(
+                    {
+                        "id": uuid7(),
+                        "join_timestamp": ladder_member.join_timestamp,
+                        "points": ladder_member.points,
+                        "wins": ladder_member.wins,
+                        "losses": ladder_member.losses,
+                        "highest_rank": ladder_member.highest_rank,
+                        "previous_rank": ladder_member.previous_rank,
+                        "race": ladder_member.race,
+                        "profile_id": profile_id,
+                        "ladder_id": ladder_future.id,
+                    }
+                )
+
+        copy_upsert(
+            session,
+            model=Character,
+            rows=characters,
+            constraint=CHARACTER_UNIQUE_CONSTRAINT,
+            update_columns=["clan_name", "clan_tag"],
+        )
+        copy_upsert(
+            session,
+            model=LadderMember,
+            rows=ladder_members,
+            constraint=LADDER_MEMBER_UNIQUE_CONSTRAINT,
+            update_columns=["points", "wins", "losses", "highest_rank", "previous_rank"],
+        )
+        update_checkpoint(
+            session,
+            region_id,
+            season_id,
+            last_ladder_id=batch[-1][0].ladder_id,
+            ladders=BackfillCheckpoint.ladders + len(batch),
+        )
+
+    ProfileIdentities.set_many(profile_ids)
+    return len(ladder_members)
+
+
+def season_ladders(region_id, season_id, last_ladder_id, limit=None):
+    """
+    The season's ladders in ladder_id order after last_ladder_id, read a page at a time in
+    short transactions so a backfill running for hours never holds a snapshot open
+    """
+    remaining = limit
+    while remaining is None or remaining > 0:
+        page_size = BACKFILL_BATCH_SIZE if remaining is None else min(BACKFILL_BATCH_SIZE, remaining)
+        filters = [(Ladder.region_id == region_id), (League.season_id == season_id)]
+        if last_ladder_id is not None:
+            filters.append(Ladder.ladder_id > last_ladder_id)
+
+        with session_scope() as session:
+            page = query(
+                session,
+                params=[Ladder.id, Ladder.ladder_id, Ladder.region_id],
+                joins=[(League, League.id == Ladder.league_id)],
+                filters=filters,
+                order_by=Ladder.ladder_id,
+                limit=page_size,
+            )
+
+        for ladder in page:
+            yield LadderFuture(id=ladder.id, ladder_id=ladder.ladder_id, region_id=ladder.region_id)
+
+        if len(page) < page_size:
+            return
+        last_ladder_id = page[-1].ladder_id
+        if remaining is not None:
+            remaining -= len(page)
+
+
+def backfill_ladders(region_id, season_id, last_ladder_id, limit=None):
+    """
+    Fetch the season's ladders in ladder_id order after last_ladder_id. Stops at the first
+    ladder the API could not serve so the checkpoint never skips past it. Returns
+    (ladder members written, True if every ladder was fetched).
+    """
+    written = 0
+    batch = []
+    stages = [
+        Stage(get_backfill_ladder_wrapper, workers=thread_pool_max_workers(), name="fetch"),
+        Stage(LegacyLadderResponse.model_validate, name="validate"),
+    ]
+    ladder_futures = season_ladders(region_id, season_id, last_ladder_id, limit=limit)
+    for item in pipeline(ladder_futures, stages=stages, ordered=True):
+        if isinstance(item.error, ApiUnavailableError):
+            logger.warning(f"Stopping backfill of season {season_id} at ladder {item.arg.ladder_id}: {item.error!r}")
+            if batch:
+                written += copy_ladder_members(region_id, season_id, batch)
+            return written, False
+
+        if not item.ok:
+            logger.error(f"Failed to {item.stage} ladder {item.arg}: {item.error!r}")
+            continue
+
+        batch.append((item.arg, item.value))
+        if len(batch) >= BACKFILL_BATCH_SIZE:
+            written += copy_ladder_members(region_id, season_id, batch)
+            batch = []
+
+    if batch:
+        written += copy_ladder_members(region_id, season_id, batch)
+
+    return written, limit is None
+
+
+def backfill_season(region_id, season_id, limit=None):
+    leagues_done, last_ladder_id, completed_timestamp = get_checkpoint(region_id, season_id)
+    if completed_timestamp:
+        logger.info(f"Season {season_id} of region {region_id} is already backfilled.")
+        return True
+
+    if not leagues_done:
+        logger.info(f"Backfilling leagues of season {season_id} for region {region_id}...")
+        if not backfill_leagues(region_id, season_id):
+            return False
+
+        with session_scope() as session:
+            update_checkpoint(session, region_id, season_id, leagues_done=True)
+
+    logger.info(f"Backfilling ladders of season {season_id} for region {region_id} after {last_ladder_id=}...")
+    written, complete = backfill_ladders(region_id, season_id, last_ladder_id, limit=limit)
+    logger.info(f"Wrote {written} ladder members for season {season_id} of region {region_id}.")
+    if complete:
+        with session_scope() as session:
+            update_checkpoint(session, region_id, season_id, completed_timestamp=current_epoch_time())
+
+    return complete
+
+
+def backfill_seasons(**kwargs):
+    """
+    Backfill seasons season_start..season_end (default: the season before the current one)
+    of a region, newest first. Progress is checkpointed per season and ladder batch, so
+    an interrupted backfill resumes where it stopped.
+    """
+    logger.info("Starting backfill of past seasons...")
+    start = datetime.now()
+
+    region_id = kwargs.get("region_id")
+    season_start = kwargs.get("season_start")
+    if not region_id or season_start is None:
+        logger.warning("Missing required params region_id and season_start")
+        return
+
+    season_end = kwargs.get("season_end")
+    if season_end is None:
+        season = SeasonResponse.model_validate(backfill_api().get_ladder_season(region_id=region_id))
+        season_end = season.season_id - 1
+
+    for season_id in range(season_end, season_start - 1, -1):
+        if not backfill_season(region_id, season_id, limit=kwargs.get("limit")):
+            logger.warning(f"Backfill of season {season_id} for region {region_id} is incomplete, will resume there.")
+            break
+
+    end = datetime.now()
+    logger.info(f"Backfilling seasons took {round(end.timestamp() - start.timestamp())} seconds.")
+    logger.info("Done with backfill of past seasons.")
@@ -0,0 +1,207 @@
+"""
+Replay of deferred API requests from the retry queue
+"""
+
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, Callable
+
+from backend.api.blizzard import CircuitOpenError, DeadlineExceededError
+from backend.api.circuit import CircuitState
+from backend.api.models.game_data import LeagueResponse
+from backend.api.models.legacy import LegacyLadderResponse, LegacyMatchHistoryResponse
+from backend.api.models.profile import ProfileLadderResponse
+from backend.db.db import get_engine, session_scope
+from backend.enums import RegionId, RetryKind
+from backend.etl.ladder import LeagueFuture, get_league_wrapper, upsert_league
+from backend.etl.ladder_member import (
+    LadderFuture,
+    get_legacy_ladder_wrapper,
+    insert_ladder_members,
+)
+from backend.etl.ladder_result import (
+    ProfileLadderFuture,
+    get_profile_ladder_wrapper,
+    process_profile_ladder_responses,
+)
+from backend.etl.match import get_match_history_wrapper, insert_match_histories
+from backend.etl.priority import ProfileCandidate
+from backend.etl.retry import (
+    Deferral,
+    complete_requests,
+    dead_letter_requests,
+    defer_requests,
+    due_requests,
+    future_from_payload,
+    is_deferrable,
+)
+from backend.static import (
+    BLIZZARD_API_BASE,
+    REQUEST_MAX_PER_DAY,
+    RETRY_DRAIN_BUDGET_SHARE,
+    RETRY_DRAIN_RUNS_PER_DAY,
+)
+from backend.utils.concurrency import Stage, pipeline, thread_pool_max_workers
+from backend.utils.log import get_logger
+
+logger = get_logger(__name__)
+
+
+@dataclass
+class RetryHandler:
+    future: type
+    fetch: Callable
+    validate: Callable
+    persist: Callable  # Takes a list of (future, response)
+
+
+@dataclass
+class RetryEntry:
+    id: Any
+    kind: str
+    url: str
+    future: Any
+
+
+def persist_leagues(results):
+    for future, response in results:
+        response.region_id = future.region_id
+        upsert_league(response)
+
+
+def persist_ladders(results):
+    for future, response in results:
+        response.ladder_id = future.id
+    insert_ladder_members(response for _, response in results)
+
+
+def persist_profile_ladders(results):
+    for future, response in results:
+        response.ladder_member = future
+    process_profile_ladder_responses(get_engine(), [response for _, response in results])
+
+
+RETRY_HANDLERS = {
+    RetryKind.LEAGUE.value: RetryHandler(
+        future=LeagueFuture,
+        fetch=get_league_wrapper,
+        validate=LeagueResponse.model_validate,
+        persist=persist_leagues,
+    ),
+    RetryKind.LEGACY_LADDER.value: RetryHandler(
+        future=LadderFuture,
+        fetch=get_legacy_ladder_wrapper,
+        validate=LegacyLadderResponse.model_validate,
+        persist=persist_ladders,
+    ),
+    RetryKind.PROFILE_LADDER.value: RetryHandler(
+        future=ProfileLadderFuture,
+        fetch=get_profile_ladder_wrapper,
+        validate=ProfileLadderResponse.model_validate,
+        persist=persist_profile_ladders,
+    ),
+    RetryKind.MATCH_HISTORY.value: RetryHandler(
+        future=ProfileCandidate,
+        fetch=get_match_history_wrapper,
+        validate=LegacyMatchHistoryResponse.model_validate,
+        persist=insert_match_histories,
+    ),
+}
+
+
+def drain_budget():
+    """Deferred requests replayed per region per run, the run's share of the daily quota"""
+    return max(1, int(REQUEST_MAX_PER_DAY * RETRY_DRAIN_BUDGET_SHARE / RETRY_DRAIN_RUNS_PER_DAY / len(RegionId)))
+
+
+def fetch_entry(entry):
+    return entry, RETRY_HANDLERS[entry.kind].fetch(entry.future)
+
+
+def validate_entry(fetched):
+    entry, response = fetched
+    return RETRY_HANDLERS[entry.kind].validate(response)
+
+
+def drain_retry_requests(**kwargs):
+    """
+    Replay due retry requests of a region, most important kinds first, up to this run's
+    share of the rate limit. Successful requests are persisted the same way as in their
+    job and removed from the queue, failed ones are deferred again or dead lettered.
+    Requests that were never sent, cut off by the deadline or an open circuit, are left
+    as they are without counting an attempt.
+    """
+    logger.info("Starting drain of deferred API requests...")
+    start = datetime.now()
+
+    region_id = kwargs.get("region_id")
+    if not region_id:
+        logger.warning("Missing required param region_id")
+        return
+
+    breaker = CircuitState.breaker(BLIZZARD_API_BASE.format(region=RegionId(region_id).name.lower()))
+    if breaker.is_open:
+        logger.info(f"Circuit for {breaker.host} is open, not draining retries.")
+        return
+
+    limit = drain_budget() if kwargs.get("limit") is None else min(drain_budget(), kwargs.get("limit"))
+    with session_scope() as session:
+        entries = [
+            RetryEntry(
+                id=id,
+                kind=kind,
+                url=url,
+                future=future_from_payload(RETRY_HANDLERS[kind].future, payload),
+            )
+            for id, kind, url, payload, _ in due_requests(session, region_id=region_id, limit=limit)
+        ]
+
+    stages = [
+        Stage(fetch_entry, workers=thread_pool_max_workers(), name="fetch"),
+        Stage(validate_entry, name="validate"),
+    ]
+    results = {kind: [] for kind in RETRY_HANDLERS}
+    deferrals = []
+    dead = []
+    unsent = 0
+    for item in pipeline(entries, stages=stages):
+        entry = item.arg
+        if item.ok:
+            results[entry.kind].append((entry, item.value))
+            continue
+
+        if isinstance(item.error, (DeadlineExceededError, CircuitOpenError)):
+            unsent += 1
+            continue
+
+        logger.error(f"Failed to {item.stage} deferred {entry.kind} request {entry.url}: {item.error!r}")
+        if is_deferrable(item.error):
+            deferrals.append(Deferral(kind=entry.kind, future=entry.future, error=item.error, url=entry.url))
+        else:
+            dead.append((entry.id, item.error))
+
+    completed = []
+    for kind, kind_results in results.items():
+        if not kind_results:
+            continue
+
+        try:
+            RETRY_HANDLERS[kind].persist([(entry.future, response) for entry, response in kind_results])
+            completed.extend(entry.id for entry, _ in kind_results)
+        except Exception as e:
+            logger.exception(f"Exception thrown while persisting deferred {kind} requests...")
+            deferrals.extend(
+                Deferral(kind=kind, future=entry.future, error=e, url=entry.url) for entry, _ in kind_results
+            )
+
+    complete_requests(completed)
+    defer_requests(deferrals)
+    dead_letter_requests(dead)
+
+    end = datetime.now()
+    logger.info(
+        f"Replayed {len(completed)} of {len(entries)} deferred requests. {len(deferrals)} failed again, "
+        + f"{len(dead)} dead lettered, {unsent} left for the next run."
+    )
+    logger.info(f"Draining deferred requests took {round(end.timestamp() - start.timestamp())} seconds.")
+    logger.info("Done with drain of deferred API requests.")
@@ -0,0 +1,304 @@
+"""
+ETL processes exporting columnar Parquet snapshots for offline analysis
+"""
+
+import json
+import os
+from dataclasses import dataclass
+from datetime import datetime
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from sqlalchemy import String, and_, cast, func, or_, select
+
+from backend.db.db import session_scope
+from backend.db.model import (
+    Character,
+    CharacterMMR,
+    Game,
+    Ladder,
+    LadderMember,
+    League,
+    Match,
+    Profile,
+)
+from backend.static import EXPORT_BATCH_SIZE, EXPORT_PATH, EXPORT_SETTLE_SECONDS
+from backend.utils.datetime import current_epoch_time
+from backend.utils.log import get_logger
+
+logger = get_logger(__name__)
+
+
+@dataclass
+class ExportTable:
+    name: str
+    schema: pa.Schema
+    incremental_key: str = None  # Ingestion time column, rows are exported once it passes the watermark
+
+
+LADDER_MEMBER_EXPORT = ExportTable(
+    name="ladder_member",
+    schema=pa.schema(
+        [
+            ("id", pa.string()),
+            ("profile_id", pa.string()),
+            ("ladder_id", pa.string()),
+            ("blizzard_ladder_id", pa.int64()),
+            ("league_id", pa.int16()),
+            ("queue_id", pa.int16()),
+            ("team_type", pa.int16()),
+            ("join_timestamp", pa.int64()),
+            ("points", pa.int32()),
+            ("wins", pa.int32()),
+            ("losses", pa.int32()),
+            ("highest_rank", pa.int32()),
+            ("previous_rank", pa.int32()),
+            ("race", pa.string()),
+        ]
+    ),
+)
+
+CHARACTER_MMR_EXPORT = ExportTable(
+    name="character_mmr",
+    schema=pa.schema(
+        [
+            ("id", pa.string()),
+            ("character_id", pa.string()),
+            ("profile_id", pa.string()),
+            ("race", pa.string()),
+            ("mmr", pa.int32()),
+            ("date", pa.int64()),
+        ]
+    ),
+    incremental_key="created_timestamp",
+)
+
+MATCH_EXPORT = ExportTable(
+    name="match",
+    schema=pa.schema(
+        [
+            ("id", pa.string()),
+            ("profile_id", pa.string()),
+            ("game_id", pa.string()),
+            ("map", pa.string()),
+            ("type", pa.string()),
+            ("decision", pa.string()),
+            ("speed", pa.string()),
+            ("start_timestamp", pa.int64()),
+            ("end_timestamp", pa.int64()),
+            ("inferred", pa.bool_()),
+        ]
+    ),
+    incremental_key="created_timestamp",
+)
+
+GAME_EXPORT = ExportTable(
+    name="game",
+    schema=pa.schema(
+        [
+            ("id", pa.string()),
+            ("start_timestamp", pa.int64()),
+            ("end_timestamp", pa.int64()),
+        ]
+    ),
+    incremental_key="created_timestamp",
+)
+
+
+def watermark_path(region_id):
+    """One file per region, regions are exported concurrently"""
+    return EXPORT_PATH / f"_watermarks_region_id={region_id}.json"
+
+
+def read_watermarks(region_id):
+    path = watermark_path(region_id)
+    if not path.exists():
+        return {}
+
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_watermarks(region_id, watermarks):
+    """Replace atomically so a crash mid-write never loses the previous marks"""
+    path = watermark_path(region_id)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(watermarks, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def ingested_between(column, since, until):
+    """Rows ingested in (since, until], rows from before ingestion times were kept go with the first export"""
+    if not since:
+        return or_(column == None, column <= until)  # noqa E711
+    return (column > since) & (column <= until)
+
+
+def partition_path(table, region_id, season_id, date):
+    return EXPORT_PATH / table.name / f"region_id={region_id}" / f"season_id={season_id}" / f"date={date}"
+
+
+def ladder_member_stmt(region_id, season_id, since, until):
+    return (
+        select(
+            cast(LadderMember.id, String),
+            cast(LadderMember.profile_id, String),
+            cast(LadderMember.ladder_id, String),
+            Ladder.ladder_id,
+            League.league_id,
+            League.queue_id,
+            League.team_type,
+            LadderMember.join_timestamp,
+            LadderMember.points,
+            LadderMember.wins,
+            LadderMember.losses,
+            LadderMember.highest_rank,
+            LadderMember.previous_rank,
+            cast(LadderMember.race, String),
+        )
+        .join(Ladder, Ladder.id == LadderMember.ladder_id)
+        .join(League, League.id == Ladder.league_id)
+        .where((Ladder.region_id == region_id), (League.season_id == season_id))
+    )
+
+
+def character_mmr_stmt(region_id, season_id, since, until):
+    return (
+        select(
+            cast(CharacterMMR.id, String),
+            cast(CharacterMMR.character_id, String),
+            cast(Character.profile_id, String),
+            cast(CharacterMMR.race, String),
+            CharacterMMR.mmr,
+            CharacterMMR.date,
+        )
+        .join(Character, Character.id == CharacterMMR.character_id)
+        .join(Profile, Profile.id == Character.profile_id)
+        .where(
+            (Profile.region_id == region_id),
+            or_(
+                ingested_between(CharacterMMR.created_timestamp, since, until),
+                # Rows from before ingestion times were kept, by the date watermark they used to be exported by
+                and_(
+                    (CharacterMMR.created_timestamp == None),  # noqa E711
+                    (CharacterMMR.date > since),
+                    (CharacterMMR.date <= until),
+                ),
+            ),
+        )
+        .order_by(CharacterMMR.created_timestamp, CharacterMMR.date)
+    )
+
+
+def match_stmt(region_id, season_id, since, until):
+    return (
+        select(
+            cast(Match.id, String),
+            cast(Match.profile_id, String),
+            cast(Match.game_id, String),
+            Match.map,
+            Match.type,
+            Match.decision,
+            Match.speed,
+            Match.start_timestamp,
+            Match.end_timestamp,
+            Match.inferred,
+        )
+        .join(Profile, Profile.id == Match.profile_id)
+        .where((Profile.region_id == region_id), ingested_between(Match.created_timestamp, since, until))
+        .order_by(Match.created_timestamp)
+    )
+
+
+def game_stmt(region_id, season_id, since, until):
+    region_games = (
+        select(Match.game_id)
+        .join(Profile, Profile.id == Match.profile_id)
+        .where((Profile.region_id == region_id), (Match.game_id != None))  # noqa E711
+    )
+    return (
+        select(cast(Game.id, String), Game.start_timestamp, Game.end_timestamp)
+        .where((Game.id.in_(region_games)), ingested_between(Game.created_timestamp, since, until))
+        .order_by(Game.created_timestamp)
+    )
+
+
+EXPORTS = [
+    (LADDER_MEMBER_EXPORT, ladder_member_stmt),
+    (CHARACTER_MMR_EXPORT, character_mmr_stmt),
+    (MATCH_EXPORT, match_stmt),
+    (GAME_EXPORT, game_stmt),
+]
+
+
+def export_table(session, table, stmt, path, run_timestamp):
+    """
+    Stream rows through a server-side cursor into Parquet row groups. Only one batch
+    of rows is held in memory at a time.
+    """
+    rows_written = 0
+    file_path = path / f"part-{run_timestamp}.parquet"
+    writer = None
+
+    try:
+        result = session.execute(stmt.execution_options(yield_per=EXPORT_BATCH_SIZE))
+        for rows in result.partitions():
+            columns = list(zip(*rows))
+            batch = pa.RecordBatch.from_arrays(
+                [pa.array(column, type=field.type) for column, field in zip(columns, table.schema)],
+                schema=table.schema,
+            )
+            if writer is None:
+                path.mkdir(parents=True, exist_ok=True)
+                writer = pq.ParquetWriter(file_path, table.schema, compression="zstd")
+
+            writer.write_batch(batch)
+            rows_written += batch.num_rows
+    finally:
+        if writer is not None:
+            writer.close()
+
+    return rows_written
+
+
+def export_snapshots(**kwargs):
+    logger.info("Starting export of Parquet snapshots...")
+    start = datetime.now()
+
+    region_id = kwargs.get("region_id")
+    if not region_id:
+        logger.warning("Missing required param region_id")
+        return
+
+    run_timestamp = current_epoch_time()
+    date = datetime.fromtimestamp(run_timestamp).strftime("%Y-%m-%d")
+    # Incremental tables are exported up to until, leaving time for writes in flight to commit
+    until = run_timestamp - EXPORT_SETTLE_SECONDS
+    watermarks = read_watermarks(region_id)
+    with session_scope() as session:
+        season_id = session.query(func.max(League.season_id)).filter(League.region_id == region_id).scalar()
+        if season_id is None:
+            logger.warning(f"No leagues found for {region_id=}. Skipping export.")
+            return
+
+        for table, stmt_func in EXPORTS:
+            since = watermarks.get(table.name, 0)
+            path = partition_path(table, region_id=region_id, season_id=season_id, date=date)
+            rows_written = export_table(
+                session,
+                table=table,
+                stmt=stmt_func(region_id=region_id, season_id=season_id, since=since, until=until),
+                path=path,
+                run_timestamp=run_timestamp,
+            )
+            logger.info(f"Exported {rows_written} {table.name} rows to {path}.")
+
+            if table.incremental_key:
+                watermarks[table.name] = until
+                write_watermarks(region_id, watermarks)
+
+    end = datetime.now()
+    logger.info(f"Exporting snapshots took {round(end.timestamp() - start.timestamp())} seconds.")
+    logger.info("Done with export of Parquet snapshots.")
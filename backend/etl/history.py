@@ -0,0 +1,196 @@
+"""
+Point in time ladder standings. Each sweep that changes a ladder writes one LadderHistory
+row holding only the fields that changed per member, so storage grows with activity
+rather than members times sweeps. A keyframe with every member is written at most every
+LADDER_HISTORY_KEYFRAME_INTERVAL, so reconstructing a ladder at any time reads one
+keyframe and at most an interval of deltas. A member who left the ladder is recorded in a
+delta as a null tombstone.
+"""
+
+from enum import Enum
+
+from more_itertools import only
+
+from backend.db.db import bulk_insert, insert_stmt, query
+from backend.db.model import LadderHistory, LadderMember, Profile
+from backend.static import LADDER_HISTORY_FIELDS, LADDER_HISTORY_KEYFRAME_INTERVAL
+from backend.utils.ids import uuid7
+from backend.utils.log import get_logger
+
+logger = get_logger(__name__)
+
+
+def history_key(realm_id, profile_id, join_timestamp):
+    """Member key within a ladder, Blizzard identities so no profile lookup is needed"""
+    return f"{realm_id}_{profile_id}_{join_timestamp}"
+
+
+def field_value(value):
+    return value.value if isinstance(value, Enum) else value
+
+
+def member_history_key(ladder_member):
+    """Member key of a legacy API ladder member"""
+    character = ladder_member.character
+    return history_key(character.realm_id, character.profile_id, ladder_member.join_timestamp)
+
+
+def member_state(ladder_member):
+    """(member key, {field: value}) of a legacy API ladder member"""
+    return member_history_key(ladder_member), {
+        field: field_value(getattr(ladder_member, field)) for field in LADDER_HISTORY_FIELDS
+    }
+
+
+def member_delta(previous, current):
+    return {field: value for field, value in current.items() if field not in previous or previous[field] != value}
+
+
+def recent_keyframes(session, timestamp):
+    """Ids of the ladders with a keyframe recent enough that the next sweep needs none"""
+    return {
+        ladder_id
+        for (ladder_id,) in query(
+            session,
+            params=[LadderHistory.ladder_id],
+            filters=[
+                (LadderHistory.keyframe.is_(True)),
+                (LadderHistory.timestamp > timestamp - LADDER_HISTORY_KEYFRAME_INTERVAL),
+            ],
+            distinct={LadderHistory.ladder_id},
+        )
+    }
+
+
+def stored_states(session, ladder_ids):
+    """{ladder id: {member key: {field: value}}} as currently stored in ladder_member"""
+    states = {}
+    rows = query(
+        session,
+        params=[
+            LadderMember.ladder_id,
+            Profile.realm_id,
+            Profile.profile_id,
+            LadderMember.join_timestamp,
+            *(getattr(LadderMember, field) for field in LADDER_HISTORY_FIELDS),
+        ],
+        joins=[(Profile, Profile.id == LadderMember.profile_id)],
+        filters=[(LadderMember.ladder_id.in_(ladder_ids))],
+    )
+    for ladder_id, realm_id, profile_id, join_timestamp, *values in rows:
+        states.setdefault(ladder_id, {})[history_key(realm_id, profile_id, join_timestamp)] = {
+            field: field_value(value) for field, value in zip(LADDER_HISTORY_FIELDS, values)
+        }
+    return states
+
+
+def replay(keyframe, deltas):
+    """{member key: {field: value}} of a keyframe's members with deltas applied in order"""
+    standings = {key: dict(state) for key, state in keyframe.items()}
+    for members in deltas:
+        for key, delta in members.items():
+            if delta is None:
+                standings.pop(key, None)
+            else:
+                standings.setdefault(key, {}).update(delta)
+    return standings
+
+
+def recorded_standings(session, ladder_ids):
+    """{ladder id: standings} as last recorded, of many ladders in one query per kind of row"""
+    keyframes = {
+        row.ladder_id: row
+        for row in query(
+            session,
+            params=[LadderHistory.ladder_id, LadderHistory.timestamp, LadderHistory.members],
+            filters=[(LadderHistory.ladder_id.in_(ladder_ids)), (LadderHistory.keyframe.is_(True))],
+            distinct=[LadderHistory.ladder_id],
+            order_by=(LadderHistory.ladder_id, LadderHistory.timestamp.desc()),
+        )
+    }
+    filters = [(LadderHistory.ladder_id.in_(ladder_ids)), (LadderHistory.keyframe.is_(False))]
+    if len(keyframes) == len(ladder_ids):
+        filters.append(LadderHistory.timestamp > min(row.timestamp for row in keyframes.values()))
+
+    deltas = {ladder_id: [] for ladder_id in ladder_ids}
+    for ladder_id, row_timestamp, members in query(
+        session,
+        params=[LadderHistory.ladder_id, LadderHistory.timestamp, LadderHistory.members],
+        filters=filters,
+        order_by=LadderHistory.timestamp,
+    ):
+        keyframe = keyframes.get(ladder_id)
+        if keyframe is None or row_timestamp > keyframe.timestamp:
+            deltas[ladder_id].append(members)
+
+    return {
+        ladder_id: replay(keyframes[ladder_id].members if ladder_id in keyframes else {}, deltas[ladder_id])
+        for ladder_id in ladder_ids
+    }
+
+
+def record_ladder_history(session, sweeps, timestamp):
+    """
+    Write the history of a sweep, before its ladder members are upserted as the stored
+    members are the previous snapshot. sweeps is {ladder id: (keyframe, {member key:
+    state}, member keys, departed member keys)}, with every member's state for a keyframe
+    and the members that may have changed otherwise. Departed members get a tombstone in
+    a delta, when departed is None they are the recorded members missing from the sweep,
+    so a member already tombstoned is not tombstoned again. Returns (keyframes, deltas)
+    written.
+    """
+    delta_ladder_ids = [ladder_id for ladder_id, (keyframe, *_) in sweeps.items() if not keyframe]
+    previous = stored_states(session, delta_ladder_ids) if delta_ladder_ids else {}
+    replay_ladder_ids = [
+        ladder_id for ladder_id, (keyframe, _, _, departed) in sweeps.items() if not keyframe and departed is None
+    ]
+    recorded = recorded_standings(session, replay_ladder_ids) if replay_ladder_ids else {}
+
+    rows = []
+    deltas = 0
+    for ladder_id, (keyframe, states, members, departed) in sweeps.items():
+        if not keyframe:
+            ladder_previous = previous.get(ladder_id, {})
+            states = {key: member_delta(ladder_previous.get(key, {}), state) for key, state in states.items()}
+            states = {key: delta for key, delta in states.items() if delta}
+            if departed is None:
+                departed = recorded[ladder_id].keys() - members
+            states.update((key, None) for key in departed)
+            if not states:
+                continue
+            deltas += 1
+
+        rows.append(
+            {"id": uuid7(), "ladder_id": ladder_id, "timestamp": timestamp, "keyframe": keyframe, "members": states}
+        )
+
+    if rows:
+        bulk_insert(session, stmt=insert_stmt(model=LadderHistory, values=rows), constraint=None)
+    return len(rows) - deltas, deltas
+
+
+def ladder_standings(session, ladder_id, timestamp):
+    """{member key: {field: value}} of a ladder as of timestamp, empty before its first sweep"""
+    keyframe = only(
+        query(
+            session,
+            params=[LadderHistory.timestamp, LadderHistory.members],
+            filters=[
+                (LadderHistory.ladder_id == ladder_id),
+                (LadderHistory.keyframe.is_(True)),
+                (LadderHistory.timestamp <= timestamp),
+            ],
+            order_by=LadderHistory.timestamp.desc(),
+            limit=1,
+        )
+    )
+    filters = [
+        (LadderHistory.ladder_id == ladder_id),
+        (LadderHistory.keyframe.is_(False)),
+        (LadderHistory.timestamp <= timestamp),
+    ]
+    if keyframe:
+        filters.append(LadderHistory.timestamp > keyframe.timestamp)
+
+    deltas = query(session, params=[LadderHistory.members], filters=filters, order_by=LadderHistory.timestamp)
+    return replay(keyframe.members if keyframe else {}, (members for (members,) in deltas))
@@ -0,0 +1,204 @@
+"""
+Process wide caches of Blizzard identities to internal ids. A profile or character keeps
+its id for good, so entries never go stale. They are only added from committed rows,
+after the transaction that wrote them, so a rolled back insert is never cached.
+"""
+
+import sys
+from collections import OrderedDict
+from datetime import datetime
+from threading import Lock
+
+from sqlalchemy import tuple_
+
+from backend.db.db import query, session_scope
+from backend.db.model import Character, Profile
+from backend.static import (
+    CHARACTER_IDENTITY_CACHE_BYTES,
+    PROFILE_BATCH_SIZE,
+    PROFILE_IDENTITY_CACHE_BYTES,
+)
+from backend.utils.log import get_logger
+
+logger = get_logger(__name__)
+
+ENTRY_OVERHEAD = 100  # Bytes of an OrderedDict entry besides its key and value
+
+
+def entry_size(key, value):
+    size = ENTRY_OVERHEAD + sys.getsizeof(key) + sys.getsizeof(value)
+    for part in (key if isinstance(key, tuple) else ()) + (value if isinstance(value, tuple) else ()):
+        size += sys.getsizeof(part)
+    return size
+
+
+class IdentityCache:
+    """LRU of key -> id, evicting the least recently used entries above max_bytes"""
+
+    def __init__(self, name, max_bytes):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.sizes = {}
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def get_many(self, keys):
+        """({key: id} of cached keys, [keys missing])"""
+        found = {}
+        missing = []
+        for key in keys:
+            value = self.get(key)
+            if value is None:
+                missing.append(key)
+            else:
+                found[key] = value
+        return found, missing
+
+    def set(self, key, value):
+        """Add an entry. Returns False once the cache is full and had to evict."""
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return True
+
+            size = entry_size(key, value)
+            self.entries[key] = value
+            self.sizes[key] = size
+            self.bytes += size
+            evicted = False
+            while self.bytes > self.max_bytes and self.entries:
+                old_key, _ = self.entries.popitem(last=False)
+                self.bytes -= self.sizes.pop(old_key)
+                self.evictions += 1
+                evicted = True
+            return not evicted
+
+    def set_many(self, entries):
+        for key, value in entries.items():
+            self.set(key, value)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "megabytes": round(self.bytes / 1024 / 1024, 1),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+                "evictions": self.evictions,
+            }
+
+
+# (region_id, realm_id, profile_id) -> Profile.id
+ProfileIdentities = IdentityCache("profile", PROFILE_IDENTITY_CACHE_BYTES)
+# (region_id, realm_id, profile_id, display_name) -> (Character.id, Profile.id)
+CharacterIdentities = IdentityCache("character", CHARACTER_IDENTITY_CACHE_BYTES)
+
+
+def identity_stats():
+    return {cache.name: cache.stats() for cache in (ProfileIdentities, CharacterIdentities)}
+
+
+def profile_ids(session, keys):
+    """
+    {(region_id, realm_id, profile_id): Profile.id} of the keys that exist, querying only
+    the keys not cached. Ids read are cached, they are committed rows.
+    """
+    found, missing = ProfileIdentities.get_many(set(keys))
+    if missing:
+        loaded = {
+            (region_id, realm_id, profile_id): id
+            for id, region_id, realm_id, profile_id in query(
+                session,
+                params=[Profile.id, Profile.region_id, Profile.realm_id, Profile.profile_id],
+                filters=[(tuple_(Profile.region_id, Profile.realm_id, Profile.profile_id).in_(missing))],
+            )
+        }
+        ProfileIdentities.set_many(loaded)
+        found.update(loaded)
+    return found
+
+
+def character_identities(session, keys):
+    """
+    {(region_id, realm_id, profile_id, display_name): (Character.id, Profile.id)} of the
+    characters that exist, querying only the keys not cached
+    """
+    found, missing = CharacterIdentities.get_many(set(keys))
+    if missing:
+        key = tuple_(Profile.region_id, Profile.realm_id, Profile.profile_id, Character.display_name)
+        loaded = {
+            (region_id, realm_id, profile_id, display_name): (id, profile_uuid)
+            for id, profile_uuid, region_id, realm_id, profile_id, display_name in query(
+                session,
+                params=[
+                    Character.id,
+                    Character.profile_id,
+                    Profile.region_id,
+                    Profile.realm_id,
+                    Profile.profile_id,
+                    Character.display_name,
+                ],
+                joins=[(Profile, Profile.id == Character.profile_id)],
+                filters=[(key.in_(missing))],
+            )
+        }
+        CharacterIdentities.set_many(loaded)
+        found.update(loaded)
+    return found
+
+
+def warm_identity_cache(**kwargs):
+    """Bulk load identities until the caches are full, most recently polled profiles first"""
+    logger.info("Starting warm up of identity caches...")
+    start = datetime.now()
+
+    with session_scope() as session:
+        profiles = query(
+            session,
+            params=[Profile.id, Profile.region_id, Profile.realm_id, Profile.profile_id],
+            order_by=[Profile.match_history_polled_timestamp.desc().nulls_last()],
+            yield_per=PROFILE_BATCH_SIZE,
+        )
+        for id, region_id, realm_id, profile_id in profiles:
+            if not ProfileIdentities.set((region_id, realm_id, profile_id), id):
+                break
+
+        characters = query(
+            session,
+            params=[
+                Character.id,
+                Character.profile_id,
+                Character.display_name,
+                Profile.region_id,
+                Profile.realm_id,
+                Profile.profile_id,
+            ],
+            joins=[(Profile, Profile.id == Character.profile_id)],
+            order_by=[Profile.match_history_polled_timestamp.desc().nulls_last()],
+            yield_per=PROFILE_BATCH_SIZE,
+        )
+        for id, profile_uuid, display_name, region_id, realm_id, profile_id in characters:
+            if not CharacterIdentities.set((region_id, realm_id, profile_id, display_name), (id, profile_uuid)):
+                break
+
+    end = datetime.now()
+    logger.info(f"Identity caches: {identity_stats()}")
+    logger.info(f"Warming identity caches took {round(end.timestamp() - start.timestamp())} seconds.")
+    logger.info("Done with warm up of identity caches.")
@@ -0,0 +1,158 @@
+"""
+Infer played matches from consecutive ladder team observations (MMR, wins, losses, points)
+"""
+
+import uuid
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+
+from backend.db.model import Match
+from backend.enums import Decision
+from backend.static import INFERENCE_MAX_GAMES, MATCH_SPEED
+from backend.utils.datetime import current_epoch_time
+from backend.utils.ids import uuid7
+
+
+@dataclass
+class TeamObservation:
+    """A ladder team as seen on this poll and as last recorded for the same character/race"""
+
+    profile_id: uuid.UUID
+    match_type: str
+    mmr: int
+    wins: Optional[int]
+    losses: Optional[int]
+    points: Optional[int]
+    date: int
+    previous_mmr: Optional[int] = None
+    previous_wins: Optional[int] = None
+    previous_losses: Optional[int] = None
+    previous_points: Optional[int] = None
+    previous_date: Optional[int] = None
+    team_id: Optional[uuid.UUID] = None
+
+
+@dataclass
+class InferenceStats:
+    observations: int = 0
+    games: int = 0
+    from_counters: int = 0
+    from_mmr: int = 0
+    mmr_disagreements: int = 0
+    truncated: int = 0
+
+
+def as_array(observations, attribute, dtype=np.int64):
+    """Column of observation attribute with None encoded as -1"""
+    return np.fromiter(
+        (
+            -1 if getattr(observation, attribute) is None else getattr(observation, attribute)
+            for observation in observations
+        ),
+        dtype=dtype,
+        count=len(observations),
+    )
+
+
+def infer_match_counts(mmr, previous_mmr, wins, previous_wins, losses, previous_losses, points, previous_points):
+    """
+    Number of wins and losses played between two observations of each team.
+
+    The wins/losses counters are authoritative when both observations have them and
+    they moved forward. Otherwise (first sighting with counters, season rollover, API
+    omitting counters) fall back to a single game whose result is the sign of the MMR or
+    points delta. Returns (wins, losses, from_counters, mmr_disagrees).
+    """
+    counters_known = (wins >= 0) & (previous_wins >= 0) & (losses >= 0) & (previous_losses >= 0)
+    win_delta = np.where(counters_known, wins - previous_wins, 0)
+    loss_delta = np.where(counters_known, losses - previous_losses, 0)
+    from_counters = counters_known & (win_delta >= 0) & (loss_delta >= 0) & (win_delta + loss_delta > 0)
+
+    mmr_known = (mmr >= 0) & (previous_mmr >= 0)
+    points_known = (points >= 0) & (previous_points >= 0)
+    delta = np.where(mmr_known, mmr - previous_mmr, 0)
+    delta = np.where((delta == 0) & points_known, points - previous_points, delta)
+    from_mmr = ~from_counters & (delta != 0)
+
+    inferred_wins = np.where(from_counters, win_delta, (from_mmr & (delta > 0)).astype(np.int64))
+    inferred_losses = np.where(from_counters, loss_delta, (from_mmr & (delta < 0)).astype(np.int64))
+
+    # A single game must move MMR in the direction of its result
+    single_game = from_counters & (inferred_wins + inferred_losses == 1) & mmr_known
+    mmr_disagrees = single_game & (((inferred_wins == 1) & (delta < 0)) | ((inferred_losses == 1) & (delta > 0)))
+
+    return inferred_wins, inferred_losses, from_counters, mmr_disagrees
+
+
+def infer_matches(observations, max_games=INFERENCE_MAX_GAMES):
+    """
+    Expand a batch of team observations into Match rows, vectorized over all teams.
+
+    The profile ladder API does not report when each game ended, so every game is
+    recorded with the poll interval it was played in, (start_timestamp, end_timestamp],
+    and marked inferred.
+    """
+    stats = InferenceStats(observations=len(observations))
+    if not observations:
+        return [], stats
+
+    wins, losses, from_counters, mmr_disagrees = infer_match_counts(
+        mmr=as_array(observations, "mmr"),
+        previous_mmr=as_array(observations, "previous_mmr"),
+        wins=as_array(observations, "wins"),
+        previous_wins=as_array(observations, "previous_wins"),
+        losses=as_array(observations, "losses"),
+        previous_losses=as_array(observations, "previous_losses"),
+        points=as_array(observations, "points"),
+        previous_points=as_array(observations, "previous_points"),
+    )
+
+    games = wins + losses
+    truncated = games > max_games
+    scale = np.where(truncated, max_games / np.maximum(games, 1), 1.0)
+    wins = np.floor(wins * scale).astype(np.int64)
+    losses = np.minimum(losses, max_games - wins)
+    games = wins + losses
+
+    stats.games = int(games.sum())
+    stats.from_counters = int((from_counters & (games > 0)).sum())
+    stats.from_mmr = int((~from_counters & (games > 0)).sum())
+    stats.mmr_disagreements = int(mmr_disagrees.sum())
+    stats.truncated = int(truncated.sum())
+    if not stats.games:
+        return [], stats
+
+    date = as_array(observations, "date")
+    previous_date = as_array(observations, "previous_date")
+    previous_date = np.where(previous_date >= 0, previous_date, date)
+
+    # One row per inferred game, k is the game's position within its team's interval
+    team = np.repeat(np.arange(len(observations)), games)
+    offsets = np.cumsum(games) - games
+    k = np.arange(stats.games) - offsets[team]
+    is_win = k < wins[team]
+
+    created = current_epoch_time()
+    matches = []
+    for index, win in zip(team.tolist(), is_win.tolist()):
+        observation = observations[index]
+        matches.append(
+            Match(
+                **{
+                    "id": uuid7(),
+                    "type": observation.match_type,
+                    "speed": MATCH_SPEED,
+                    "decision": (Decision.WIN if win else Decision.LOSS).value,
+                    "start_timestamp": int(previous_date[index]),
+                    "end_timestamp": int(date[index]),
+                    "created_timestamp": created,
+                    "inferred": True,
+                    "profile_id": observation.profile_id,
+                    "team_id": observation.team_id,
+                }
+            )
+        )
+
+    return matches, stats
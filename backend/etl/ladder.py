@@ -2,11 +2,10 @@
 ETL processes associated with SC2 ladders
 """
 
-import uuid
 from dataclasses import dataclass
 from datetime import datetime
 
-from backend.api.blizzard import BlizzardApi
+from backend.api.blizzard import ApiUnavailableError, BlizzardApi
 from backend.api.models.game_data import LeagueResponse
 from backend.api.models.ladder import SeasonResponse
 from backend.db.db import (
@@ -17,10 +16,13 @@ from backend.db.db import (
     session_scope,
 )
 from backend.db.model import Ladder, League
-from backend.enums import LeagueId, QueueId, TeamType
+from backend.enums import LeagueId, QueueId, RetryKind
+from backend.etl.retry import Deferral, defer_requests, is_deferrable
 from backend.static import LADDER_UNIQUE_CONSTRAINT
-from backend.utils.concurrency import yield_futures
+from backend.utils.concurrency import Stage, pipeline, thread_pool_max_workers
+from backend.utils.ids import uuid7
 from backend.utils.log import get_logger
+from backend.utils.tracing import span
 
 logger = get_logger(__name__)
 
@@ -36,24 +38,27 @@ class LeagueFuture:
 
 def get_league_wrapper(league_future):
     api = BlizzardApi()
-    return LeagueResponse.model_validate(
-        api.get_league(
-            region_id=league_future.region_id,
-            season_id=league_future.season_id,
-            queue_id=league_future.queue_id,
-            team_type=league_future.team_type,
-            league_id=league_future.league_id,
-        )
+    return api.get_league(
+        region_id=league_future.region_id,
+        season_id=league_future.season_id,
+        queue_id=league_future.queue_id,
+        team_type=league_future.team_type,
+        league_id=league_future.league_id,
     )
 
 
-def process_leagues(region_id):
+def process_leagues(region_id, limit=None):
     api = BlizzardApi()
     leagues = []
 
-    season = SeasonResponse.model_validate(api.get_ladder_season(region_id=region_id))
+    try:
+        season = SeasonResponse.model_validate(api.get_ladder_season(region_id=region_id))
+    except ApiUnavailableError as e:
+        logger.warning(f"Season unavailable for region {region_id}, skipping this run: {e!r}")
+        return
+
     for queue in QueueId:
-        for team in TeamType:
+        for team in queue.team_types:
             for league in LeagueId:
                 leagues.append(
                     LeagueFuture(
@@ -65,9 +70,80 @@ def process_leagues(region_id):
                     )
                 )
 
-    for result, league in yield_futures(get_league_wrapper, leagues):
-        result.region_id = league.region_id
-        yield result
+    if limit is not None:
+        leagues = leagues[:limit]
+
+    stages = [
+        Stage(get_league_wrapper, workers=thread_pool_max_workers(), name="fetch"),
+        Stage(LeagueResponse.model_validate, name="validate"),
+    ]
+    deferrals = []
+    for item in pipeline(leagues, stages=stages):
+        if not item.ok:
+            logger.error(f"Failed to {item.stage} league {item.arg}: {item.error!r}")
+            if is_deferrable(item.error):
+                deferrals.append(Deferral(kind=RetryKind.LEAGUE.value, future=item.arg, error=item.error))
+            continue
+
+        item.value.region_id = item.arg.region_id
+        yield item.value
+
+    defer_requests(deferrals)
+
+
+def upsert_league(league_response):
+    """Create the league if needed and upsert the ratings and sizes of its ladders"""
+    if not league_response or not league_response.key:
+        return
+
+    with span("write"), session_scope() as session:
+        league = get_or_create(
+            session,
+            model=League,
+            filter={
+                "region_id": league_response.region_id,
+                "league_id": league_response.key.league_id,
+                "season_id": league_response.key.season_id,
+                "queue_id": league_response.key.queue_id,
+                "team_type": league_response.key.team_type,
+            },
+            values={
+                "region_id": league_response.region_id,
+                "league_id": league_response.key.league_id,
+                "season_id": league_response.key.season_id,
+                "queue_id": league_response.key.queue_id,
+                "team_type": league_response.key.team_type,
+            },
+        )
+
+        ladders = []
+        for league_tier in league_response.tier:
+            for league_division in league_tier.division:
+                ladders.append(
+                    Ladder(
+                        **{
+                            "id": uuid7(),
+                            "ladder_id": league_division.ladder_id,
+                            "region_id": league_response.region_id,
+                            "min_rating": league_tier.min_rating,
+                            "max_rating": league_tier.max_rating,
+                            "member_count": league_division.member_count,
+                            "league_id": league.id,
+                        }
+                    ),
+                )
+        if ladders:
+            stmt = insert_stmt(model=Ladder, values=orm_classes_as_dict(ladders))
+            bulk_upsert(
+                session,
+                stmt=stmt,
+                constraint=LADDER_UNIQUE_CONSTRAINT,
+                set_={
+                    "min_rating": stmt.excluded.min_rating,
+                    "max_rating": stmt.excluded.max_rating,
+                    "member_count": stmt.excluded.member_count,
+                },
+            )
 
 
 def get_ladders(**kwargs):
@@ -79,56 +155,8 @@ def get_ladders(**kwargs):
         logger.warning("Missing required param region_id")
         return
 
-    for league_response in process_leagues(region_id=region_id):
-        if league_response and league_response.key:
-            with session_scope() as session:
-                league = get_or_create(
-                    session,
-                    model=League,
-                    filter={
-                        "region_id": league_response.region_id,
-                        "league_id": league_response.key.league_id,
-                        "season_id": league_response.key.season_id,
-                        "queue_id": league_response.key.queue_id,
-                        "team_type": league_response.key.team_type,
-                    },
-                    values={
-                        "region_id": league_response.region_id,
-                        "league_id": league_response.key.league_id,
-                        "season_id": league_response.key.season_id,
-                        "queue_id": league_response.key.queue_id,
-                        "team_type": league_response.key.team_type,
-                    },
-                )
-
-                ladders = []
-                for league_tier in league_response.tier:
-                    for league_division in league_tier.division:
-                        ladders.append(
-                            Ladder(
-                                **{
-                                    "id": uuid.uuid4(),
-                                    "ladder_id": league_division.ladder_id,
-                                    "region_id": league_response.region_id,
-                                    "min_rating": league_tier.min_rating,
-                                    "max_rating": league_tier.max_rating,
-                                    "member_count": league_division.member_count,
-                                    "league_id": league.id,
-                                }
-                            ),
-                        )
-                if ladders:
-                    stmt = insert_stmt(model=Ladder, values=orm_classes_as_dict(ladders))
-                    bulk_upsert(
-                        session,
-                        stmt=stmt,
-                        constraint=LADDER_UNIQUE_CONSTRAINT,
-                        set_={
-                            "min_rating": stmt.excluded.min_rating,
-                            "max_rating": stmt.excluded.max_rating,
-                            "member_count": stmt.excluded.member_count,
-                        },
-                    )
+    for league_response in process_leagues(region_id=region_id, limit=kwargs.get("limit")):
+        upsert_league(league_response)
 
     end = datetime.now()
     logger.info(f"Updating leagues and ladders took {round(end.timestamp() - start.timestamp())} seconds.")
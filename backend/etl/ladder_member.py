@@ -6,8 +6,11 @@ import time
 import uuid
 from dataclasses import dataclass
 from datetime import datetime
+from typing import Optional
 
-from backend.api.blizzard import BlizzardApi
+from sqlalchemy import update
+
+from backend.api.blizzard import ApiUnavailableError, BlizzardApi, DeadlineExceededError
 from backend.api.models.ladder import SeasonResponse
 from backend.api.models.legacy import LegacyLadderResponse
 from backend.db.db import (
@@ -19,13 +22,29 @@ from backend.db.db import (
     session_scope,
 )
 from backend.db.model import Character, Ladder, LadderMember, League, Profile
+from backend.enums import RetryKind
+from backend.etl.history import (
+    history_key,
+    member_history_key,
+    member_state,
+    recent_keyframes,
+    record_ladder_history,
+)
+from backend.etl.identity import ProfileIdentities
+from backend.etl.retry import Deferral, defer_requests, is_deferrable
+from backend.etl.snapshot import LadderMemberCache, content_hash
 from backend.static import (
     CHARACTER_UNIQUE_CONSTRAINT,
     LADDER_BATCH_SIZE,
     LADDER_MEMBER_UNIQUE_CONSTRAINT,
 )
-from backend.utils.concurrency import yield_futures
+from backend.utils.concurrency import Stage, pipeline, thread_pool_max_workers
+from backend.utils.datetime import current_epoch_time
+from backend.utils.deadline import ResumeCursors
+from backend.utils.ids import uuid7
 from backend.utils.log import get_logger
+from backend.utils.metrics import Metrics
+from backend.utils.tracing import span
 
 logger = get_logger(__name__)
 
@@ -35,120 +54,216 @@ class LadderFuture:
     id: uuid.UUID
     region_id: int
     ladder_id: int
+    content_hash: Optional[str] = None
+
+
+@dataclass
+class LadderPayload:
+    future: LadderFuture
+    payload: dict
+    content_hash: str
 
 
 def get_legacy_ladder_wrapper(ladder_future):
     api = BlizzardApi()
-    return LegacyLadderResponse.model_validate(
-        api.get_legacy_ladder(region_id=ladder_future.region_id, ladder_id=ladder_future.ladder_id)
-    )
+    return api.get_legacy_ladder(region_id=ladder_future.region_id, ladder_id=ladder_future.ladder_id)
+
+
+def fetch_ladder_payload(ladder_future):
+    payload = get_legacy_ladder_wrapper(ladder_future)
+    return LadderPayload(future=ladder_future, payload=payload, content_hash=content_hash(payload))
 
 
-def process_ladder(region_id):
+def validate_changed_ladder(ladder_payload):
+    """None when the payload is identical to the one last written, so it is never validated"""
+    if ladder_payload.content_hash == ladder_payload.future.content_hash:
+        return None
+
+    response = LegacyLadderResponse.model_validate(ladder_payload.payload)
+    response.content_hash = ladder_payload.content_hash
+    return response
+
+
+def process_ladder(region_id, limit=None):
     processed = 0
+    unchanged = 0
+    deferrals = []
     batch_start = time.time()
 
     api = BlizzardApi()
-    season = SeasonResponse.model_validate(api.get_ladder_season(region_id=region_id))
+    try:
+        season = SeasonResponse.model_validate(api.get_ladder_season(region_id=region_id))
+    except ApiUnavailableError as e:
+        logger.warning(f"Season unavailable for region {region_id}, skipping this run: {e!r}")
+        return
+
+    # Ladders are walked in ladder_id order, resuming where a run cut off by its deadline stopped
+    filters = [(Ladder.region_id == region_id), (League.season_id == season.season_id)]
+    cursor_key = ("ladder_members", region_id, season.season_id)
+    cursor = ResumeCursors.get(cursor_key)
+    if cursor is not None:
+        logger.info(f"Resuming ladder members of {region_id=} from ladder {cursor}.")
+        filters.append(Ladder.ladder_id >= cursor)
+    cut = []
+
     with session_scope() as session:
         ladders = query(
             session,
-            params={Ladder},
+            params=[Ladder.id, Ladder.ladder_id, Ladder.region_id, Ladder.content_hash],
             joins=[(League, League.id == Ladder.league_id)],
-            filters=[(Ladder.region_id == region_id), (League.season_id == season.season_id)],
+            filters=filters,
+            order_by=Ladder.ladder_id,
+            limit=limit,
+            yield_per=LADDER_BATCH_SIZE,
         )
-        ladder_futures = [
-            LadderFuture(id=ladder.id, ladder_id=ladder.ladder_id, region_id=ladder.region_id) for ladder in ladders
+        ladder_futures = (
+            LadderFuture(
+                id=ladder.id,
+                ladder_id=ladder.ladder_id,
+                region_id=ladder.region_id,
+                content_hash=ladder.content_hash,
+            )
+            for ladder in ladders
+        )
+
+        stages = [
+            Stage(fetch_ladder_payload, workers=thread_pool_max_workers(), name="fetch"),
+            Stage(validate_changed_ladder, name="validate"),
         ]
+        for item in pipeline(ladder_futures, stages=stages):
+            if processed != 0 and processed % LADDER_BATCH_SIZE == 0:
+                logger.info(
+                    f"Have fetched {processed} ladders. " f"Last batch took {round(time.time() - batch_start)} seconds."
+                )
+                batch_start = time.time()
 
-    for result, ladder_future in yield_futures(func=get_legacy_ladder_wrapper, iterable=ladder_futures):
-        if processed != 0 and processed % LADDER_BATCH_SIZE == 0:
-            logger.info(
-                f"Have fetched {processed} ladders. " f"Last batch took {round(time.time() - batch_start)} seconds."
-            )
-            batch_start = time.time()
+            processed += 1
+            if not item.ok:
+                logger.error(f"Failed to {item.stage} ladder {item.arg}: {item.error!r}")
+                if isinstance(item.error, DeadlineExceededError):
+                    cut.append(item.arg.ladder_id)
+                elif is_deferrable(item.error):
+                    deferrals.append(Deferral(kind=RetryKind.LEGACY_LADDER.value, future=item.arg, error=item.error))
+                continue
 
-        if not ladder_future.id:
-            print("HERE I AM")
-            print(ladder_future)
+            if item.value is None:
+                unchanged += 1
+                continue
 
-        result.ladder_id = ladder_future.id
-        yield result
-        processed += 1
-    logger.info(f"Done with fetch of ladders. Fetched {processed} total ladders.")
+            item.value.ladder_id = item.arg.id
+            yield item.value
 
+    defer_requests(deferrals)
+    ResumeCursors.update(cursor_key, cut)
 
-def get_ladder_members(**kwargs):
-    logger.info("Starting fetch of ladder members (characters)...")
-    start = datetime.now()
+    Metrics.increment("ladders.unchanged", unchanged)
+    logger.info(f"Done with fetch of ladders. Fetched {processed} total ladders, {unchanged} unchanged.")
+
+
+def insert_ladder_members(ladder_responses):
+    """
+    Get or create the profiles of changed ladder members then upsert their characters and
+    ladder members. Members identical to the ladder's previous snapshot are skipped.
+    """
     processed_ladder_members = 0
+    unchanged_ladder_members = 0
     characters = []
     spent_characters = set()
     spent_ladder_members = set()
     ladder_members = []
+    snapshots = {}
+    content_hashes = []
+    sweeps = {}
+    timestamp = current_epoch_time()
+    with session_scope() as session:
+        keyframed = recent_keyframes(session, timestamp)
 
-    region_id = kwargs.get("region_id")
-    if not region_id:
-        logger.warning("Missing required param region_id")
-        return
-
-    for ladder_response in process_ladder(region_id=region_id):
+    for ladder_response in ladder_responses:
         logger.info(f"Got response for ladder {ladder_response.ladder_id}...")
-        for ladder_member in ladder_response.ladder_members:
-            with session_scope() as session:
-                profile = get_or_create(
-                    session,
-                    model=Profile,
-                    filter={
-                        "profile_id": ladder_member.character.profile_id,
-                        "realm_id": ladder_member.character.realm_id,
-                        "region_id": ladder_member.character.region_id,
-                    },
-                    values={
-                        "profile_id": ladder_member.character.profile_id,
-                        "realm_id": ladder_member.character.realm_id,
-                        "region_id": ladder_member.character.region_id,
-                    },
+        changed, snapshots[ladder_response.ladder_id] = LadderMemberCache.changed(
+            ladder_response.ladder_id, ladder_response.ladder_members
+        )
+        departed = LadderMemberCache.departed(ladder_response.ladder_id, snapshots[ladder_response.ladder_id])
+        unchanged_ladder_members += len(ladder_response.ladder_members) - len(changed)
+        if ladder_response.content_hash:
+            content_hashes.append({"id": ladder_response.ladder_id, "content_hash": ladder_response.content_hash})
+        if changed or departed:
+            keyframe = ladder_response.ladder_id not in keyframed
+            sweeps[ladder_response.ladder_id] = (
+                keyframe,
+                dict(member_state(member) for member in (ladder_response.ladder_members if keyframe else changed)),
+                {member_history_key(member) for member in ladder_response.ladder_members},
+                departed if departed is None else {history_key(*key[1:]) for key in departed},
+            )
+
+        for ladder_member in changed:
+            profile_key = (
+                ladder_member.character.region_id,
+                ladder_member.character.realm_id,
+                ladder_member.character.profile_id,
+            )
+            profile_id = ProfileIdentities.get(profile_key)
+            if profile_id is None:
+                with session_scope() as session:
+                    profile_id = get_or_create(
+                        session,
+                        model=Profile,
+                        filter={
+                            "profile_id": ladder_member.character.profile_id,
+                            "realm_id": ladder_member.character.realm_id,
+                            "region_id": ladder_member.character.region_id,
+                        },
+                        values={
+                            "profile_id": ladder_member.character.profile_id,
+                            "realm_id": ladder_member.character.realm_id,
+                            "region_id": ladder_member.character.region_id,
+                        },
+                    ).id
+                ProfileIdentities.set(profile_key, profile_id)
+
+            character_lookup_key = f"{profile_id}_{ladder_member.character.display_name}"
+            if character_lookup_key not in spent_characters:
+                character = Character(
+                    **{
+                        "id": uuid7(),
+                        "display_name": ladder_member.character.display_name,
+                        "clan_name": ladder_member.character.clan_name,
+                        "clan_tag": ladder_member.character.clan_tag,
+                        "profile_path": ladder_member.character.profile_path,
+                        "profile_id": profile_id,
+                    }
                 )
-                character_lookup_key = f"{profile.id}_{ladder_member.character.display_name}"
-                if character_lookup_key not in spent_characters:
-                    character = Character(
-                        **{
-                            "id": uuid.uuid4(),
-                            "display_name": ladder_member.character.display_name,
-                            "clan_name": ladder_member.character.clan_name,
-                            "clan_tag": ladder_member.character.clan_tag,
-                            "profile_path": ladder_member.character.profile_path,
-                            "profile_id": profile.id,
-                        }
-                    )
-                    characters.append(character)
-                    spent_characters.add(character_lookup_key)
-
-                ladder_member_lookup_key = (
-                    f"{ladder_member.character.profile_id}_{ladder_response.ladder_id}_{ladder_member.join_timestamp}"
+                characters.append(character)
+                spent_characters.add(character_lookup_key)
+
+            ladder_member_lookup_key = (
+                f"{ladder_member.character.profile_id}_{ladder_response.ladder_id}_{ladder_member.join_timestamp}"
+            )
+            if ladder_member_lookup_key not in spent_ladder_members:
+                ladder_member = LadderMember(
+                    **{
+                        "id": uuid7(),
+                        "join_timestamp": ladder_member.join_timestamp,
+                        "points": ladder_member.points,
+                        "wins": ladder_member.wins,
+                        "losses": ladder_member.losses,
+                        "highest_rank": ladder_member.highest_rank,
+                        "previous_rank": ladder_member.previous_rank,
+                        "race": ladder_member.race,
+                        "profile_id": profile_id,
+                        "ladder_id": ladder_response.ladder_id,
+                    }
                 )
-                if ladder_member_lookup_key not in spent_ladder_members:
-                    ladder_member = LadderMember(
-                        **{
-                            "id": uuid.uuid4(),
-                            "join_timestamp": ladder_member.join_timestamp,
-                            "points": ladder_member.points,
-                            "wins": ladder_member.wins,
-                            "losses": ladder_member.losses,
-                            "highest_rank": ladder_member.highest_rank,
-                            "previous_rank": ladder_member.previous_rank,
-                            "race": ladder_member.race,
-                            "profile_id": profile.id,
-                            "ladder_id": ladder_response.ladder_id,
-                        }
-                    )
-                    ladder_members.append(ladder_member)
-                    spent_ladder_members.add(ladder_member_lookup_key)
-
-                processed_ladder_members += 1
+                ladder_members.append(ladder_member)
+                spent_ladder_members.add(ladder_member_lookup_key)
+
+            processed_ladder_members += 1
+
+    with span("write"), session_scope() as session:
+        if sweeps:
+            keyframes, deltas = record_ladder_history(session, sweeps, timestamp)
+            logger.info(f"Recorded ladder history: {keyframes} keyframes, {deltas} deltas.")
 
-    with session_scope() as session:
         if characters:
             logger.info(f"Upserting {len(characters)} characters...")
             stmt = insert_stmt(model=Character, values=orm_classes_as_dict(characters))
@@ -178,6 +293,28 @@ def get_ladder_members(**kwargs):
                 },
             )
 
+        if content_hashes:
+            session.execute(update(Ladder), content_hashes)
+
+    for ladder_id, fingerprints in snapshots.items():
+        LadderMemberCache.set(ladder_id, fingerprints)
+
+    Metrics.increment("ladder_members.unchanged", unchanged_ladder_members)
+    logger.info(f"Skipped {unchanged_ladder_members} ladder members unchanged since the last snapshot.")
+    return processed_ladder_members
+
+
+def get_ladder_members(**kwargs):
+    logger.info("Starting fetch of ladder members (characters)...")
+    start = datetime.now()
+
+    region_id = kwargs.get("region_id")
+    if not region_id:
+        logger.warning("Missing required param region_id")
+        return
+
+    processed_ladder_members = insert_ladder_members(process_ladder(region_id=region_id, limit=kwargs.get("limit")))
+
     end = datetime.now()
     logger.info(f"Processed {processed_ladder_members} ladder members.")
     logger.info(f"Processing characters took {round(end.timestamp() - start.timestamp())} seconds.")
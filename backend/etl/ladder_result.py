@@ -4,11 +4,14 @@ ETL processes associated with SC2 ladder results (MMR, Game duration, Etc.)
 
 import time
 import uuid
+from collections import OrderedDict
+from dataclasses import dataclass
 from datetime import datetime
+from threading import Lock
 
 from more_itertools import only
 
-from backend.api.blizzard import BlizzardApi
+from backend.api.blizzard import BlizzardApi, DeadlineExceededError
 from backend.api.models.profile import ProfileLadderResponse
 from backend.db.db import (
     bulk_insert,
@@ -19,69 +22,159 @@ from backend.db.db import (
     session_scope,
 )
 from backend.db.model import (
-    Character,
     CharacterMMR,
     Ladder,
     LadderMember,
+    League,
     Match,
     Profile,
+    Team,
+    TeamMMR,
 )
-from backend.static import CHARACTER_MMR_UNIQUE_CONSTRAINT, LADDER_BATCH_SIZE
-from backend.utils.concurrency import yield_futures
+from backend.enums import QueueId, RetryKind
+from backend.etl.identity import character_identities, profile_ids
+from backend.etl.inference import TeamObservation, infer_matches
+from backend.etl.match import without_superseded_matches
+from backend.etl.retry import Deferral, defer_requests, is_deferrable
+from backend.etl.rollup import rollup_character_mmrs
+from backend.feed.publish import new_batch_id, publish_change
+from backend.static import (
+    CHARACTER_MMR_UNIQUE_CONSTRAINT,
+    LADDER_BATCH_SIZE,
+    LADDER_POLL_CACHE_SIZE,
+    TEAM_MMR_UNIQUE_CONSTRAINT,
+    TEAM_UNIQUE_CONSTRAINT,
+)
+from backend.utils.concurrency import Stage, pipeline, thread_pool_max_workers
 from backend.utils.datetime import current_epoch_time
+from backend.utils.deadline import ResumeCursors
+from backend.utils.ids import uuid7
 from backend.utils.log import get_logger
-
-# TODO refactor this ETL for team types beyond 1v1
+from backend.utils.tracing import span
 
 logger = get_logger(__name__)
+mmr_logger = get_logger(f"{__name__}.mmr")  # Per character messages, sampled
+
+
+class LadderPolls:
+    """
+    Bounded LRU of when each ladder's results were last polled, keyed by (region_id,
+    ladder_id). MMR rows are only stored on change, so the last poll rather than the last
+    row bounds when an inferred game was played.
+    """
+
+    lock = Lock()
+    entries = OrderedDict()
+
+    @classmethod
+    def swap(cls, key, timestamp):
+        """Record a poll of the ladder at timestamp and return the previous one, if known"""
+        with cls.lock:
+            previous = cls.entries.pop(key, None)
+            cls.entries[key] = timestamp
+            while len(cls.entries) > LADDER_POLL_CACHE_SIZE:
+                cls.entries.popitem(last=False)
+            return previous
+
+
+def interval_start(previous_date, last_poll):
+    """Start of the interval games seen in this poll were played in"""
+    return previous_date if last_poll is None else max(previous_date, last_poll)
+
+
+@dataclass
+class ProfileLadderFuture:
+    id: uuid.UUID
+    ladder_id: int
+    queue_id: int
+    team_type: int
+    region_id: int
+    realm_id: int
+    profile_id: int
 
 
 def get_profile_ladder_wrapper(ladder_member):
     api = BlizzardApi()
-    return ProfileLadderResponse.model_validate(
-        api.get_profile_ladder(
-            region_id=ladder_member.region_id,
-            realm_id=ladder_member.realm_id,
-            profile_id=ladder_member.profile_id,
-            ladder_id=ladder_member.ladder_id,
-        )
+    return api.get_profile_ladder(
+        region_id=ladder_member.region_id,
+        realm_id=ladder_member.realm_id,
+        profile_id=ladder_member.profile_id,
+        ladder_id=ladder_member.ladder_id,
     )
 
 
-def process_profile_ladder(engine, region_id):
+def process_profile_ladder(engine, region_id, queue_id=None, limit=None):
     processed = 0
+    deferrals = []
     batch_start = time.time()
+    filters = [(Ladder.region_id == region_id)]
+    if queue_id is not None:
+        filters.append(League.queue_id == queue_id)
+
+    # Ladders are walked in ladder_id order, resuming where a run cut off by its deadline stopped
+    cursor_key = ("ladder_results", region_id, queue_id)
+    cursor = ResumeCursors.get(cursor_key)
+    if cursor is not None:
+        logger.info(f"Resuming ladder results of {region_id=}, {queue_id=} from ladder {cursor}.")
+        filters.append(Ladder.ladder_id >= cursor)
+    cut = []
+
     with session_scope(engine=engine) as session:
         ladder_members = query(
             session,
-            params={
+            params=[
                 LadderMember.id,
                 Ladder.ladder_id,
-                Profile.id,
+                League.queue_id,
+                League.team_type,
                 Profile.region_id,
                 Profile.realm_id,
                 Profile.profile_id,
-            },
-            joins=[(Profile, Profile.id == LadderMember.profile_id), (Ladder, Ladder.id == LadderMember.ladder_id)],
-            filters=[(Ladder.region_id == region_id)],
-            distinct={LadderMember.ladder_id},
+            ],
+            joins=[
+                (Profile, Profile.id == LadderMember.profile_id),
+                (Ladder, Ladder.id == LadderMember.ladder_id),
+                (League, League.id == Ladder.league_id),
+            ],
+            filters=filters,
+            distinct={Ladder.ladder_id},
+            order_by=Ladder.ladder_id,
+            limit=limit,
+            yield_per=LADDER_BATCH_SIZE,
         )
 
-    for profile_ladder_response, ladder_member in yield_futures(get_profile_ladder_wrapper, ladder_members):
-        if processed != 0 and processed % LADDER_BATCH_SIZE == 0:
-            logger.info(
-                f"Have fetched {processed} ladders. " f"Last batch took {round(time.time() - batch_start)} seconds."
-            )
-            batch_start = time.time()
+        stages = [
+            Stage(get_profile_ladder_wrapper, workers=thread_pool_max_workers(), name="fetch"),
+            Stage(ProfileLadderResponse.model_validate, name="validate"),
+        ]
+        ladder_members = (ProfileLadderFuture(**ladder_member._asdict()) for ladder_member in ladder_members)
+        for item in pipeline(ladder_members, stages=stages):
+            if processed != 0 and processed % LADDER_BATCH_SIZE == 0:
+                logger.info(
+                    f"Have fetched {processed} ladders. " f"Last batch took {round(time.time() - batch_start)} seconds."
+                )
+                batch_start = time.time()
+
+            processed += 1
+            if not item.ok:
+                logger.error(f"Failed to {item.stage} profile ladder {item.arg}: {item.error!r}")
+                if isinstance(item.error, DeadlineExceededError):
+                    cut.append(item.arg.ladder_id)
+                elif is_deferrable(item.error):
+                    deferrals.append(Deferral(kind=RetryKind.PROFILE_LADDER.value, future=item.arg, error=item.error))
+                continue
 
-        profile_ladder_response.ladder_member = ladder_member
-        yield profile_ladder_response
-        processed += 1
+            item.value.ladder_member = item.arg
+            yield item.value
+
+    defer_requests(deferrals)
+    ResumeCursors.update(cursor_key, cut)
 
     logger.info(f"Done with fetch of ladders. Fetched {processed} total ladders.")
 
 
 def get_ladder_results(**kwargs):
+    """Fetch ladder results for every ladder of a region, optionally only those of queue_id"""
     logger.info("Starting fetch of ladder results...")
     ladders_processed = 0
     start = datetime.now()
@@ -92,8 +185,11 @@ def get_ladder_results(**kwargs):
         logger.warning("Missing required param region_id")
         return
 
+    queue_id = kwargs.get("queue_id")
     responses = []
-    for profile_ladder_response in process_profile_ladder(engine=engine, region_id=region_id):
+    for profile_ladder_response in process_profile_ladder(
+        engine=engine, region_id=region_id, queue_id=queue_id, limit=kwargs.get("limit")
+    ):
         ladders_processed += 1
         responses.append(profile_ladder_response)
 
@@ -105,111 +201,316 @@ def get_ladder_results(**kwargs):
     logger.info("Done with fetch of ladder results.")
 
 
-def process_profile_ladder_response(response):
-    engine = get_engine()
-    mmrs = []
-    matches = []
+def team_key(team_members):
+    """Identity of a team within a queue: its members' Blizzard ids, sorted"""
+    return ",".join(sorted(f"{member.region_id}-{member.realm_id}-{member.profile_id}" for member in team_members))
+
+
+def process_team_ladder_response(response):
+    """
+    MMR for queues other than 1v1 belongs to the team, so it is tracked per team rather
+    than per character. Every lookup for the ladder's teams is done in one query per
+    table instead of one query per member.
+    """
+    ladder_member = response.ladder_member
+    queue = QueueId(ladder_member.queue_id)
+    teams = {}
     for ladder_team in response.ladder_teams:
-        if not ladder_team.mmr:
+        if ladder_team.mmr and ladder_team.team_members:
+            teams[team_key(ladder_team.team_members)] = ladder_team
+
+    if not teams:
+        return [], [], []
+
+    date = current_epoch_time()
+    last_poll = LadderPolls.swap((ladder_member.region_id, ladder_member.ladder_id), date)
+    with session_scope() as session:
+        stmt = insert_stmt(
+            model=Team,
+            values=[
+                {
+                    "id": uuid7(),
+                    "region_id": ladder_member.region_id,
+                    "queue_id": ladder_member.queue_id,
+                    "team_type": ladder_member.team_type,
+                    "team_key": key,
+                }
+                for key in teams
+            ],
+        )
+        bulk_insert(session, stmt=stmt, constraint=TEAM_UNIQUE_CONSTRAINT)
+
+        team_ids = dict(
+            query(
+                session,
+                params=[Team.team_key, Team.id],
+                filters=[
+                    (Team.region_id == ladder_member.region_id),
+                    (Team.queue_id == ladder_member.queue_id),
+                    (Team.team_type == ladder_member.team_type),
+                    (Team.team_key.in_(list(teams))),
+                ],
+            )
+        )
+        previous_mmrs = {
+            team_mmr.team_id: team_mmr
+            for team_mmr in query(
+                session,
+                params=[
+                    TeamMMR.team_id,
+                    TeamMMR.mmr,
+                    TeamMMR.wins,
+                    TeamMMR.losses,
+                    TeamMMR.points,
+                    TeamMMR.date,
+                ],
+                filters=[(TeamMMR.team_id.in_(list(team_ids.values())))],
+                distinct=[TeamMMR.team_id],
+                order_by=(TeamMMR.team_id, TeamMMR.date.desc()),
+            )
+        }
+        member_keys = {
+            (member.region_id, member.realm_id, member.profile_id)
+            for ladder_team in teams.values()
+            for member in ladder_team.team_members
+        }
+        member_profile_ids = profile_ids(session, member_keys)
+
+    team_mmrs = []
+    observations = []
+    for key, ladder_team in teams.items():
+        team_id = team_ids.get(key)
+        previous = previous_mmrs.get(team_id)
+        if not team_id:
+            continue
+
+        if previous and (previous.mmr, previous.wins, previous.losses) == (
+            ladder_team.mmr,
+            ladder_team.wins,
+            ladder_team.losses,
+        ):
+            continue
+
+        team_mmrs.append(
+            TeamMMR(
+                **{
+                    "id": uuid7(),
+                    "mmr": ladder_team.mmr,
+                    "date": date,
+                    "wins": ladder_team.wins,
+                    "losses": ladder_team.losses,
+                    "points": ladder_team.points,
+                    "team_id": team_id,
+                }
+            )
+        )
+        if previous is None:
             continue
 
-        for team_member in ladder_team.team_members:
-            if not team_member.race:
+        for member in ladder_team.team_members:
+            profile_id = member_profile_ids.get((member.region_id, member.realm_id, member.profile_id))
+            if not profile_id:
                 continue
 
-        with session_scope(engine=engine) as session:
-            db_character_mmr = only(
-                query(
+            observations.append(
+                TeamObservation(
+                    profile_id=profile_id,
+                    team_id=team_id,
+                    match_type=queue.match_type,
+                    mmr=ladder_team.mmr,
+                    wins=ladder_team.wins,
+                    losses=ladder_team.losses,
+                    points=ladder_team.points,
+                    date=date,
+                    previous_mmr=previous.mmr,
+                    previous_wins=previous.wins,
+                    previous_losses=previous.losses,
+                    previous_points=previous.points,
+                    previous_date=interval_start(previous.date, last_poll),
+                )
+            )
+
+    return [], team_mmrs, observations
+
+
+def process_profile_ladder_response(response):
+    """
+    1v1 MMR belongs to the character and race. Every lookup for the ladder's members is
+    done in one query per table instead of one query per member.
+    """
+    if response.ladder_member.queue_id != QueueId.LotV_1v1.value:
+        return process_team_ladder_response(response)
+
+    mmrs = []
+    observations = []
+    date = current_epoch_time()
+    ladder_member = response.ladder_member
+    last_poll = LadderPolls.swap((ladder_member.region_id, ladder_member.ladder_id), date)
+    members = [
+        (ladder_team, team_member)
+        for ladder_team in response.ladder_teams
+        if ladder_team.mmr
+        for team_member in ladder_team.team_members
+        if team_member.race
+    ]
+    if not members:
+        return [], [], []
+
+    def identity_key(team_member):
+        return (team_member.region_id, team_member.realm_id, team_member.profile_id, team_member.display_name)
+
+    with session_scope() as session:
+        identities = character_identities(session, {identity_key(team_member) for _, team_member in members})
+        character_ids = list({character_id for character_id, _ in identities.values()})
+        previous_mmrs = (
+            {
+                (character_mmr.character_id, character_mmr.race): character_mmr
+                for character_mmr in query(
                     session,
-                    params={CharacterMMR},
-                    joins=[
-                        (Character, Character.id == CharacterMMR.character_id),
-                        (Profile, Profile.id == Character.profile_id),
+                    params=[
+                        CharacterMMR.character_id,
+                        CharacterMMR.race,
+                        CharacterMMR.mmr,
+                        CharacterMMR.wins,
+                        CharacterMMR.losses,
+                        CharacterMMR.points,
+                        CharacterMMR.date,
                     ],
-                    filters=[
-                        (Profile.profile_id == team_member.profile_id),
-                        (Profile.realm_id == team_member.realm_id),
-                        (Profile.region_id == team_member.region_id),
-                        (Character.display_name == team_member.display_name),
-                        (CharacterMMR.race == team_member.race),
-                    ],
-                    order_by=CharacterMMR.date.desc(),
-                    limit=1,
+                    filters=[(CharacterMMR.character_id.in_(character_ids))],
+                    distinct=[CharacterMMR.character_id, CharacterMMR.race],
+                    order_by=(CharacterMMR.character_id, CharacterMMR.race, CharacterMMR.date.desc()),
                 )
+            }
+            if character_ids
+            else {}
+        )
+
+    for ladder_team, team_member in members:
+        identity = identities.get(identity_key(team_member))
+        if not identity:
+            continue
+
+        character_id, profile_id = identity
+        db_character_mmr = previous_mmrs.get((character_id, team_member.race))
+        db_mmr = db_character_mmr.mmr if db_character_mmr else None
+        counters_changed = db_character_mmr is not None and (
+            (db_character_mmr.wins, db_character_mmr.losses) != (ladder_team.wins, ladder_team.losses)
+        )
+        if db_mmr == ladder_team.mmr and not counters_changed:
+            continue
+
+        mmr_logger.info(
+            f"New MMR result for {character_id}:{team_member.display_name}:{team_member.race.value} "
+            + f"{db_mmr} --> {ladder_team.mmr}"
+        )
+        mmrs.append(
+            CharacterMMR(
+                **{
+                    "id": uuid7(),
+                    "race": team_member.race,
+                    "mmr": ladder_team.mmr,
+                    "date": date,
+                    "wins": ladder_team.wins,
+                    "losses": ladder_team.losses,
+                    "points": ladder_team.points,
+                    "character_id": character_id,
+                }
             )
-            db_mmr = db_character_mmr.mmr if db_character_mmr else None
-            if db_mmr != ladder_team.mmr:
-                if not db_character_mmr:
-                    character = only(
-                        query(
-                            session,
-                            params={Character},
-                            joins=[(Profile, Profile.id == Character.profile_id)],
-                            filters=[
-                                (Profile.profile_id == team_member.profile_id),
-                                (Profile.realm_id == team_member.realm_id),
-                                (Profile.region_id == team_member.region_id),
-                                (Character.display_name == team_member.display_name),
-                            ],
-                        )
-                    )
-                else:
-                    character = db_character_mmr.character
-
-                if not character:
-                    continue
+        )
 
-                logger.info(
-                    f"New MMR result for {character.id}:{team_member.display_name}:{team_member.race.value} "
-                    + f"{db_mmr} --> {ladder_team.mmr}"
-                )
-                mmrs.append(
-                    CharacterMMR(
-                        **{
-                            "id": uuid.uuid4(),
-                            "race": team_member.race,
-                            "mmr": ladder_team.mmr,
-                            "date": current_epoch_time(),
-                            "character_id": character.id,
-                        }
-                    )
+        if db_character_mmr is not None:
+            observations.append(
+                TeamObservation(
+                    profile_id=profile_id,
+                    match_type=QueueId.LotV_1v1.match_type,
+                    mmr=ladder_team.mmr,
+                    wins=ladder_team.wins,
+                    losses=ladder_team.losses,
+                    points=ladder_team.points,
+                    date=date,
+                    previous_mmr=db_character_mmr.mmr,
+                    previous_wins=db_character_mmr.wins,
+                    previous_losses=db_character_mmr.losses,
+                    previous_points=db_character_mmr.points,
+                    previous_date=interval_start(db_character_mmr.date, last_poll),
                 )
+            )
 
-                if db_mmr is not None:
-                    # TODO determine decision options here
-                    # decision = "Loss" if db_mmr > ladder_team.mmr else "Win"
-                    matches.append(
-                        Match(
-                            **{
-                                "id": uuid.uuid4(),
-                                "end_date": current_epoch_time(),
-                                # "decision": decision,
-                                "profile_id": character.profile_id,
-                            }
-                        )
-                    )
-
-    return (mmrs, matches)
+    return (mmrs, [], observations)
 
 
 def process_profile_ladder_responses(engine, responses):
     character_mmrs = []
-    matches = []
+    team_mmrs = []
+    observations = []
+    regions = set()
+
+    stages = [Stage(process_profile_ladder_response, workers=thread_pool_max_workers(), name="transform")]
+    for item in pipeline(responses, stages=stages):
+        if not item.ok:
+            logger.error(f"Failed to {item.stage} profile ladder {item.arg.ladder_member}: {item.error!r}")
+            continue
 
-    for res, _ in yield_futures(process_profile_ladder_response, responses):
-        ladder_mmrs, ladder_matches = res
-        character_mmrs = character_mmrs + ladder_mmrs
-        matches = matches + ladder_matches
+        ladder_character_mmrs, ladder_team_mmrs, ladder_observations = item.value
+        regions.add(item.arg.ladder_member.region_id)
+        character_mmrs.extend(ladder_character_mmrs)
+        team_mmrs.extend(ladder_team_mmrs)
+        observations.extend(ladder_observations)
 
-    with session_scope(engine=engine) as session:
+    matches, stats = infer_matches(observations)
+    logger.info(
+        f"Inferred {stats.games} matches from {stats.observations} ladder team changes. "
+        + f"{stats.from_counters=}, {stats.from_mmr=}, {stats.mmr_disagreements=}, {stats.truncated=}"
+    )
+
+    batch_id = new_batch_id()
+    region_id = only(regions) if len(regions) == 1 else None
+    with span("write"), session_scope(engine=engine) as session:
         if character_mmrs:
+            # Stamped at write time, incremental exports read rows by it
+            created = current_epoch_time()
+            for character_mmr in character_mmrs:
+                character_mmr.created_timestamp = created
             stmt = insert_stmt(model=CharacterMMR, values=orm_classes_as_dict(character_mmrs))
-            bulk_insert(
+            rows = bulk_insert(
                 session,
                 stmt=stmt,
                 constraint=CHARACTER_MMR_UNIQUE_CONSTRAINT,
             )
+            publish_change(
+                session,
+                batch_id,
+                CharacterMMR.__tablename__,
+                rows,
+                [mmr.date for mmr in character_mmrs],
+                region_id=region_id,
+            )
+            rollup_character_mmrs(session, character_mmrs)
+
+        if team_mmrs:
+            stmt = insert_stmt(model=TeamMMR, values=orm_classes_as_dict(team_mmrs))
+            rows = bulk_insert(
+                session,
+                stmt=stmt,
+                constraint=TEAM_MMR_UNIQUE_CONSTRAINT,
+            )
+            publish_change(
+                session, batch_id, TeamMMR.__tablename__, rows, [mmr.date for mmr in team_mmrs], region_id=region_id
+            )
+
+        inferred = len(matches)
+        matches = without_superseded_matches(session, matches)
+        if len(matches) < inferred:
+            logger.info(f"Dropped {inferred - len(matches)} inferred matches already covered by match history.")
 
         if matches:
             stmt = insert_stmt(model=Match, values=orm_classes_as_dict(matches))
-            bulk_insert(session, stmt=stmt, constraint=None)
+            rows = bulk_insert(session, stmt=stmt, constraint=None)
+            publish_change(
+                session,
+                batch_id,
+                Match.__tablename__,
+                rows,
+                [match.end_timestamp for match in matches],
+                region_id=region_id,
+            )
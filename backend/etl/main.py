@@ -1,79 +1,317 @@
 import argparse
+import importlib
+import json
+import sys
 import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from datetime import datetime
+from typing import Optional
 
-import schedule
 from dotenv import load_dotenv
 
-from backend.enums import RegionId
-from backend.etl.ladder import get_ladders
-from backend.etl.ladder_member import get_ladder_members
-from backend.etl.ladder_result import get_ladder_results
-from backend.etl.match import create_games
+from backend.enums import QueueId, RegionId
+from backend.static import LADDER_RESULTS_INTERVAL_MINUTES
 from backend.utils.concurrency import run_threaded
+from backend.utils.deadline import with_deadline
 from backend.utils.log import get_logger
-from backend.utils.state import log_app_state
+from backend.utils.metrics import Metrics, group_counters
+from backend.utils.tracing import JobTag, Spans, tagged
 
 load_dotenv()
 
 logger = get_logger(__name__)
 
+EXIT_OK = 0
+EXIT_FAILED = 1  # A job raised
+EXIT_USAGE = 2
+EXIT_PARTIAL = 3  # Jobs completed but some requests or items failed
+
+
+@dataclass
+class Job:
+    module: str
+    target: str
+    per_region: bool = True
+
+
+# Jobs are imported on first use so a single process only loads the modules it runs
+JOBS = {
+    "ladder": Job("backend.etl.ladder", "get_ladders"),
+    "ladder_members": Job("backend.etl.ladder_member", "get_ladder_members"),
+    "ladder_results": Job("backend.etl.ladder_result", "get_ladder_results"),
+    "match_histories": Job("backend.etl.match", "get_match_histories"),
+    "retries": Job("backend.etl.drainer", "drain_retry_requests"),
+    "games": Job("backend.etl.match", "create_games", per_region=False),
+    "export": Job("backend.etl.export", "export_snapshots"),
+    "backfill": Job("backend.etl.backfill", "backfill_seasons"),
+    "mmr_distribution": Job("backend.analytics.mmr", "log_mmr_distribution"),
+    "prune_changes": Job("backend.feed.publish", "prune_change_events", per_region=False),
+    "compact_mmr": Job("backend.etl.rollup", "compact_character_mmr"),
+    "identities": Job("backend.etl.identity", "warm_identity_cache", per_region=False),
+    "app_state": Job("backend.utils.state", "log_app_state", per_region=False),
+}
+
+
+def load_job(process):
+    job = JOBS[process]
+    return getattr(importlib.import_module(job.module), job.target)
+
 
 def handle_schedule():
+    import schedule
+
+    from backend.utils.profiler import install_profile_signal
+
     logger.info("Scheduling all jobs...")
+    install_profile_signal()
+    log_app_state = load_job("app_state")
+    get_ladders = load_job("ladder")
+    get_ladder_members = load_job("ladder_members")
+    get_ladder_results = load_job("ladder_results")
+    get_match_histories = load_job("match_histories")
+    drain_retry_requests = load_job("retries")
+    create_games = load_job("games")
+    export_snapshots = load_job("export")
+    log_mmr_distribution = load_job("mmr_distribution")
+    prune_change_events = load_job("prune_changes")
+    warm_identity_cache = load_job("identities")
+    compact_character_mmr = load_job("compact_mmr")
 
+    # Warm up once in the background, jobs starting meanwhile fall back to the database
+    run_threaded(kwargs={"target": warm_identity_cache})
     schedule.every(10).seconds.do(job_func=run_threaded, kwargs={"target": log_app_state}).tag("log_app_state")
 
+    # API jobs get a deadline of their interval so a slow run stops fetching before the next starts
     for i, region in enumerate(RegionId):
         schedule.every(1).hours.at(":{:02d}".format(i * 20)).do(
-            job_func=run_threaded, kwargs={"target": get_ladders, "region_id": region.value}
+            job_func=run_threaded, kwargs={"target": get_ladders, "region_id": region.value, "deadline": 3600}
         ).tag(f"get_ladders_region_id_{region.value}")
 
         schedule.every(20).minutes.at(":{:02d}".format(i * 1)).do(
-            job_func=run_threaded, kwargs={"target": get_ladder_members, "region_id": region.value}
+            job_func=run_threaded, kwargs={"target": get_ladder_members, "region_id": region.value, "deadline": 1200}
         ).tag(f"get_ladder_members_region_id_{region.value}")
 
-        schedule.every(1).minutes.at(":{:02d}".format(i * 20)).do(
-            job_func=run_threaded, kwargs={"target": get_ladder_results, "region_id": region.value}
-        ).tag(f"get_ladder_results_region_id_{region.value}")
+        for j, queue in enumerate(QueueId):
+            schedule.every(LADDER_RESULTS_INTERVAL_MINUTES[queue.value]).minutes.at(
+                ":{:02d}".format(i * 20 + j * 3)
+            ).do(
+                job_func=run_threaded,
+                kwargs={
+                    "target": get_ladder_results,
+                    "region_id": region.value,
+                    "queue_id": queue.value,
+                    "deadline": LADDER_RESULTS_INTERVAL_MINUTES[queue.value] * 60,
+                },
+            ).tag(
+                f"get_ladder_results_region_id_{region.value}_queue_id_{queue.value}"
+            )
+
+        schedule.every(15).minutes.at(":{:02d}".format(i * 5)).do(
+            job_func=run_threaded, kwargs={"target": get_match_histories, "region_id": region.value, "deadline": 900}
+        ).tag(f"get_match_histories_region_id_{region.value}")
+
+        schedule.every(1).minutes.at(":{:02d}".format(i * 20 + 15)).do(
+            job_func=run_threaded, kwargs={"target": drain_retry_requests, "region_id": region.value, "deadline": 60}
+        ).tag(f"drain_retry_requests_region_id_{region.value}")
+
+        schedule.every(1).hours.at(":{:02d}".format(i * 20 + 10)).do(
+            job_func=run_threaded, kwargs={"target": log_mmr_distribution, "region_id": region.value}
+        ).tag(f"log_mmr_distribution_region_id_{region.value}")
+
+        schedule.every(1).days.at("04:{:02d}".format(i * 20)).do(
+            job_func=run_threaded, kwargs={"target": export_snapshots, "region_id": region.value}
+        ).tag(f"export_snapshots_region_id_{region.value}")
+
+        schedule.every(1).days.at("06:{:02d}".format(i * 20)).do(
+            job_func=run_threaded, kwargs={"target": compact_character_mmr, "region_id": region.value}
+        ).tag(f"compact_character_mmr_region_id_{region.value}")
 
     schedule.every(1).hours.do(job_func=run_threaded, kwargs={"target": create_games}).tag("create_games")
 
+    schedule.every(1).days.at("05:00").do(job_func=run_threaded, kwargs={"target": prune_change_events}).tag(
+        "prune_change_events"
+    )
+
     while True:
         schedule.run_pending()
         time.sleep(1)
 
 
-def handle_process(process):
-    threads = []
-    logger.info(f"Starting single execution of {process=}")
-    if process == "ladder":
-        for region in RegionId:
-            threads.append(run_threaded(kwargs={"target": get_ladders, "region_id": region.value}))
-    elif process == "ladder_members":
-        for region in RegionId:
-            threads.append(run_threaded(kwargs={"target": get_ladder_members, "region_id": region.value}))
-    elif process == "ladder_results":
-        for region in RegionId:
-            threads.append(run_threaded(kwargs={"target": get_ladder_results, "region_id": region.value}))
-    elif process == "games":
-        threads.append(run_threaded(kwargs={"target": create_games}))
+@dataclass
+class JobRun:
+    region_id: Optional[int]
+    seconds: float = 0
+    error: Optional[str] = None
+
+
+def run_job(target, kwargs):
+    run = JobRun(region_id=kwargs.get("region_id"))
+    start = time.perf_counter()
+    try:
+        job = with_deadline(target, kwargs.get("deadline"))
+        tagged(job, JobTag(job=target.__name__, region_id=kwargs.get("region_id")))(**kwargs)
+    except Exception as e:
+        logger.exception(f"Exception thrown while running {target.__name__} with {kwargs=}...")
+        run.error = repr(e)
+    run.seconds = round(time.perf_counter() - start, 3)
+    return run
+
+
+def run_report(process, runs, seconds, limit):
+    """Summary of a one-shot run and its exit status"""
+    counters = group_counters(Metrics.get())
+    api = counters.get("api", {})
+    errors = counters.get("errors", {})
+    if any(run.error for run in runs):
+        status, exit_status = "failed", EXIT_FAILED
+    elif errors or api.get("unavailable") or api.get("failed") or api.get("deadline"):
+        status, exit_status = "partial", EXIT_PARTIAL
     else:
+        status, exit_status = "ok", EXIT_OK
+
+    report = {
+        "process": process,
+        "status": status,
+        "limit": limit,
+        "seconds": round(seconds, 3),
+        "jobs": [asdict(run) for run in runs],
+        "api": api,
+        "rows": counters.get("rows", {}),
+        "errors": errors,
+        "spans": Spans.get(),
+    }
+    return report, exit_status
+
+
+def handle_process(process, regions=None, limit=None, profile=None, replay=None, **job_kwargs):
+    """
+    Run one job per region to completion on a bounded executor, print a JSON run report
+    and return the exit status. With profile, the job's stacks are sampled for up to that
+    many seconds.
+
+    With replay (start, end), the job is fed the archived responses fetched in that range
+    instead of calling the API. Each pass serves the next archived response of every url
+    the job fetches, so the job is run again until a pass serves nothing new.
+    """
+    if process not in JOBS:
         logger.error(f"Unable to execute {process=}")
+        return EXIT_USAGE
+
+    logger.info(f"Starting single execution of {process=}")
+    job = JOBS[process]
+    target = load_job(process)
+    if limit is not None:
+        job_kwargs["limit"] = limit
+    runs_kwargs = (
+        [{**job_kwargs, "region_id": region.value} for region in regions or RegionId]
+        if job.per_region
+        else [job_kwargs]
+    )
+
+    Metrics.reset()
+    Spans.reset()
+    profiler = None
+    if profile:
+        from backend.utils.profiler import start_profiler
+
+        profiler = start_profiler(seconds=profile)
 
+    replay_source = None
+    if replay:
+        from backend.api.archive import ReplaySource
+        from backend.api.blizzard import BlizzardApi
+
+        replay_source = BlizzardApi.replay = ReplaySource(*replay)
+
+    start = time.perf_counter()
+    runs = []
+    passes = 0
     while True:
-        time.sleep(1)
+        served = replay_source.served if replay_source else 0
+        with ThreadPoolExecutor(max_workers=len(runs_kwargs)) as executor:
+            runs.extend(executor.map(lambda kwargs: run_job(target, kwargs), runs_kwargs))
+        passes += 1
+        if not replay_source or not replay_source.remaining or replay_source.served == served:
+            break
+
+    if profiler:
+        profiler.stop()
+
+    report, exit_status = run_report(process, runs, time.perf_counter() - start, limit)
+    if replay_source:
+        report["replay"] = {"passes": passes, "served": replay_source.served, "remaining": replay_source.remaining}
+    print(json.dumps(report, indent=2))
+    logger.info(f"Finished single execution of {process=} with status {report['status']}.")
+    return exit_status
+
+
+def parse_region(value):
+    """RegionId by name (kr) or value (3)"""
+    try:
+        return RegionId(int(value)) if value.isdigit() else RegionId[value.upper()]
+    except (KeyError, ValueError):
+        raise argparse.ArgumentTypeError(f"Unknown region {value!r}, expected one of {[r.name for r in RegionId]}")
+
+
+def parse_time(value):
+    """Epoch seconds (1760000000) or ISO 8601 (2025-10-09T12:00)"""
+    try:
+        return float(value) if value.isdigit() else datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Unknown time {value!r}, expected epoch seconds or ISO 8601")
 
 
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
-    parser.add_argument("-p", "--process")
+    parser.add_argument("-p", "--process", choices=sorted(JOBS))
     parser.add_argument("-s", "--schedule", action="store_true")
+    parser.add_argument("-r", "--regions", nargs="+", type=parse_region, help="Region names or ids, default all")
+    parser.add_argument("-l", "--limit", type=int, help="Max items (leagues, ladders, profiles) fetched per region")
+    parser.add_argument(
+        "--seasons",
+        nargs="+",
+        type=int,
+        metavar=("START", "END"),
+        help="Season range for backfill, END defaults to the previous season",
+    )
+    parser.add_argument(
+        "--since", type=parse_time, metavar="TIME", help="Compact MMR history from TIME instead of the lookback"
+    )
+    parser.add_argument("--deadline", type=float, metavar="SECONDS", help="Stop API calls of the job after SECONDS")
+    parser.add_argument("--profile", type=float, metavar="SECONDS", help="Sample the job's stacks, see PROFILE_PATH")
+    parser.add_argument(
+        "--replay",
+        nargs="+",
+        type=parse_time,
+        metavar=("START", "END"),
+        help="Feed the job archived responses fetched from START to END (default now) instead of the API",
+    )
     args = parser.parse_args()
 
     if args.schedule:
         handle_schedule()
     elif args.process:
-        handle_process(args.process)
+        job_kwargs = {}
+        if args.deadline:
+            job_kwargs["deadline"] = args.deadline
+        if args.since:
+            job_kwargs["since"] = args.since
+        if args.seasons:
+            job_kwargs["season_start"] = args.seasons[0]
+            job_kwargs["season_end"] = args.seasons[1] if len(args.seasons) > 1 else None
+        replay = (args.replay[0], args.replay[1] if len(args.replay) > 1 else None) if args.replay else None
+        sys.exit(
+            handle_process(
+                args.process,
+                regions=args.regions,
+                limit=args.limit,
+                profile=args.profile,
+                replay=replay,
+                **job_kwargs,
+            )
+        )
     else:
         logger.error("Missing required argument.")
+        sys.exit(EXIT_USAGE)
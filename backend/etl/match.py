@@ -2,90 +2,412 @@
 ETL processes associated with SC2 ladder games
 """
 
+from bisect import bisect_right
 from collections import defaultdict
+from dataclasses import dataclass
 from datetime import datetime, timedelta
 
+import numpy as np
+from sqlalchemy import delete, exists, update
+from sqlalchemy.orm import aliased
+
 from backend.api.blizzard import BlizzardApi
 from backend.api.models.legacy import LegacyMatchHistoryResponse
-from backend.db.db import get_or_create, query, session_scope
-from backend.db.model import Game, Match
-from backend.static import MATCH_LOOKBACK_MAX, MATCH_LOOKBACK_MIN, MATCH_LOOKUP_KEY
-from backend.utils.datetime import datetime_to_epoch
+from backend.db.db import bulk_insert, insert_stmt, query, session_scope
+from backend.db.model import Game, Match, Profile
+from backend.enums import Decision, QueueId, RetryKind
+from backend.etl.priority import PriorityState, select_profiles
+from backend.etl.retry import Deferral, defer_requests, is_deferrable
+from backend.feed.publish import new_batch_id, publish_change
+from backend.static import (
+    MATCH_BATCH_SIZE,
+    MATCH_LOOKBACK_MAX,
+    MATCH_LOOKBACK_MIN,
+    MATCH_LOOKUP_KEY,
+    MATCH_PAIR_WINDOW,
+    MATCH_UNIQUE_CONSTRAINT,
+    PROFILE_BATCH_SIZE,
+)
+from backend.utils.concurrency import Stage, pipeline, thread_pool_max_workers
+from backend.utils.datetime import current_epoch_time, datetime_to_epoch
+from backend.utils.ids import uuid7
 from backend.utils.log import get_logger
-
-# TODO refactor pairing logic to support game modes other than 1V1
-
+from backend.utils.tracing import span
 
 logger = get_logger(__name__)
 
 
 def get_match_history_wrapper(profile):
     api = BlizzardApi()
-    return LegacyMatchHistoryResponse.model_validate(
-        api.get_legacy_match_history(
-            region_id=profile.region_id,
-            realm_id=profile.realm_id,
-            profile_id=profile.profile_id,
+    return api.get_legacy_match_history(
+        region_id=profile.region_id,
+        realm_id=profile.realm_id,
+        profile_id=profile.profile_id,
+    )
+
+
+def insert_match_histories(batch):
+    """Insert unseen matches and advance every profile's high-water mark in one transaction"""
+
+    polled = current_epoch_time()
+    matches = []
+    marks = []
+    for profile, response in batch:
+        mark = profile.match_history_timestamp or 0
+        for match in response.matches:
+            # Games of the same second as the mark may not be stored yet, the constraint drops those that are
+            if match.start_timestamp < mark:
+                continue
+
+            matches.append(
+                {
+                    "id": uuid7(),
+                    "map": match.map,
+                    "type": match.type,
+                    "decision": match.decision,
+                    "speed": match.speed,
+                    "start_timestamp": match.start_timestamp,
+                    "end_timestamp": match.start_timestamp,
+                    "created_timestamp": polled,
+                    "profile_id": profile.id,
+                    "game_id": None,
+                }
+            )
+
+        latest = max((match.start_timestamp for match in response.matches), default=mark)
+        marks.append(
+            {
+                "id": profile.id,
+                "match_history_timestamp": latest or None,
+                "match_history_polled_timestamp": polled,
+            }
         )
+
+    inserted = 0
+    with span("write"), session_scope() as session:
+        if matches:
+            inserted = bulk_insert(
+                session, stmt=insert_stmt(model=Match, values=matches), constraint=MATCH_UNIQUE_CONSTRAINT
+            )
+            superseded = delete_superseded_matches(session, {match["profile_id"] for match in matches})
+            if superseded:
+                logger.info(f"Deleted {superseded} inferred matches superseded by match history.")
+
+        if marks:
+            session.execute(update(Profile), marks)
+
+    return inserted
+
+
+def delete_superseded_matches(session, profile_ids):
+    """
+    Delete the unpaired inferred matches of profiles that have a legacy match of the same
+    type in their poll interval. Match history is exact, so it replaces the inference of
+    the games it covers.
+    """
+    legacy = aliased(Match)
+    stmt = delete(Match).where(
+        (Match.inferred.is_(True)),
+        (Match.game_id == None),  # noqa E711
+        (Match.profile_id.in_(profile_ids)),
+        exists().where(
+            (legacy.inferred.is_(False)),
+            (legacy.profile_id == Match.profile_id),
+            (legacy.type == Match.type),
+            (legacy.start_timestamp > Match.start_timestamp),
+            (legacy.start_timestamp <= Match.end_timestamp),
+        ),
+    )
+    return session.execute(stmt).rowcount
+
+
+def without_superseded_matches(session, matches):
+    """Inferred matches that no stored legacy match of the same profile and type falls in the interval of"""
+    if not matches:
+        return matches
+
+    legacy = defaultdict(list)
+    for profile_id, match_type, start_timestamp in query(
+        session,
+        params=[Match.profile_id, Match.type, Match.start_timestamp],
+        filters=[
+            (Match.inferred.is_(False)),
+            (Match.profile_id.in_({match.profile_id for match in matches})),
+            (Match.start_timestamp > min(match.start_timestamp for match in matches)),
+        ],
+    ):
+        legacy[(profile_id, match_type)].append(start_timestamp)
+    for timestamps in legacy.values():
+        timestamps.sort()
+
+    def superseded(match):
+        timestamps = legacy.get((match.profile_id, match.type), [])
+        return bisect_right(timestamps, match.end_timestamp) > bisect_right(timestamps, match.start_timestamp)
+
+    return [match for match in matches if not superseded(match)]
+
+
+def get_match_histories(**kwargs):
+    logger.info("Starting fetch of match histories for prioritized profiles...")
+    start = datetime.now()
+    processed = 0
+    inserted = 0
+
+    region_id = kwargs.get("region_id")
+    if not region_id:
+        logger.warning("Missing required param region_id")
+        return
+
+    with session_scope() as session:
+        profiles = select_profiles(session, region_id=region_id, limit=kwargs.get("limit"))
+
+    stats = PriorityState.get().get(region_id)
+    logger.info(
+        f"Selected {stats.selected} of {stats.candidates} profiles for match history. "
+        + f"{stats.active=}, {stats.coverage=}, {stats.staleness_p50=}, {stats.staleness_p95=}"
     )
 
+    batch = []
+    stages = [
+        Stage(get_match_history_wrapper, workers=thread_pool_max_workers(), name="fetch"),
+        Stage(LegacyMatchHistoryResponse.model_validate, name="validate"),
+    ]
+    deferrals = []
+    for item in pipeline(profiles, stages=stages):
+        processed += 1
+        if not item.ok:
+            logger.error(f"Failed to {item.stage} match history for {item.arg.id}: {item.error!r}")
+            if is_deferrable(item.error):
+                deferrals.append(Deferral(kind=RetryKind.MATCH_HISTORY.value, future=item.arg, error=item.error))
+            continue
+
+        batch.append((item.arg, item.value))
+        if len(batch) >= PROFILE_BATCH_SIZE:
+            inserted += insert_match_histories(batch)
+            batch = []
+
+    if batch:
+        inserted += insert_match_histories(batch)
+
+    defer_requests(deferrals)
+
+    end = datetime.now()
+    logger.info(f"Inserted {inserted} new matches from {processed} match histories.")
+    logger.info(f"Processing match histories took {round(end.timestamp() - start.timestamp())} seconds.")
+    logger.info("Done with fetch of match histories.")
+
 
 def query_unpaired_matches(session):
-    """Get all matches in recent history that have not been merged into a game"""
+    """
+    Stream all decided matches in recent history that have not been merged into a game,
+    with their profile's region since only players of the same region can meet
+    """
 
     lookback_max = datetime_to_epoch(datetime.now() - timedelta(0, MATCH_LOOKBACK_MAX))
     lookback_min = datetime_to_epoch(datetime.now() - timedelta(0, MATCH_LOOKBACK_MIN))
     return query(
         session,
-        params={Match},
-        filters=[(Match.game_id == None), (Match.date > lookback_max), (Match.date < lookback_min)],  # noqa E711
+        params=[
+            Match.id,
+            Match.profile_id,
+            Match.map,
+            Match.type,
+            Match.speed,
+            Match.decision,
+            Match.start_timestamp,
+            Match.end_timestamp,
+            Match.team_id,
+            Match.inferred,
+            Profile.region_id,
+        ],
+        joins=[(Profile, Profile.id == Match.profile_id)],
+        filters=[
+            (Match.game_id == None),  # noqa E711
+            (Match.decision.in_([Decision.WIN.value, Decision.LOSS.value])),
+            (Match.end_timestamp > lookback_max),
+            (Match.end_timestamp < lookback_min),
+        ],
+        yield_per=MATCH_BATCH_SIZE,
     )
 
 
 def insert_game(session, matches):
-    durations = [match.duration for match in matches if match.duration is not None]
-    duration_average = sum(durations) / len(durations) if durations else None
-    game = get_or_create(session, model=Game, values={"duration": duration_average}, filter={})
+    """
+    Create a game of the paired matches and return its end timestamp. A game of inferred
+    matches was played in the intersection of their poll intervals.
+    """
+    start_timestamps = [match.start_timestamp for match in matches if match.start_timestamp is not None]
+    end_timestamps = [match.end_timestamp for match in matches if match.end_timestamp is not None]
+    if all(match.inferred for match in matches):
+        start_timestamp, end_timestamp = max(start_timestamps), min(end_timestamps)
+    else:
+        start_timestamp = min(start_timestamps) if start_timestamps else min(end_timestamps)
+        end_timestamp = max(end_timestamps)
+
+    # Flushed, not committed: the games, match updates and change event commit together
+    game = Game(
+        id=uuid7(),
+        start_timestamp=start_timestamp,
+        end_timestamp=end_timestamp,
+        created_timestamp=current_epoch_time(),
+    )
+    session.add(game)
+    session.flush()
+    session.execute(update(Match).where(Match.id.in_([match.id for match in matches])).values(game_id=game.id))
+    return game.end_timestamp
+
+
+def match_bounds(match, window=MATCH_PAIR_WINDOW):
+    """
+    [low, high] of when the game of a match ended, the bounds of two matches of one game
+    overlap. An inferred match ended in its poll interval (start, end]. The legacy end
+    timestamps of one game differ by at most window, so legacy bounds are [end, end + window].
+    """
+    if match.inferred:
+        return match.start_timestamp + 1, match.end_timestamp
+    return match.end_timestamp, match.end_timestamp + window
+
+
+@dataclass
+class Side:
+    """The matches of every player on one side of a game"""
+
+    decision: str
+    low: int
+    high: int
+    matches: list
+
+    @property
+    def profiles(self):
+        return {match.profile_id for match in self.matches}
+
+
+def build_sides(matches, team_size):
+    """
+    Group one decision's matches into the sides of games. Solo queue matches are a side
+    each. Team matches of one game share their bounds (and team_id when known), the
+    reported timestamp of legacy matches or the team's poll interval of inferred ones. A
+    group of exactly team_size profiles with n matches each is n sides, as a team can
+    play several games in one poll interval. Returns (sides, incomplete).
+    """
+    if team_size == 1:
+        return [Side(match.decision, *match_bounds(match), [match]) for match in matches], 0
+
+    groups = defaultdict(list)
     for match in matches:
-        match.game_id = game.id
-        match.game = game
-        session.add(match)
-    session.commit()
+        groups[(match.team_id, *match_bounds(match))].append(match)
+
+    sides = []
+    incomplete = 0
+    for (_, low, high), members in groups.items():
+        by_profile = defaultdict(list)
+        for match in members:
+            by_profile[match.profile_id].append(match)
+
+        if len(by_profile) != team_size or len({len(games) for games in by_profile.values()}) != 1:
+            incomplete += len(members)
+            continue
+
+        for game in zip(*by_profile.values()):
+            sides.append(Side(members[0].decision, low, high, list(game)))
+
+    return sides, incomplete
+
+
+def side_bounds(sides):
+    lows = np.fromiter((side.low for side in sides), dtype=np.int64, count=len(sides))
+    highs = np.fromiter((side.high for side in sides), dtype=np.int64, count=len(sides))
+    return lows, highs
+
+
+def overlaps(lows, highs, other_lows, other_highs):
+    """
+    For each [low, high], how many of the other intervals overlap it and, when that is
+    one, its index. The others starting by high overlap unless they ended before low, and
+    when only one overlaps it is the latest ending of those starting by high.
+    """
+    if not len(other_lows):
+        return np.zeros(len(lows), dtype=np.int64), np.full(len(lows), -1, dtype=np.int64)
+
+    order = np.argsort(other_lows, kind="stable")
+    started = np.searchsorted(other_lows[order], highs, side="right")
+    ended = np.searchsorted(np.sort(other_highs), lows, side="left")
+    ordered_highs = other_highs[order]
+    positions = np.arange(len(order))
+    latest = np.maximum.accumulate(np.where(ordered_highs == np.maximum.accumulate(ordered_highs), positions, 0))
+    candidate = np.where(started > 0, order[latest[np.maximum(started - 1, 0)]], -1)
+    return started - ended, candidate
+
+
+def pair_decisions(wins, losses):
+    """
+    Pair each winning side with the losing side whose bounds overlap its own. A pair is
+    only accepted when the win overlaps exactly one loss and that loss exactly one win, so
+    ambiguous clusters are reported instead of guessed. Returns (pairs, waiting_pair,
+    conflict) with the counts in sides.
+    """
+    win_lows, win_highs = side_bounds(wins)
+    loss_lows, loss_highs = side_bounds(losses)
+    win_candidates, win_loss = overlaps(win_lows, win_highs, loss_lows, loss_highs)
+    loss_candidates, _ = overlaps(loss_lows, loss_highs, win_lows, win_highs)
+
+    unique = win_candidates == 1
+    mutual = np.zeros(len(wins), dtype=bool)
+    mutual[unique] = loss_candidates[win_loss[unique]] == 1
+
+    candidates = [(wins[i], losses[win_loss[i]]) for i in np.flatnonzero(mutual).tolist()]
+    # A player cannot be on both sides of the same game
+    pairs = [(win, loss) for win, loss in candidates if not win.profiles & loss.profiles]
+    waiting_pair = int((win_candidates == 0).sum() + (loss_candidates == 0).sum())
+    conflict = len(wins) + len(losses) - 2 * len(pairs) - waiting_pair
+    return pairs, waiting_pair, conflict
 
 
 def pair_matches():
 
-    lookup = defaultdict(list)
+    lookup = defaultdict(lambda: defaultdict(list))
+    match_types = {}
+    match_regions = {}
     with session_scope() as session:
-        matches = query_unpaired_matches(session)
-        logger.info(f"Found {len(matches)} unpaired recent matches...")
-        for match in matches:
-            key = MATCH_LOOKUP_KEY.format(map=match.map, type=match.type, date=match.date, speed=match.speed)
-            lookup[key].append(match)
+        unpaired = 0
+        for match in query_unpaired_matches(session):
+            unpaired += 1
+            key = MATCH_LOOKUP_KEY.format(region_id=match.region_id, map=match.map, type=match.type, speed=match.speed)
+            lookup[key][match.decision].append(match)
+            match_types[key] = match.type
+            match_regions[key] = match.region_id
+        logger.info(f"Found {unpaired} unpaired recent matches...")
 
         waiting_pair = 0
         paired = 0
         conflict = 0
-        for _, matches in lookup.items():
-            if not matches or len(matches) < 1:
-                continue
-
-            if len(matches) == 1:
-                waiting_pair += len(matches)
-                continue
-
-            if len(matches) > 2:
-                conflict += len(matches)
+        unsupported = 0
+        game_end_timestamps = defaultdict(list)
+        for key, decisions in lookup.items():
+            queue = QueueId.from_match_type(match_types[key])
+            if not queue:
+                unsupported += sum(len(matches) for matches in decisions.values())
                 continue
 
-            if len(matches) == 2:
-                # TODO Validate number of wins/losses
+            wins, incomplete_wins = build_sides(decisions[Decision.WIN.value], team_size=queue.team_size)
+            losses, incomplete_losses = build_sides(decisions[Decision.LOSS.value], team_size=queue.team_size)
+            pairs, group_waiting_pair, group_conflict = pair_decisions(wins=wins, losses=losses)
+            waiting_pair += group_waiting_pair * queue.team_size + incomplete_wins + incomplete_losses
+            conflict += group_conflict * queue.team_size
+            for win, loss in pairs:
                 paired += 1
-                insert_game(session, matches)
+                game_end_timestamps[match_regions[key]].append(insert_game(session, win.matches + loss.matches))
+
+        batch_id = new_batch_id()
+        for region_id, end_timestamps in game_end_timestamps.items():
+            publish_change(
+                session, batch_id, Game.__tablename__, len(end_timestamps), end_timestamps, region_id=region_id
+            )
 
-    logger.info(f"Paired {paired} matches.")
+    logger.info(f"Paired {paired} games.")
     logger.info(f"{waiting_pair} matches still waiting for results.")
     logger.info(f"{conflict} matches have a pairing conflict.")
+    logger.info(f"{unsupported} matches are of an unsupported type.")
 
 
 def create_games():
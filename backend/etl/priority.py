@@ -0,0 +1,206 @@
+"""
+Activity-based prioritization of profiles for match history polling
+"""
+
+import uuid
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from threading import Lock
+
+import numpy as np
+from sqlalchemy import func
+
+from backend.db.model import (
+    Character,
+    CharacterMMR,
+    Ladder,
+    LadderMember,
+    League,
+    Profile,
+    Team,
+    TeamMMR,
+)
+from backend.enums import LeagueId, RegionId
+from backend.static import (
+    MATCH_HISTORY_BUDGET_SHARE,
+    MATCH_HISTORY_CYCLES_PER_DAY,
+    MATCH_PRIORITY_ACTIVITY_WEIGHT,
+    MATCH_PRIORITY_LEAGUE_WEIGHT,
+    MATCH_PRIORITY_STALENESS_CAP,
+    MATCH_PRIORITY_STALENESS_WEIGHT,
+    MATCH_PRIORITY_WINDOW,
+    REQUEST_MAX_PER_DAY,
+)
+from backend.utils.datetime import current_epoch_time, datetime_to_epoch
+
+
+@dataclass
+class ProfileCandidate:
+    id: uuid.UUID
+    region_id: int
+    realm_id: int
+    profile_id: int
+    match_history_timestamp: int
+
+
+@dataclass
+class CoverageStats:
+    candidates: int = 0
+    selected: int = 0
+    active: int = 0
+    active_covered: int = 0
+    staleness_p50: float = None
+    staleness_p95: float = None
+    timestamp: int = None
+
+    @property
+    def coverage(self):
+        return self.active_covered / self.active if self.active else None
+
+
+class PriorityState:
+    """Last coverage stats per region, reported by log_app_state"""
+
+    lock = Lock()
+    stats = {}
+
+    @classmethod
+    def set(cls, region_id, stats):
+        with cls.lock:
+            cls.stats[region_id] = stats
+
+    @classmethod
+    def get(cls):
+        with cls.lock:
+            return dict(cls.stats)
+
+
+def cycle_budget():
+    """Match history calls available to one region in one polling cycle"""
+    return int(REQUEST_MAX_PER_DAY * MATCH_HISTORY_BUDGET_SHARE / MATCH_HISTORY_CYCLES_PER_DAY / len(RegionId))
+
+
+def query_candidates(session, region_id):
+    """
+    Every profile on a current season ladder with its recent MMR change count, of its
+    characters and of the teams it plays in, and its best league
+    """
+
+    lookback = datetime_to_epoch(datetime.now() - timedelta(0, MATCH_PRIORITY_WINDOW))
+    season_id = session.query(func.max(League.season_id)).filter(League.region_id == region_id).scalar_subquery()
+    activity = (
+        session.query(Character.profile_id, func.count(CharacterMMR.id).label("changes"))
+        .join(CharacterMMR, CharacterMMR.character_id == Character.id)
+        .filter(CharacterMMR.date > lookback)
+        .group_by(Character.profile_id)
+        .subquery()
+    )
+    # Teams are keyed by their members' Blizzard ids, see ladder_result.team_key
+    team_members = (
+        session.query(func.unnest(func.string_to_array(Team.team_key, ",")).label("member_key"), TeamMMR.id)
+        .join(TeamMMR, TeamMMR.team_id == Team.id)
+        .filter((Team.region_id == region_id), (TeamMMR.date > lookback))
+        .subquery()
+    )
+    team_activity = (
+        session.query(team_members.c.member_key, func.count(team_members.c.id).label("changes"))
+        .group_by(team_members.c.member_key)
+        .subquery()
+    )
+    leagues = (
+        session.query(LadderMember.profile_id, func.max(League.league_id).label("league_id"))
+        .join(Ladder, Ladder.id == LadderMember.ladder_id)
+        .join(League, League.id == Ladder.league_id)
+        .filter((League.region_id == region_id), (League.season_id == season_id))
+        .group_by(LadderMember.profile_id)
+        .subquery()
+    )
+    return (
+        session.query(
+            Profile.id,
+            Profile.realm_id,
+            Profile.profile_id,
+            Profile.match_history_timestamp,
+            Profile.match_history_polled_timestamp,
+            func.coalesce(activity.c.changes, 0) + func.coalesce(team_activity.c.changes, 0),
+            leagues.c.league_id,
+        )
+        .join(leagues, leagues.c.profile_id == Profile.id)
+        .outerjoin(activity, activity.c.profile_id == Profile.id)
+        .outerjoin(
+            team_activity,
+            team_activity.c.member_key == func.concat_ws("-", Profile.region_id, Profile.realm_id, Profile.profile_id),
+        )
+        .filter(Profile.region_id == region_id)
+        .all()
+    )
+
+
+def score_profiles(changes, league_id, polled, now):
+    """
+    Higher is more urgent. Combines how often the profile's MMR moved recently, how high
+    it is on the ladder and how long since its history was last polled. Never polled
+    profiles count as maximally stale.
+    """
+    staleness = np.where(polled >= 0, now - polled, MATCH_PRIORITY_STALENESS_CAP)
+    staleness = np.minimum(staleness, MATCH_PRIORITY_STALENESS_CAP) / MATCH_PRIORITY_STALENESS_CAP
+    activity = np.log1p(changes)
+    league = league_id / max(league.value for league in LeagueId)
+    return (
+        MATCH_PRIORITY_ACTIVITY_WEIGHT * activity
+        + MATCH_PRIORITY_LEAGUE_WEIGHT * league
+        + MATCH_PRIORITY_STALENESS_WEIGHT * staleness
+    ) * (changes > 0)
+
+
+def coverage_stats(changes, polled, now, selected):
+    stats = CoverageStats(candidates=len(changes), selected=selected, timestamp=now)
+    active = changes > 0
+    stats.active = int(active.sum())
+    if not stats.active:
+        return stats
+
+    # Never polled profiles are infinitely stale
+    staleness = np.where(polled[active] >= 0, now - polled[active], np.inf)
+    stats.active_covered = int((staleness <= MATCH_PRIORITY_STALENESS_CAP).sum())
+    stats.staleness_p50, stats.staleness_p95 = np.percentile(staleness, [50, 95], method="inverted_cdf").tolist()
+    return stats
+
+
+def select_profiles(session, region_id, limit=None):
+    """
+    Top profiles by score for this cycle's share of the daily API budget. Profiles with
+    no recent MMR change are never selected since their history cannot have changed.
+    """
+    if limit is None:
+        limit = cycle_budget()
+
+    rows = query_candidates(session, region_id=region_id)
+    now = current_epoch_time()
+    if not rows:
+        PriorityState.set(region_id, CoverageStats(timestamp=now))
+        return []
+
+    ids, realm_ids, profile_ids, marks, polled, changes, league_ids = zip(*rows)
+    polled = np.fromiter((-1 if value is None else value for value in polled), dtype=np.int64, count=len(rows))
+    changes = np.asarray(changes, dtype=np.int64)
+    scores = score_profiles(changes, np.asarray(league_ids, dtype=np.float64), polled, now)
+
+    eligible = np.flatnonzero(scores > 0)
+    if limit <= 0:
+        eligible = eligible[:0]
+    elif len(eligible) > limit:
+        eligible = eligible[np.argpartition(-scores[eligible], limit - 1)[:limit]]
+    selected = eligible[np.argsort(-scores[eligible], kind="stable")].tolist()
+
+    PriorityState.set(region_id, coverage_stats(changes, polled, now, selected=len(selected)))
+    return [
+        ProfileCandidate(
+            id=ids[i],
+            region_id=region_id,
+            realm_id=realm_ids[i],
+            profile_id=profile_ids[i],
+            match_history_timestamp=marks[i],
+        )
+        for i in selected
+    ]
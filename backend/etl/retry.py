@@ -0,0 +1,199 @@
+"""
+Persistent queue of API requests that failed and should be replayed by the drainer
+"""
+
+import dataclasses
+import uuid
+from dataclasses import dataclass
+from typing import Any, Optional
+
+from sqlalchemy import case, delete, func, update
+
+from backend.api.blizzard import ApiError, ApiNotFoundError, DeadlineExceededError
+from backend.db.db import bulk_upsert, insert_stmt, query, session_scope
+from backend.db.model import RetryRequest
+from backend.static import (
+    RETRY_BACKOFF,
+    RETRY_BACKOFF_MAX,
+    RETRY_MAX_ATTEMPTS,
+    RETRY_PRIORITY,
+    RETRY_REQUEST_UNIQUE_CONSTRAINT,
+)
+from backend.utils.datetime import current_epoch_time
+from backend.utils.ids import uuid7
+from backend.utils.log import get_logger
+
+logger = get_logger(__name__)
+
+
+@dataclass
+class Deferral:
+    """A failed fetch of future, a job's dataclass describing the request"""
+
+    kind: str
+    future: Any
+    error: Exception
+    url: Optional[str] = None
+
+
+@dataclass
+class RetryStats:
+    region_id: int
+    kind: str
+    pending: int = 0
+    due: int = 0
+    dead: int = 0
+
+
+def is_deferrable(error):
+    """
+    API failures other than 404 may succeed later. Validation errors will not, and work cut
+    off by a job's deadline is picked up by the job's next run.
+    """
+    return isinstance(error, ApiError) and not isinstance(error, (ApiNotFoundError, DeadlineExceededError))
+
+
+def future_payload(future):
+    return {
+        key: str(value) if isinstance(value, uuid.UUID) else value for key, value in dataclasses.asdict(future).items()
+    }
+
+
+def future_from_payload(cls, payload):
+    values = dict(payload)
+    for field in dataclasses.fields(cls):
+        if field.type is uuid.UUID and values.get(field.name) is not None:
+            values[field.name] = uuid.UUID(values[field.name])
+    return cls(**values)
+
+
+def defer_requests(deferrals):
+    """
+    Record failed requests, one row per kind and url. A request already queued has its
+    attempt count bumped and its next attempt pushed back exponentially. Requests are dead
+    lettered after RETRY_MAX_ATTEMPTS attempts or once they 404.
+    """
+    now = current_epoch_time()
+    values = {}
+    for deferral in deferrals:
+        url = deferral.url or getattr(deferral.error, "url", None)
+        if not url:
+            logger.error(f"Cannot defer {deferral.kind} request without a url: {deferral.error!r}")
+            continue
+
+        values[(deferral.kind, url)] = {
+            "id": uuid7(),
+            "kind": deferral.kind,
+            "region_id": deferral.future.region_id,
+            "url": url,
+            "payload": future_payload(deferral.future),
+            "priority": RETRY_PRIORITY[deferral.kind],
+            "attempts": 1,
+            "next_attempt_timestamp": now + RETRY_BACKOFF,
+            "created_timestamp": now,
+            "last_status": getattr(deferral.error, "status_code", None),
+            "last_error": repr(deferral.error)[:1000],
+            "dead_timestamp": None,
+        }
+
+    if not values:
+        return
+
+    with session_scope() as session:
+        stmt = insert_stmt(model=RetryRequest, values=list(values.values()))
+        attempts = RetryRequest.attempts + 1
+        bulk_upsert(
+            session,
+            stmt=stmt,
+            constraint=RETRY_REQUEST_UNIQUE_CONSTRAINT,
+            set_={
+                "attempts": attempts,
+                "next_attempt_timestamp": now
+                + func.least(RETRY_BACKOFF * func.power(2, RetryRequest.attempts), RETRY_BACKOFF_MAX).cast(
+                    RetryRequest.next_attempt_timestamp.type
+                ),
+                "last_status": stmt.excluded.last_status,
+                "last_error": stmt.excluded.last_error,
+                "dead_timestamp": func.coalesce(
+                    RetryRequest.dead_timestamp,
+                    case(((attempts >= RETRY_MAX_ATTEMPTS) | (stmt.excluded.last_status == 404), now), else_=None),
+                ),
+            },
+        )
+
+    logger.info(f"Deferred {len(values)} failed requests for retry.")
+
+
+def dead_letter_requests(failures):
+    """
+    Dead letter queued requests, [(id, error)], that failed in a way retrying will not fix,
+    like a 404 or a response that does not validate
+    """
+    if not failures:
+        return
+
+    now = current_epoch_time()
+    with session_scope() as session:
+        session.execute(
+            update(RetryRequest),
+            [
+                {
+                    "id": id,
+                    "dead_timestamp": now,
+                    "last_status": getattr(error, "status_code", None),
+                    "last_error": repr(error)[:1000],
+                }
+                for id, error in failures
+            ],
+        )
+
+    logger.info(f"Dead lettered {len(failures)} requests that will not succeed on retry.")
+
+
+def due_requests(session, region_id, limit):
+    """Live requests whose next attempt is due, most important first"""
+    return query(
+        session,
+        params=[
+            RetryRequest.id,
+            RetryRequest.kind,
+            RetryRequest.url,
+            RetryRequest.payload,
+            RetryRequest.attempts,
+        ],
+        filters=[
+            (RetryRequest.region_id == region_id),
+            (RetryRequest.dead_timestamp == None),  # noqa E711
+            (RetryRequest.next_attempt_timestamp <= current_epoch_time()),
+        ],
+        order_by=(RetryRequest.priority.desc(), RetryRequest.next_attempt_timestamp),
+        limit=limit,
+    )
+
+
+def complete_requests(ids):
+    if not ids:
+        return
+
+    with session_scope() as session:
+        session.execute(delete(RetryRequest).where(RetryRequest.id.in_(ids)))
+
+
+def retry_stats(session):
+    now = current_epoch_time()
+    live = RetryRequest.dead_timestamp == None  # noqa E711
+    rows = (
+        session.query(
+            RetryRequest.region_id,
+            RetryRequest.kind,
+            func.count().filter(live),
+            func.count().filter(live & (RetryRequest.next_attempt_timestamp <= now)),
+            func.count().filter(~live),
+        )
+        .group_by(RetryRequest.region_id, RetryRequest.kind)
+        .all()
+    )
+    return [
+        RetryStats(region_id=region_id, kind=kind, pending=pending, due=due, dead=dead)
+        for region_id, kind, pending, due, dead in sorted(rows)
+    ]
@@ -0,0 +1,202 @@
+"""
+Hourly and daily open/high/low/close rollups of character MMR history, so a chart reads
+one row per bucket instead of every raw poll. Rollups are merged incrementally from each
+batch of new character_mmr rows. Merging is idempotent, the same rows can be rolled up
+again, which lets compaction roll up raw history before downsampling it.
+"""
+
+from datetime import datetime
+
+from more_itertools import chunked
+from sqlalchemy import case, func, text
+
+from backend.db.db import bulk_upsert, insert_stmt, query, session_scope
+from backend.db.model import Character, CharacterMMR, CharacterMMRRollup, Profile
+from backend.static import (
+    CHARACTER_MMR_COMPACTION_LOOKBACK,
+    CHARACTER_MMR_DOWNSAMPLE_RESOLUTION,
+    CHARACTER_MMR_RETENTION,
+    CHARACTER_MMR_ROLLUP_RESOLUTIONS,
+    CHARACTER_MMR_ROLLUP_UNIQUE_CONSTRAINT,
+    MATCH_BATCH_SIZE,
+)
+from backend.utils.datetime import current_epoch_time
+from backend.utils.ids import uuid7
+from backend.utils.log import get_logger
+
+logger = get_logger(__name__)
+
+DAY = 86400
+
+# Keep the last raw row per (character, race, bucket) of a region's window
+DOWNSAMPLE_STMT = text(
+    """
+    DELETE FROM character_mmr WHERE id IN (
+        SELECT id FROM (
+            SELECT character_mmr.id, row_number() OVER (
+                PARTITION BY character_mmr.character_id, character_mmr.race, character_mmr.date / :resolution
+                ORDER BY character_mmr.date DESC, character_mmr.id DESC
+            ) AS position
+            FROM character_mmr
+            JOIN character ON character.id = character_mmr.character_id
+            JOIN profile ON profile.id = character.profile_id
+            WHERE profile.region_id = :region_id AND character_mmr.date >= :start AND character_mmr.date < :end
+        ) ranked WHERE position > 1
+    )
+    """
+)
+
+
+def bucket_start(date, resolution):
+    return date - date % resolution
+
+
+def rollup_rows(character_mmrs, resolutions=CHARACTER_MMR_ROLLUP_RESOLUTIONS):
+    """
+    Aggregate (character_id, race, mmr, date, wins, losses) rows, or CharacterMMR instances,
+    to one rollup dict per (character_id, race, resolution, bucket).
+    """
+    rollups = {}
+    for mmr in character_mmrs:
+        for resolution in resolutions:
+            bucket = bucket_start(mmr.date, resolution)
+            key = (mmr.character_id, mmr.race, resolution, bucket)
+            rollup = rollups.get(key)
+            if rollup is None:
+                rollups[key] = {
+                    "id": uuid7(),
+                    "character_id": mmr.character_id,
+                    "race": mmr.race,
+                    "resolution": resolution,
+                    "bucket": bucket,
+                    "open": mmr.mmr,
+                    "high": mmr.mmr,
+                    "low": mmr.mmr,
+                    "close": mmr.mmr,
+                    "open_date": mmr.date,
+                    "close_date": mmr.date,
+                    "wins": mmr.wins,
+                    "losses": mmr.losses,
+                }
+                continue
+
+            rollup["high"] = max(rollup["high"], mmr.mmr)
+            rollup["low"] = min(rollup["low"], mmr.mmr)
+            if mmr.date < rollup["open_date"]:
+                rollup["open"], rollup["open_date"] = mmr.mmr, mmr.date
+            if mmr.date >= rollup["close_date"]:
+                rollup["close"], rollup["close_date"] = mmr.mmr, mmr.date
+                rollup["wins"], rollup["losses"] = mmr.wins, mmr.losses
+    return list(rollups.values())
+
+
+def upsert_rollups(session, rollups):
+    """Merge rollup dicts into stored buckets, keeping the earliest open and latest close"""
+    for batch in chunked(rollups, MATCH_BATCH_SIZE):
+        stmt = insert_stmt(model=CharacterMMRRollup, values=batch)
+        later_close = stmt.excluded.close_date >= CharacterMMRRollup.close_date
+        bulk_upsert(
+            session,
+            stmt=stmt,
+            constraint=CHARACTER_MMR_ROLLUP_UNIQUE_CONSTRAINT,
+            set_={
+                "high": func.greatest(CharacterMMRRollup.high, stmt.excluded.high),
+                "low": func.least(CharacterMMRRollup.low, stmt.excluded.low),
+                "open": case(
+                    (stmt.excluded.open_date < CharacterMMRRollup.open_date, stmt.excluded.open),
+                    else_=CharacterMMRRollup.open,
+                ),
+                "open_date": func.least(CharacterMMRRollup.open_date, stmt.excluded.open_date),
+                "close": case((later_close, stmt.excluded.close), else_=CharacterMMRRollup.close),
+                "close_date": func.greatest(CharacterMMRRollup.close_date, stmt.excluded.close_date),
+                "wins": case((later_close, stmt.excluded.wins), else_=CharacterMMRRollup.wins),
+                "losses": case((later_close, stmt.excluded.losses), else_=CharacterMMRRollup.losses),
+            },
+        )
+
+
+def rollup_character_mmrs(session, character_mmrs):
+    rollups = rollup_rows(character_mmrs)
+    upsert_rollups(session, rollups)
+    return len(rollups)
+
+
+def character_mmr_history(session, character_id, race, start, end, resolution=DAY):
+    """Rollups of a character's race with buckets overlapping [start, end), oldest first"""
+    return query(
+        session,
+        params={CharacterMMRRollup},
+        filters=[
+            (CharacterMMRRollup.character_id == character_id),
+            (CharacterMMRRollup.race == race),
+            (CharacterMMRRollup.resolution == resolution),
+            (CharacterMMRRollup.bucket >= bucket_start(start, resolution)),
+            (CharacterMMRRollup.bucket < end),
+        ],
+        order_by=CharacterMMRRollup.bucket,
+    )
+
+
+def compact_day(region_id, start):
+    """Roll up then downsample a region's raw history of the day starting at start"""
+    end = start + DAY
+    with session_scope() as session:
+        character_mmrs = query(
+            session,
+            params=[
+                CharacterMMR.character_id,
+                CharacterMMR.race,
+                CharacterMMR.mmr,
+                CharacterMMR.date,
+                CharacterMMR.wins,
+                CharacterMMR.losses,
+            ],
+            joins=[
+                (Character, Character.id == CharacterMMR.character_id),
+                (Profile, Profile.id == Character.profile_id),
+            ],
+            filters=[
+                (Profile.region_id == region_id),
+                (CharacterMMR.date >= start),
+                (CharacterMMR.date < end),
+            ],
+            yield_per=MATCH_BATCH_SIZE,
+        )
+        rollups = rollup_character_mmrs(session, character_mmrs)
+        result = session.execute(
+            DOWNSAMPLE_STMT,
+            {"resolution": CHARACTER_MMR_DOWNSAMPLE_RESOLUTION, "region_id": region_id, "start": start, "end": end},
+        )
+    return rollups, result.rowcount
+
+
+def compact_character_mmr(**kwargs):
+    """
+    Downsample raw MMR history older than the retention window. Each day is rolled up
+    first, so no open, high, low or close is lost, and runs in its own transaction. Days
+    in the lookback before retention are revisited every run, which is cheap once they are
+    compacted. Pass since to compact an older backlog.
+    """
+    region_id = kwargs.get("region_id")
+    if not region_id:
+        logger.warning("Missing required param region_id")
+        return
+
+    logger.info(f"Starting compaction of character MMR history for {region_id=}...")
+    start = datetime.now()
+
+    cutoff = bucket_start(current_epoch_time() - CHARACTER_MMR_RETENTION, DAY)
+    since = kwargs.get("since") or cutoff - CHARACTER_MMR_COMPACTION_LOOKBACK
+    rollups = 0
+    deleted = 0
+    for day in range(bucket_start(int(since), DAY), cutoff, DAY):
+        day_rollups, day_deleted = compact_day(region_id, day)
+        rollups += day_rollups
+        deleted += day_deleted
+
+    end = datetime.now()
+    logger.info(f"Merged {rollups} rollups and deleted {deleted} raw character MMR rows for {region_id=}.")
+    logger.info(
+        f"Compacting character MMR history for {region_id=} took {round(end.timestamp() - start.timestamp())} seconds."
+    )
+    logger.info(f"Done with compaction of character MMR history for {region_id=}.")
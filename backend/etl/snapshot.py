@@ -0,0 +1,85 @@
+"""
+Change detection for legacy ladder payloads: a content hash per ladder and a per-member
+fingerprint cache of the previous snapshot
+"""
+
+import hashlib
+import json
+from collections import OrderedDict
+from threading import Lock
+
+from backend.static import LADDER_MEMBER_CACHE_SIZE
+
+
+def content_hash(payload):
+    """Stable digest of a JSON payload, independent of key order"""
+    return hashlib.blake2b(
+        json.dumps(payload, sort_keys=True, separators=(",", ":")).encode(), digest_size=16
+    ).hexdigest()
+
+
+def member_key(ladder_member):
+    character = ladder_member.character
+    return (character.region_id, character.realm_id, character.profile_id, ladder_member.join_timestamp)
+
+
+def member_fingerprint(ladder_member):
+    character = ladder_member.character
+    return hash(
+        (
+            character.display_name,
+            character.clan_name,
+            character.clan_tag,
+            character.profile_path,
+            ladder_member.points,
+            ladder_member.wins,
+            ladder_member.losses,
+            ladder_member.highest_rank,
+            ladder_member.previous_rank,
+            ladder_member.race,
+        )
+    )
+
+
+class LadderMemberCache:
+    """Bounded LRU of {member key: fingerprint} per ladder (Ladder.id), as last written"""
+
+    lock = Lock()
+    entries = OrderedDict()
+
+    @classmethod
+    def changed(cls, ladder_id, ladder_members):
+        """
+        Members that are new or differ from the cached snapshot of the ladder, and the
+        fingerprints to cache once they are written. Every member counts as changed when
+        the ladder is not cached.
+        """
+        with cls.lock:
+            previous = cls.entries.get(ladder_id, {})
+            if ladder_id in cls.entries:
+                cls.entries.move_to_end(ladder_id)
+
+        fingerprints = {}
+        changed = []
+        for ladder_member in ladder_members:
+            key = member_key(ladder_member)
+            fingerprints[key] = member_fingerprint(ladder_member)
+            if previous.get(key) != fingerprints[key]:
+                changed.append(ladder_member)
+
+        return changed, fingerprints
+
+    @classmethod
+    def departed(cls, ladder_id, fingerprints):
+        """Keys of the cached snapshot of the ladder missing from fingerprints, None when not cached"""
+        with cls.lock:
+            previous = cls.entries.get(ladder_id)
+        return None if previous is None else previous.keys() - fingerprints.keys()
+
+    @classmethod
+    def set(cls, ladder_id, fingerprints):
+        with cls.lock:
+            cls.entries[ladder_id] = fingerprints
+            cls.entries.move_to_end(ladder_id)
+            while len(cls.entries) > LADDER_MEMBER_CACHE_SIZE:
+                cls.entries.popitem(last=False)
@@ -0,0 +1,122 @@
+"""
+Async consumer of the change feed, for dashboards, alerting and other downstream systems
+
+    async def handle(event):
+        ...
+
+    await ChangeFeedConsumer(dsn, name="alerts", handler=handle, tables={"character_mmr"}).run()
+
+Delivery is at-least-once: a consumer's cursor only advances after its handler returned,
+so an event may be handled again after a crash and handlers should be idempotent.
+"""
+
+import asyncio
+import time
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Optional
+
+import asyncpg
+
+from backend.static import (
+    CHANGE_FEED_BATCH_SIZE,
+    CHANGE_FEED_CHANNEL,
+    CHANGE_FEED_POLL_INTERVAL,
+)
+from backend.utils.log import get_logger
+
+logger = get_logger(__name__)
+
+# Events of transactions older than the snapshot's xmin have all committed or aborted, so
+# nothing can still appear behind the cursor
+SELECT_EVENTS = """
+SELECT id, transaction_id, batch_id, table_name, rows, region_id, min_timestamp, max_timestamp, created_timestamp
+FROM change_event
+WHERE (transaction_id, id) > ($1, $2)
+    AND transaction_id < txid_snapshot_xmin(txid_current_snapshot())
+    AND ($3::text[] IS NULL OR table_name = ANY($3::text[]))
+ORDER BY transaction_id, id
+LIMIT $4
+"""
+
+SELECT_CURSOR = "SELECT last_transaction_id, last_event_id FROM change_feed_cursor WHERE consumer = $1"
+
+UPSERT_CURSOR = """
+INSERT INTO change_feed_cursor (consumer, last_transaction_id, last_event_id, updated_timestamp)
+VALUES ($1, $2, $3, $4)
+ON CONFLICT (consumer) DO UPDATE
+SET last_transaction_id = EXCLUDED.last_transaction_id,
+    last_event_id = EXCLUDED.last_event_id,
+    updated_timestamp = EXCLUDED.updated_timestamp
+"""
+
+
+@dataclass
+class Change:
+    id: int
+    transaction_id: int
+    batch_id: str
+    table_name: str
+    rows: int
+    region_id: Optional[int]
+    min_timestamp: Optional[int]
+    max_timestamp: Optional[int]
+    created_timestamp: int
+
+
+class ChangeFeedConsumer:
+    def __init__(
+        self,
+        dsn,
+        name: str,
+        handler: Callable[[Change], Awaitable[None]],
+        tables=None,
+        batch_size=CHANGE_FEED_BATCH_SIZE,
+        poll_interval=CHANGE_FEED_POLL_INTERVAL,
+    ):
+        self.dsn = dsn
+        self.name = name
+        self.handler = handler
+        self.tables = sorted(tables) if tables else None
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.stopped = asyncio.Event()
+        self.wake = asyncio.Event()
+
+    def stop(self):
+        self.stopped.set()
+        self.wake.set()
+
+    def notify(self, connection, pid, channel, payload):
+        self.wake.set()
+
+    async def cursor(self, connection):
+        row = await connection.fetchrow(SELECT_CURSOR, self.name)
+        return (row["last_transaction_id"], row["last_event_id"]) if row else (0, 0)
+
+    async def drain(self, connection):
+        """Handle the next batch of events in order. Returns the number handled."""
+        transaction_id, event_id = await self.cursor(connection)
+        rows = await connection.fetch(SELECT_EVENTS, transaction_id, event_id, self.tables, self.batch_size)
+        for row in rows:
+            await self.handler(Change(**{**dict(row), "batch_id": str(row["batch_id"])}))
+            await connection.execute(UPSERT_CURSOR, self.name, row["transaction_id"], row["id"], int(time.time()))
+        return len(rows)
+
+    async def run(self):
+        """Consume until stop() is called. Wakes on NOTIFY, or every poll_interval as a fallback."""
+        connection = await asyncpg.connect(self.dsn)
+        await connection.add_listener(CHANGE_FEED_CHANNEL, self.notify)
+        logger.info(f"Consumer {self.name} listening on {CHANGE_FEED_CHANNEL}...")
+        try:
+            while not self.stopped.is_set():
+                self.wake.clear()
+                if await self.drain(connection) >= self.batch_size:
+                    continue
+
+                try:
+                    await asyncio.wait_for(self.wake.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            await connection.remove_listener(CHANGE_FEED_CHANNEL, self.notify)
+            await connection.close()
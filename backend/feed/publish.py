@@ -0,0 +1,65 @@
+"""
+Change events published by ETL write paths, through the change_event outbox and NOTIFY
+"""
+
+import json
+from datetime import datetime
+
+from sqlalchemy import delete, func, insert, select
+
+from backend.db.db import session_scope
+from backend.db.model import ChangeEvent
+from backend.static import CHANGE_EVENT_RETENTION, CHANGE_FEED_CHANNEL
+from backend.utils.datetime import current_epoch_time
+from backend.utils.ids import uuid7
+from backend.utils.log import get_logger
+
+logger = get_logger(__name__)
+
+
+def new_batch_id():
+    return uuid7()
+
+
+def publish_change(session, batch_id, table_name, rows, timestamps=(), region_id=None):
+    """
+    Record a compact event for a write of rows to table_name, spanning timestamps, in the
+    writer's transaction. The NOTIFY is only delivered if that transaction commits, and the
+    outbox row lets consumers catch up on anything they missed while disconnected.
+    """
+    if not rows:
+        return None
+
+    values = {
+        "batch_id": batch_id,
+        "table_name": table_name,
+        "rows": rows,
+        "region_id": region_id,
+        "min_timestamp": min(timestamps, default=None),
+        "max_timestamp": max(timestamps, default=None),
+        "created_timestamp": current_epoch_time(),
+    }
+    event_id = session.execute(insert(ChangeEvent).values(values).returning(ChangeEvent.id)).scalar_one()
+    session.execute(
+        select(
+            func.pg_notify(
+                CHANGE_FEED_CHANNEL,
+                json.dumps({"id": event_id, "table": table_name, "batch_id": str(batch_id)}, separators=(",", ":")),
+            )
+        )
+    )
+    return event_id
+
+
+def prune_change_events(**kwargs):
+    logger.info("Starting prune of change events...")
+    start = datetime.now()
+
+    cutoff = current_epoch_time() - CHANGE_EVENT_RETENTION
+    with session_scope() as session:
+        result = session.execute(delete(ChangeEvent).where(ChangeEvent.created_timestamp < cutoff))
+
+    end = datetime.now()
+    logger.info(f"Pruned {result.rowcount} change events.")
+    logger.info(f"Pruning change events took {round(end.timestamp() - start.timestamp())} seconds.")
+    logger.info("Done with prune of change events.")
@@ -8,17 +8,88 @@ load_dotenv()
 
 # Paths
 APPLICATION_LOG_PATH = Path("/app/log/sc2_stats.log")
+EXPORT_PATH = Path("/app/export")
+EXPORT_SETTLE_SECONDS = 300  # Rows ingested more recently may belong to transactions not yet committed
+PROFILE_PATH = Path("/app/profile")
+ARCHIVE_PATH = Path("/app/archive")
+
+# Archive
+ARCHIVE_ENABLED = os.environ.get("ARCHIVE_ENABLED", "true").lower() == "true"
+ARCHIVE_SEGMENT_BYTES = 256 * 1024 * 1024  # Uncompressed bytes before a segment is closed
+ARCHIVE_SEGMENT_SECONDS = 3600  # Age before a segment is closed
+ARCHIVE_ZSTD_LEVEL = 3
+ARCHIVE_QUEUE_SIZE = 10000  # Responses waiting for the writer thread, responses are dropped rather than block when full
+ARCHIVE_FLUSH_RECORDS = 1000  # Records between flushes of the open segment
+
+# Profiling
+PROFILE_INTERVAL = 0.01  # Seconds between stack samples
+PROFILE_SECONDS = 60  # Duration of a profile started by signal when the request does not set one
+PROFILE_REQUEST_FILE = "request"  # In PROFILE_PATH, "<job> [seconds]" read on SIGUSR1 to profile a single job
+
+# Logging
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text")  # text or json
+LOG_QUEUE_SIZE = 10000  # Records waiting for the writer thread, records are dropped rather than block when full
+LOG_SAMPLE_RATES = {  # Max INFO records per second of hot path loggers, warnings and errors are never sampled
+    "backend.api.blizzard.requests": 5,
+    "backend.etl.ladder_result.mmr": 5,
+}
 
 # API
 BLIZZARD_OATH_BASE = "https://oauth.battle.net"
 BLIZZARD_API_BASE = "https://{region}.api.blizzard.com"
 BLIZZARD_CLIENT_ID = os.environ.get("BLIZZARD_CLIENT_ID")
 BLIZZARD_CLIENT_SECRET = os.environ.get("BLIZZARD_CLIENT_SECRET")
+OAUTH_REFRESH_MARGIN = 600  # Seconds before expiry a token is refreshed
+OAUTH_ADVISORY_LOCK = 20315001  # pg_advisory_xact_lock key held by the process refreshing the shared token
 REQUEST_MAX_PER_SECOND = int(100 * 0.95)  # Blizzard max 100
 REQUEST_MAX_PER_DAY = int(36000 * 0.95)  # Blizzard max 36,000
+REQUEST_TIMEOUT = (3.05, 10)  # (connect, read) seconds of endpoints without their own
+REQUEST_TIMEOUTS = {
+    "oauth": (3.05, 10),
+    "league": (3.05, 10),
+    "ladder_season": (3.05, 5),
+    "profile_ladder": (3.05, 10),
+    "legacy_ladder": (3.05, 30),  # Full ladders of up to 100 members
+    "legacy_match_history": (3.05, 10),
+}
+REQUEST_HEDGE_ENDPOINTS = {"profile_ladder", "legacy_match_history"}  # Small idempotent reads, empty to disable
+REQUEST_HEDGE_QUANTILE = 0.95  # A duplicate is sent once a request is slower than this quantile of recent ones
+REQUEST_HEDGE_MIN_DELAY = 0.1
+REQUEST_HEDGE_MIN_SAMPLES = 50  # Latencies recorded before an endpoint is hedged
+REQUEST_LATENCY_WINDOW = 500  # Recent latencies kept per endpoint
+REQUEST_HEDGE_BUDGET_RATIO = 0.05  # Each request earns this many hedges, per region host
+REQUEST_HEDGE_BUDGET_INITIAL = 5
+REQUEST_HEDGE_BUDGET_MAX = 50
+BACKFILL_REQUEST_SHARE = 0.2  # Max share of the rate limit spent on backfill, the rest is reserved for live ETL
+REQUEST_RETRY_ATTEMPTS = 4
+REQUEST_BACKOFF_MULTIPLIER = 0.5  # Full jitter, wait is uniform in [0, multiplier * 2 ** attempt]
+REQUEST_BACKOFF_MAX = 8
+REQUEST_RETRY_BUDGET_RATIO = 0.1  # Each request earns this many retries, per region host
+REQUEST_RETRY_BUDGET_INITIAL = 10  # Retries available to a host before it has earned any
+REQUEST_RETRY_BUDGET_MAX = 100
+CIRCUIT_FAILURE_THRESHOLD = 5  # Consecutive failed requests before a region host is cut off
+CIRCUIT_RESET_TIMEOUT = 60  # Seconds an open circuit waits before letting a probe request through
+
+# Retry
+RETRY_BACKOFF = 60  # Doubled on every failed attempt of a deferred request
+RETRY_BACKOFF_MAX = 3600
+RETRY_MAX_ATTEMPTS = 6  # Then the request is dead lettered
+RETRY_DRAIN_BUDGET_SHARE = 0.1  # Share of REQUEST_MAX_PER_DAY spent draining retries, split across regions
+RETRY_DRAIN_RUNS_PER_DAY = 1440  # Retries are drained every minute
+RETRY_PRIORITY = {"league": 3, "legacy_ladder": 2, "profile_ladder": 1, "match_history": 0}  # Keyed by RetryKind
 
 # Match
-MATCH_LOOKUP_KEY = "{map}_{type}_{date}_{speed}"
+MATCH_LOOKUP_KEY = "{region_id}_{map}_{type}_{speed}"
+MATCH_PAIR_WINDOW = 120  # Max seconds between the legacy end timestamps reported for one game
+MATCH_SPEED = "FASTER"
+MATCH_HISTORY_BUDGET_SHARE = 0.3  # Share of REQUEST_MAX_PER_DAY spent on match history, split across regions
+MATCH_HISTORY_CYCLES_PER_DAY = 96  # Match history is polled every 15 minutes
+MATCH_PRIORITY_WINDOW = 86400  # MMR changes this recent count towards a profile's activity
+MATCH_PRIORITY_STALENESS_CAP = 86400  # Profiles not polled for this long are maximally stale
+MATCH_PRIORITY_ACTIVITY_WEIGHT = 1.0
+MATCH_PRIORITY_LEAGUE_WEIGHT = 0.5
+MATCH_PRIORITY_STALENESS_WEIGHT = 1.0
+INFERENCE_MAX_GAMES = 20  # Guard against counter jumps after an outage or a ladder reset
 MATCH_LOOKBACK_MAX = 86400  # Assume games will be reported within 24 hours
 MATCH_LOOKBACK_MIN = 3600 * 7  # Maximum game time 6hours, 30mins, 6seconds. Round to 7hrs for API time buffer
 
@@ -26,6 +97,43 @@ MATCH_LOOKBACK_MIN = 3600 * 7  # Maximum game time 6hours, 30mins, 6seconds. Rou
 LADDER_BATCH_SIZE = 50
 PROFILE_BATCH_SIZE = 500
 MATCH_BATCH_SIZE = 5000
+EXPORT_BATCH_SIZE = 50000
+BACKFILL_BATCH_SIZE = 500  # Ladders per COPY batch and checkpoint
+LADDER_MEMBER_CACHE_SIZE = 50000  # Ladders whose last member snapshot is kept for diffing
+LADDER_POLL_CACHE_SIZE = 50000  # Ladders whose last results poll time is kept for match inference
+PROFILE_IDENTITY_CACHE_BYTES = 64 * 1024 * 1024  # Approximate memory cap of the Profile.id cache
+CHARACTER_IDENTITY_CACHE_BYTES = 64 * 1024 * 1024  # Approximate memory cap of the Character.id cache
+
+# Analytics
+MMR_HISTOGRAM_BIN_WIDTH = 100
+MMR_PERCENTILES = (1, 5, 10, 25, 50, 75, 90, 95, 99)
+LEAGUE_CUTOFF_PERCENTILE = 2.5  # Low tail of a league, ignores players that have not been re-placed yet
+ANALYTICS_SNAPSHOT_INTERVAL = 3600
+ANALYTICS_DRIFT_BUCKET = 86400
+ANALYTICS_CACHE_SIZE = 32
+
+# MMR history
+CHARACTER_MMR_ROLLUP_RESOLUTIONS = (3600, 86400)  # Hourly and daily open/high/low/close buckets
+CHARACTER_MMR_RETENTION = 86400 * 30  # Raw history older than this is downsampled
+CHARACTER_MMR_DOWNSAMPLE_RESOLUTION = 3600  # Past retention only the last raw row per bucket is kept
+CHARACTER_MMR_COMPACTION_LOOKBACK = 86400 * 7  # Each compaction revisits this much history before retention
+
+# Ladder history
+LADDER_HISTORY_KEYFRAME_INTERVAL = 86400  # Full standings of a ladder at most this often, deltas in between
+LADDER_HISTORY_FIELDS = ("points", "wins", "losses", "highest_rank", "previous_rank", "race")
+
+# Scheduling
+LADDER_RESULTS_INTERVAL_MINUTES = {201: 1, 202: 5, 203: 10, 204: 10, 206: 10}  # Keyed by QueueId
+
+# Async persistence
+ASYNC_DB_POOL_SIZE = 4  # Writes are batched, a few connections keep up with many fetches
+ASYNC_DB_MAX_OVERFLOW = 0
+
+# Change feed
+CHANGE_FEED_CHANNEL = "sc2_stats_changes"
+CHANGE_FEED_BATCH_SIZE = 500
+CHANGE_FEED_POLL_INTERVAL = 30  # Consumers also poll in case a notification was missed
+CHANGE_EVENT_RETENTION = 86400 * 7
 
 # Constraints
 LEAGUE_UNIQUE_CONSTRAINT = "league_unique_constraint"
@@ -34,4 +142,15 @@ LADDER_MEMBER_UNIQUE_CONSTRAINT = "ladder_member_unique_constraint"
 CHARACTER_MMR_UNIQUE_CONSTRAINT = "character_mmr_unique_constraint"
 CHARACTER_UNIQUE_CONSTRAINT = "character_unique_constraint"
 PROFILE_UNIQUE_CONSTRAINT = "profile_unique_constraint"
+TEAM_UNIQUE_CONSTRAINT = "team_unique_constraint"
+RETRY_REQUEST_UNIQUE_CONSTRAINT = "retry_request_unique_constraint"
+BACKFILL_CHECKPOINT_UNIQUE_CONSTRAINT = "backfill_checkpoint_unique_constraint"
+CHANGE_EVENT_ORDER_INDEX = "change_event_transaction_id_id_index"
+TEAM_MMR_UNIQUE_CONSTRAINT = "team_mmr_unique_constraint"
+CHARACTER_MMR_ROLLUP_UNIQUE_CONSTRAINT = "character_mmr_rollup_unique_constraint"
+CHARACTER_MMR_DATE_INDEX = "character_mmr_date_index"
+CHARACTER_MMR_CREATED_INDEX = "character_mmr_created_timestamp_index"
+MATCH_CREATED_INDEX = "match_created_timestamp_index"
+GAME_CREATED_INDEX = "game_created_timestamp_index"
+LADDER_HISTORY_ORDER_INDEX = "ladder_history_ladder_id_timestamp_index"
 MATCH_UNIQUE_CONSTRAINT = "match_unique_constraint"
@@ -1,14 +1,25 @@
 import os
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from threading import Thread
+import time
+from contextvars import copy_context
+from dataclasses import dataclass
+from queue import Empty, Full, Queue
+from threading import Event, Lock, Semaphore, Thread
+from typing import Any, Callable, Optional
 
+from backend.utils.deadline import with_deadline
 from backend.utils.log import get_logger
+from backend.utils.metrics import Metrics
+from backend.utils.tracing import JobTag, Spans, tagged, thread_tag
 
 logger = get_logger(__name__)
 
+QUEUE_POLL_INTERVAL = 0.1
+
 
 def run_threaded(kwargs):
-    job_thread = Thread(target=kwargs.get("target"), kwargs=kwargs, daemon=True)
+    target = kwargs.get("target")
+    tag = JobTag(job=target.__name__, region_id=kwargs.get("region_id"))
+    job_thread = Thread(target=tagged(with_deadline(target, kwargs.get("deadline")), tag), kwargs=kwargs, daemon=True)
     job_thread.start()
     return job_thread
 
@@ -17,12 +28,169 @@ def thread_pool_max_workers():
     return min(32, os.cpu_count() * 5)
 
 
-def yield_futures(func, iterable, workers=None):
-    if workers is None:
-        workers = thread_pool_max_workers()
+@dataclass
+class Stage:
+    func: Callable
+    workers: int = 1
+    name: Optional[str] = None
+
+    def __post_init__(self):
+        if self.name is None:
+            self.name = getattr(self.func, "__name__", repr(self.func))
+
+
+@dataclass
+class PipelineItem:
+    index: int
+    arg: Any
+    value: Any = None
+    error: Optional[Exception] = None
+    stage: Optional[str] = None
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+class _Done:
+    pass
+
+
+DONE = _Done()
+
+
+class _StageCounter:
+    def __init__(self, count):
+        self.count = count
+        self.lock = Lock()
+
+    def decrement(self):
+        with self.lock:
+            self.count -= 1
+            return self.count == 0
+
+
+def pipeline(iterable, stages, maxsize=None, ordered=False):
+    """
+    Run each item of iterable through stages, e.g. fetch -> validate -> transform, with
+    stage.workers threads per stage connected by bounded queues. A slow stage blocks the
+    stages feeding it, so at most a few items per worker are ever in flight and the
+    iterable is read lazily.
+
+    Yields one PipelineItem per input. An exception raised by a stage is recorded on the
+    item (error, stage) and the item skips the remaining stages instead of tearing down
+    the pipeline. With ordered=True items are yielded in input order, otherwise as they
+    complete. Closing the generator cancels the remaining work. Ordered input is only
+    admitted while fewer items than the queues hold wait on a slower earlier item.
+
+    Stage threads carry the job tag and a copy of the context (e.g. the deadline) of the
+    calling thread, and the time spent in each stage is recorded as a span named after it.
+    """
+    tag = thread_tag()
+    stop = Event()
+    queues = [
+        Queue(maxsize=maxsize or 2 * (stages[i].workers if i < len(stages) else 1)) for i in range(len(stages) + 1)
+    ]
+    feed_errors = []
+    window = Semaphore(sum(queue.maxsize for queue in queues))
+
+    def admit():
+        while not stop.is_set():
+            if window.acquire(timeout=QUEUE_POLL_INTERVAL):
+                return True
+        return False
+
+    def put(queue, item):
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=QUEUE_POLL_INTERVAL)
+                return True
+            except Full:
+                continue
+        return False
+
+    def get(queue):
+        while not stop.is_set():
+            try:
+                return queue.get(timeout=QUEUE_POLL_INTERVAL)
+            except Empty:
+                continue
+        return DONE
+
+    def feed():
+        try:
+            for index, arg in enumerate(iterable):
+                if ordered and not admit():
+                    return
+                if not put(queues[0], PipelineItem(index=index, arg=arg, value=arg)):
+                    return
+        except Exception as e:
+            logger.exception("Exception thrown while reading pipeline input...")
+            feed_errors.append(e)
+        finally:
+            for _ in range(stages[0].workers):
+                put(queues[0], DONE)
+
+    def work(stage, queue_in, queue_out, counter, downstream_workers):
+        while True:
+            item = get(queue_in)
+            if item is DONE:
+                break
+
+            if item.ok:
+                start = time.perf_counter()
+                try:
+                    item.value = stage.func(item.value)
+                except Exception as e:
+                    item.value = None
+                    item.error = e
+                    item.stage = stage.name
+                    Metrics.increment(f"errors.{stage.name}")
+                Spans.record(stage.name, time.perf_counter() - start, tag=tag)
+
+            if not put(queue_out, item):
+                break
+
+        if counter.decrement():
+            for _ in range(downstream_workers):
+                put(queue_out, DONE)
+
+    threads = [Thread(target=copy_context().run, args=(tagged(feed, tag),), daemon=True)]
+    for i, stage in enumerate(stages):
+        downstream_workers = stages[i + 1].workers if i + 1 < len(stages) else 1
+        counter = _StageCounter(stage.workers)
+        for _ in range(stage.workers):
+            threads.append(
+                Thread(
+                    target=copy_context().run,
+                    args=(tagged(work, tag), stage, queues[i], queues[i + 1], counter, downstream_workers),
+                    daemon=True,
+                )
+            )
+
+    logger.info(f"Starting pipeline with stages {[f'{stage.name}x{stage.workers}' for stage in stages]}...")
+    for thread in threads:
+        thread.start()
+
+    try:
+        pending = {}
+        next_index = 0
+        while True:
+            item = queues[-1].get()
+            if item is DONE:
+                break
+
+            if not ordered:
+                yield item
+                continue
+
+            pending[item.index] = item
+            while next_index in pending:
+                window.release()
+                yield pending.pop(next_index)
+                next_index += 1
 
-    logger.info(f"Initializing ThreadPoolExecutor with {workers} workers...")
-    with ThreadPoolExecutor(max_workers=workers) as executor:
-        futures = {executor.submit(func, arg): arg for arg in iterable}
-        for future in as_completed(futures):
-            yield future.result(), futures[future]
+        if feed_errors:
+            raise feed_errors[0]
+    finally:
+        stop.set()
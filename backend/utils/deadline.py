@@ -0,0 +1,72 @@
+"""
+Job deadlines, propagated to every call the job makes through a context variable. Threads
+started by a job run in a copy of its context so they see the same deadline.
+"""
+
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from threading import Lock
+
+_deadline = ContextVar("deadline", default=None)
+
+
+@contextmanager
+def deadline(seconds):
+    """Work in this block should be done within seconds, or by an enclosing deadline if sooner"""
+    at = time.monotonic() + seconds
+    outer = _deadline.get()
+    token = _deadline.set(at if outer is None else min(at, outer))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining():
+    """Seconds left before the deadline, None without one"""
+    at = _deadline.get()
+    return None if at is None else at - time.monotonic()
+
+
+def expired():
+    left = remaining()
+    return left is not None and left <= 0
+
+
+class ResumeCursors:
+    """
+    Where a job's next run starts after one was cut off by its deadline, so work past the
+    deadline is reached next time instead of the head of the work list being redone. Keyed
+    by the job's (name, region, ...), the cursor is the lowest sort key that was cut off.
+    """
+
+    lock = Lock()
+    cursors = {}
+
+    @classmethod
+    def get(cls, key):
+        with cls.lock:
+            return cls.cursors.get(key)
+
+    @classmethod
+    def update(cls, key, cut):
+        """Resume from the lowest of cut, or start over when nothing was cut off"""
+        with cls.lock:
+            if cut:
+                cls.cursors[key] = min(cut)
+            else:
+                cls.cursors.pop(key, None)
+
+
+def with_deadline(func, seconds):
+    if not seconds:
+        return func
+
+    @wraps(func)
+    def run(*args, **kwargs):
+        with deadline(seconds):
+            return func(*args, **kwargs)
+
+    return run
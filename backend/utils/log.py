@@ -1,24 +1,157 @@
+"""
+Process wide logging. Records are put on a bounded queue by the calling thread and written
+to the file and console by a single listener thread, so workers never wait on log I/O.
+"""
+
+import atexit
+import json
 import logging
+import queue
+import time
+from logging.handlers import QueueHandler, QueueListener
+from threading import Lock
 
-from backend.static import APPLICATION_LOG_PATH
+from backend.static import (
+    APPLICATION_LOG_PATH,
+    LOG_FORMAT,
+    LOG_QUEUE_SIZE,
+    LOG_SAMPLE_RATES,
+)
 
+TEXT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
 
-def get_logger(name):
+# Attributes of every LogRecord, anything else was passed as extra=
+RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
 
-    logger = logging.getLogger(name)
-    logger.setLevel(logging.INFO)
+_listener = None
+_listener_lock = Lock()
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, with any extra= fields of the record"""
+
+    def format(self, record):
+        entry = {
+            "timestamp": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        entry.update({key: value for key, value in vars(record).items() if key not in RECORD_ATTRIBUTES})
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """Drops records instead of blocking the caller when the writer thread falls behind"""
+
+    dropped = 0
+
+    def prepare(self, record):
+        # Only resolve the message here, formatting happens on the listener thread
+        record = logging.makeLogRecord(vars(record))
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            NonBlockingQueueHandler.dropped += 1
+
+
+class SampleFilter(logging.Filter):
+    """
+    Lets at most rate INFO and DEBUG records per second through, as a token bucket. The
+    next record let through reports how many were suppressed.
+    """
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+        self.tokens = rate
+        self.last = time.monotonic()
+        self.suppressed = 0
+        self.lock = Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
 
-    file_handler = logging.FileHandler(APPLICATION_LOG_PATH)
-    file_handler.setLevel(logging.INFO)
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens < 1:
+                self.suppressed += 1
+                return False
 
-    console_handler = logging.StreamHandler()
-    console_handler.setLevel(logging.INFO)
+            self.tokens -= 1
+            suppressed, self.suppressed = self.suppressed, 0
 
-    formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
-    file_handler.setFormatter(formatter)
-    console_handler.setFormatter(formatter)
+        if suppressed:
+            record.suppressed = suppressed
+            record.msg = f"{record.msg} [{suppressed} similar suppressed]"
+        return True
+
+
+def get_formatter():
+    return JsonFormatter() if LOG_FORMAT == "json" else logging.Formatter(TEXT_FORMAT)
+
+
+def configure_logging():
+    """Install the queue handler on the root logger and start its listener, once per process"""
+    global _listener
+    with _listener_lock:
+        if _listener is not None:
+            return
+
+        # delay opens the log file on the first record rather than at import
+        file_handler = logging.FileHandler(APPLICATION_LOG_PATH, delay=True)
+        console_handler = logging.StreamHandler()
+        for handler in (file_handler, console_handler):
+            handler.setLevel(logging.INFO)
+            handler.setFormatter(get_formatter())
+
+        records = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+        logging.getLogger().addHandler(NonBlockingQueueHandler(records))
+        _listener = QueueListener(records, file_handler, console_handler, respect_handler_level=True)
+        _listener.start()
+        atexit.register(stop_logging)
+
+
+def stop_logging():
+    """Flush queued records and stop the listener thread"""
+    global _listener
+    with _listener_lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
+
+
+def log_stats():
+    return {
+        "dropped": NonBlockingQueueHandler.dropped,
+        "queued": _listener.queue.qsize() if _listener else 0,
+    }
+
+
+def get_logger(name):
+
+    configure_logging()
+    logger = logging.getLogger(name)
+    logger.setLevel(logging.INFO)
 
-    logger.addHandler(file_handler)
-    logger.addHandler(console_handler)
+    rate = LOG_SAMPLE_RATES.get(name)
+    if rate and not any(isinstance(f, SampleFilter) for f in logger.filters):
+        logger.addFilter(SampleFilter(rate))
 
     return logger
@@ -0,0 +1,37 @@
+"""
+Process wide counters reported by one-shot runs
+"""
+
+from collections import Counter
+from threading import Lock
+
+
+class Metrics:
+    """Counters keyed by dotted name, e.g. api.requests or rows.ladder_member"""
+
+    lock = Lock()
+    counters = Counter()
+
+    @classmethod
+    def increment(cls, name, value=1):
+        with cls.lock:
+            cls.counters[name] += value
+
+    @classmethod
+    def get(cls):
+        with cls.lock:
+            return dict(cls.counters)
+
+    @classmethod
+    def reset(cls):
+        with cls.lock:
+            cls.counters.clear()
+
+
+def group_counters(counters):
+    """{"api.requests": 3, "rows.match": 5} -> {"api": {"requests": 3}, "rows": {"match": 5}}"""
+    grouped = {}
+    for name, value in sorted(counters.items()):
+        group, _, key = name.partition(".")
+        grouped.setdefault(group, {})[key or group] = value
+    return grouped
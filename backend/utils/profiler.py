@@ -0,0 +1,127 @@
+"""
+Sampling profiler for running jobs. A background thread samples the stacks of the threads
+tagged with a job every PROFILE_INTERVAL seconds and writes them in the collapsed stack
+format read by flamegraph.pl and speedscope, one file per job and region:
+
+    PROFILE_PATH/get_ladder_results-region_1-1760000000.collapsed
+
+Started by --profile SECONDS for one-shot runs, or by SIGUSR1 on the scheduled process,
+which reads an optional "<job> [seconds]" from PROFILE_PATH/PROFILE_REQUEST_FILE.
+"""
+
+import os
+import signal
+import sys
+import time
+from collections import Counter, defaultdict
+from threading import Event, Lock, Thread
+
+from backend.static import (
+    PROFILE_INTERVAL,
+    PROFILE_PATH,
+    PROFILE_REQUEST_FILE,
+    PROFILE_SECONDS,
+)
+from backend.utils.log import get_logger
+from backend.utils.tracing import thread_tag
+
+logger = get_logger(__name__)
+
+_active = None
+_active_lock = Lock()
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def collapse(frame):
+    """Root first, semicolon separated stack of frame"""
+    names = []
+    while frame is not None:
+        names.append(frame_name(frame))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class SamplingProfiler:
+    def __init__(self, seconds, job=None, interval=PROFILE_INTERVAL, path=PROFILE_PATH):
+        self.seconds = seconds
+        self.job = job
+        self.interval = interval
+        self.path = path
+        self.samples = defaultdict(Counter)
+        self.stopped = Event()
+        self.thread = Thread(target=self.run, name="profiler", daemon=True)
+
+    def sample(self):
+        for ident, frame in sys._current_frames().items():
+            tag = thread_tag(ident)
+            if tag is None or (self.job and tag.job != self.job):
+                continue
+            self.samples[tag][collapse(frame)] += 1
+
+    def run(self):
+        logger.info(f"Profiling {self.job or 'all jobs'} for {self.seconds} seconds...")
+        deadline = time.monotonic() + self.seconds
+        while time.monotonic() < deadline and not self.stopped.wait(self.interval):
+            self.sample()
+
+        paths = self.write()
+        logger.info(f"Wrote profiles {[str(path) for path in paths]}.")
+
+    def write(self):
+        self.path.mkdir(parents=True, exist_ok=True)
+        timestamp = int(time.time())
+        paths = []
+        for tag, stacks in self.samples.items():
+            path = self.path / f"{tag}-{timestamp}.collapsed"
+            with open(path, "w") as f:
+                for stack, count in stacks.most_common():
+                    f.write(f"{stack} {count}\n")
+            paths.append(path)
+        return paths
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+
+def start_profiler(seconds=PROFILE_SECONDS, job=None):
+    """Start a profile unless one is already running. Returns the profiler or None."""
+    global _active
+    with _active_lock:
+        if _active is not None and _active.thread.is_alive():
+            logger.warning("A profile is already running, ignoring request.")
+            return None
+        _active = SamplingProfiler(seconds=seconds, job=job).start()
+        return _active
+
+
+def read_profile_request():
+    """(job, seconds) from the request file, which is consumed. All jobs by default."""
+    path = PROFILE_PATH / PROFILE_REQUEST_FILE
+    try:
+        request = path.read_text().split()
+        path.unlink()
+    except FileNotFoundError:
+        return None, PROFILE_SECONDS
+
+    job = request[0] if request else None
+    seconds = float(request[1]) if len(request) > 1 else PROFILE_SECONDS
+    return job, seconds
+
+
+def handle_profile_signal(signum, frame):
+    job, seconds = read_profile_request()
+    start_profiler(seconds=seconds, job=job)
+
+
+def install_profile_signal():
+    """Profile on SIGUSR1, e.g. kill -USR1 <pid>"""
+    signal.signal(signal.SIGUSR1, handle_profile_signal)
@@ -3,7 +3,14 @@ from threading import active_count
 import schedule
 
 from backend.api.blizzard import APIState
-from backend.utils.log import get_logger
+from backend.api.circuit import CircuitState
+from backend.api.latency import LatencyState
+from backend.db.db import session_scope
+from backend.etl.identity import identity_stats
+from backend.etl.priority import PriorityState
+from backend.etl.retry import retry_stats
+from backend.utils.log import get_logger, log_stats
+from backend.utils.tracing import Spans
 
 logger = get_logger(__name__)
 
@@ -15,11 +22,60 @@ def log_app_state(**kwargs):
         tags = "".join(sorted(job.tags))
         jobs_logging += f"\tname={tags}, next={job.next_run}, last={job.last_run}\n"
 
+    coverage_logging = "Match history coverage:\n"
+    for region_id, stats in sorted(PriorityState.get().items()):
+        coverage_logging += (
+            f"\tregion_id={region_id}, selected={stats.selected}, candidates={stats.candidates}, "
+            f"active={stats.active}, coverage={stats.coverage}, "
+            f"staleness_p50={stats.staleness_p50}, staleness_p95={stats.staleness_p95}\n"
+        )
+
+    circuit_logging = "Blizzard API circuits:\n"
+    for host, breaker in sorted(CircuitState.get().items()):
+        circuit_logging += (
+            f"\thost={host}, state={breaker.state}, failures={breaker.failures}, "
+            f"retry_budget={round(breaker.retry_budget.tokens, 1)}, "
+            f"hedge_budget={round(breaker.hedge_budget.tokens, 1)}\n"
+        )
+    for endpoint, latency in sorted(LatencyState.get().items(), key=lambda item: str(item[0])):
+        circuit_logging += f"\tendpoint={endpoint}, p50={latency['p50']}, p95={latency['p95']}\n"
+
+    with session_scope() as session:
+        stats = retry_stats(session)
+    retry_logging = "Retry queue:\n"
+    for stat in stats:
+        retry_logging += (
+            f"\tregion_id={stat.region_id}, kind={stat.kind}, pending={stat.pending}, "
+            f"due={stat.due}, dead={stat.dead}\n"
+        )
+
+    span_logging = "Job spans:\n"
+    for tag, spans in Spans.get().items():
+        span_logging += f"\t{tag}: " + ", ".join(
+            f"{name}={stats['count']}x {stats['seconds']}s (max {stats['max_seconds']}s)"
+            for name, stats in spans.items()
+        )
+        span_logging += "\n"
+
+    identity_logging = "Identity caches:\n"
+    for name, stats in identity_stats().items():
+        identity_logging += (
+            f"\tname={name}, entries={stats['entries']}, megabytes={stats['megabytes']}, "
+            f"hit_rate={stats['hit_rate']}, evictions={stats['evictions']}\n"
+        )
+
+    logs = log_stats()
     logger.info(
         "\n"
         "Application state: \n"
         f"Active threads: {active_count()} \n"
         f"Blizzard API second request count: {APIState.get_second_request_count()} \n"
         f"Blizzard API day request count: {APIState.get_day_request_count()} \n"
+        f"Log records queued: {logs['queued']}, dropped: {logs['dropped']} \n"
         f"{jobs_logging}"
+        f"{coverage_logging}"
+        f"{circuit_logging}"
+        f"{retry_logging}"
+        f"{span_logging}"
+        f"{identity_logging}"
     )
@@ -0,0 +1,99 @@
+"""
+Job tags of threads and wall clock spans of job phases (fetch, validate, transform, write)
+"""
+
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from threading import Lock, get_ident
+from typing import Optional
+
+_thread_tags = {}
+
+
+@dataclass(frozen=True)
+class JobTag:
+    job: str
+    region_id: Optional[int] = None
+
+    def __str__(self):
+        return self.job if self.region_id is None else f"{self.job}-region_{self.region_id}"
+
+
+def tag_thread(tag):
+    _thread_tags[get_ident()] = tag
+
+
+def untag_thread():
+    _thread_tags.pop(get_ident(), None)
+
+
+def thread_tag(ident=None):
+    return _thread_tags.get(get_ident() if ident is None else ident)
+
+
+def tagged(func, tag):
+    """func run with the calling thread tagged, so threads started by a job are attributed to it"""
+    if tag is None:
+        return func
+
+    def run(*args, **kwargs):
+        tag_thread(tag)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            untag_thread()
+
+    return run
+
+
+@dataclass
+class SpanStats:
+    count: int = 0
+    seconds: float = 0
+    max_seconds: float = 0
+
+    def add(self, seconds):
+        self.count += 1
+        self.seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+
+
+class Spans:
+    """Span durations per job tag and span name, reported by one-shot runs and log_app_state"""
+
+    lock = Lock()
+    stats = {}
+
+    @classmethod
+    def record(cls, name, seconds, tag=None):
+        key = (str(tag or thread_tag() or "untagged"), name)
+        with cls.lock:
+            cls.stats.setdefault(key, SpanStats()).add(seconds)
+
+    @classmethod
+    def get(cls):
+        """{"get_ladder_results-region_1": {"fetch": {"count": ..., "seconds": ..., ...}}}"""
+        with cls.lock:
+            grouped = {}
+            for (tag, name), stats in sorted(cls.stats.items()):
+                grouped.setdefault(tag, {})[name] = {
+                    "count": stats.count,
+                    "seconds": round(stats.seconds, 3),
+                    "max_seconds": round(stats.max_seconds, 3),
+                }
+            return grouped
+
+    @classmethod
+    def reset(cls):
+        with cls.lock:
+            cls.stats.clear()
+
+
+@contextmanager
+def span(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        Spans.record(name, time.perf_counter() - start)